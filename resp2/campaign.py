@@ -0,0 +1,583 @@
+"""
+campaign.py runs RESP2 charge calculations for a whole table of molecules.
+
+The table has the format of the files in Studies/Results: an optional header line followed by rows
+of an index, a SMILES string and property columns. Every molecule x stage x conformer job is
+recorded in a SQLite database together with its status (queued, running, done, failed, duplicate
+for conformers removed after the optimization, or skipped for conformers a sequential run did not need)
+and timings, so the state of a campaign can be queried
+without walking the molecule folders:
+
+    python -m resp2.campaign run molecules.csv --db campaign.db --workers 4
+    python -m resp2.campaign status --db campaign.db
+    python -m resp2.campaign plan molecules.csv [--json]
+
+Molecules are processed in parallel (most expensive first) by a pool of worker processes. Every
+worker gets its own share of the CPUs and memory of the host for its psi4 jobs. Molecules which are
+already done are skipped when a campaign is restarted.
+
+To spread a campaign over several nodes, the molecules are put into a task queue on a shared
+filesystem (see executors) and every node runs workers which use the whole node:
+
+    python -m resp2.campaign run molecules.csv --db campaign.db --executor shared --queue queue.db
+    python -m resp2.executors worker --queue queue.db    # on every node
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import json
+import logging as log
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+
+try:
+    import resp2.resp2 as resp2
+    import resp2.resources as resources
+    import resp2.cost as cost
+    import resp2.plan as plan
+    import resp2.executors as executors
+    import resp2.progress as progress
+    import resp2.presets as presets
+except ModuleNotFoundError:
+    import resp2
+    import resources
+    import cost
+    import plan
+    import executors
+    import progress
+    import presets
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS molecules (
+    name TEXT PRIMARY KEY,
+    smiles TEXT,
+    resname TEXT,
+    properties TEXT,
+    status TEXT DEFAULT 'queued'
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    molecule TEXT,
+    stage TEXT,
+    conformer INTEGER DEFAULT 0,
+    status TEXT DEFAULT 'queued',
+    started REAL,
+    finished REAL,
+    elapsed REAL,
+    host TEXT,
+    message TEXT,
+    PRIMARY KEY (molecule, stage, conformer)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, stage);
+"""
+
+STATUSES = ['queued', 'running', 'done', 'failed']
+
+BRANCHES = ['RESP2LIQUID', 'RESP2GAS', 'RESP1']
+
+
+class JobDatabase(object):
+    """
+    SQLite database of the molecules and jobs of a campaign.
+    Every operation opens its own connection, so the database can be used from several processes.
+
+    :param path: Path to the database file. Created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._transaction() as connection:
+            connection.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def add_molecule(self, name, smiles, resname, properties=None):
+        """
+        Adds a molecule to the campaign. Molecules which are already known are not changed.
+        """
+        with self._transaction() as connection:
+            connection.execute('INSERT OR IGNORE INTO molecules (name, smiles, resname, properties) VALUES (?,?,?,?)',
+                               (name, smiles, resname, json.dumps(properties or [])))
+        return 0
+
+    def set_molecule_status(self, name, status):
+        with self._transaction() as connection:
+            connection.execute('UPDATE molecules SET status=? WHERE name=?', (status, name))
+        return 0
+
+    def molecules(self, status=None):
+        """
+        :param status: Only return molecules with this status.
+        :return: List of dictionaries with the columns of the molecules table.
+        """
+        with self._transaction() as connection:
+            if status is None:
+                rows = connection.execute('SELECT * FROM molecules ORDER BY rowid').fetchall()
+            else:
+                rows = connection.execute('SELECT * FROM molecules WHERE status=? ORDER BY rowid', (status,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def add_job(self, molecule, stage, conformer=0):
+        """
+        Registers a job as queued. Jobs which are already known are not changed.
+        """
+        with self._transaction() as connection:
+            connection.execute('INSERT OR IGNORE INTO jobs (molecule, stage, conformer) VALUES (?,?,?)',
+                               (molecule, stage, conformer))
+        return 0
+
+    def update_job(self, molecule, stage, conformer=0, status='running', message=None):
+        """
+        Sets the status of a job. Starting a job records the start time and host,
+        finishing it (done or failed) the end time and the elapsed time.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute('INSERT OR IGNORE INTO jobs (molecule, stage, conformer) VALUES (?,?,?)',
+                               (molecule, stage, conformer))
+            if status == 'running':
+                connection.execute('UPDATE jobs SET status=?, started=?, finished=NULL, elapsed=NULL, host=?, '
+                                   'message=? WHERE molecule=? AND stage=? AND conformer=?',
+                                   (status, now, socket.gethostname(), message, molecule, stage, conformer))
+            elif status in ('done', 'failed'):
+                connection.execute('UPDATE jobs SET status=?, finished=?, elapsed=?-started, message=? '
+                                   'WHERE molecule=? AND stage=? AND conformer=?',
+                                   (status, now, now, message, molecule, stage, conformer))
+            else:
+                connection.execute('UPDATE jobs SET status=?, message=? WHERE molecule=? AND stage=? AND conformer=?',
+                                   (status, message, molecule, stage, conformer))
+        return 0
+
+    @contextlib.contextmanager
+    def job(self, molecule, stage, conformer=0):
+        """
+        Context manager marking a job as running and afterwards as done, or as failed if an exception is raised.
+        """
+        self.update_job(molecule, stage, conformer, 'running')
+        try:
+            yield
+        except BaseException as e:
+            self.update_job(molecule, stage, conformer, 'failed', message=repr(e))
+            raise
+        self.update_job(molecule, stage, conformer, 'done')
+
+    def jobs(self, status=None, stage=None, molecule=None):
+        """
+        :return: List of dictionaries with the columns of the jobs table matching all given filters.
+        """
+        conditions, values = [], []
+        for column, value in (('status', status), ('stage', stage), ('molecule', molecule)):
+            if value is not None:
+                conditions.append('{}=?'.format(column))
+                values.append(value)
+        query = 'SELECT * FROM jobs'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        with self._transaction() as connection:
+            return [dict(row) for row in connection.execute(query + ' ORDER BY rowid', values).fetchall()]
+
+    def summary(self):
+        """
+        :return: Dictionary stage -> {status: number of jobs}
+        """
+        summary = {}
+        with self._transaction() as connection:
+            for row in connection.execute('SELECT stage, status, COUNT(*) FROM jobs GROUP BY stage, status'):
+                summary.setdefault(row[0], {})[row[1]] = row[2]
+        return summary
+
+
+def read_smiles_table(filename):
+    """
+    Reads a table of molecules (index, SMILES, property columns). A header line is skipped.
+
+    :param filename: Path to the csv file.
+    :return: List of dictionaries with the keys index, smiles and properties.
+    """
+    molecules = []
+    for row in csv.reader(open(filename)):
+        if len(row) < 2 or not row[0].strip().isdigit():
+            continue
+        molecules.append(dict(index=int(row[0]), smiles=row[1].strip(), properties=[value.strip() for value in row[2:]]))
+    return molecules
+
+
+def molecule_resname(index):
+    """
+    :param index: Index of the molecule in the table.
+    :return: Three letter residue name (M followed by the index in base 36).
+    """
+    digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    return 'M' + digits[(index // 36) % 36] + digits[index % 36]
+
+
+_worker_host = None
+
+
+def _init_worker(shares):
+    """
+    Initializer of the worker processes. Every worker takes its own share of the host.
+    """
+    global _worker_host
+    _worker_host = shares.get()
+
+
+def host_shares(nworkers, host=None):
+    """
+    Splits the CPUs and memory of the host into disjoint shares, one for every worker.
+
+    :param nworkers: Number of workers.
+    :param host: resources.HostResources. default: resources.detect_host_resources()
+    :return: List of resources.HostResources
+    """
+    if host is None:
+        host = resources.detect_host_resources()
+    ncores = max(host.ncores // nworkers, 1)
+    return [resources.HostResources(host.cpus[(k * ncores) % host.ncores:(k * ncores) % host.ncores + ncores],
+                                    host.memory / nworkers) for k in range(nworkers)]
+
+
+def _run_branches(database, name, prefix, resname, folder, number_of_conformers, branches, opt=True,
+                  timeout=None, preset=None, deduplicate=False):
+    """
+    Optimizes all conformers of a molecule, then calculates and fits the ESPs of every branch with respyte.
+    Raises RuntimeError if the ESP of any conformer failed. Used by run_molecule, prefix is the name of the molecule including the path of the working directory.
+    """
+    for i in range(1, number_of_conformers + 1):
+        database.update_job(name, 'optimization', i, 'running')
+    success = resp2.optimize_conformers(name=prefix, resname=resname, opt=opt, folder=folder,
+                                        number_of_conformers=number_of_conformers, timeout=timeout,
+                                        host=_worker_host, preset=preset)
+    for i in range(1, number_of_conformers + 1):
+        database.update_job(name, 'optimization', i, 'done' if success.get(i) else 'failed')
+    if deduplicate:
+        unique = resp2.deduplicate_optimized(name=prefix, resname=resname, folder=folder,
+                                             number_of_conformers=number_of_conformers, preset=preset)
+        for i in range(unique + 1, number_of_conformers + 1):
+            for type in branches:
+                database.update_job(name, type, i, 'duplicate')
+        number_of_conformers = unique
+
+    # required_branches lists RESP2LIQUID before RESP2GAS, which uses its gas phase ESP
+    pair = resp2.paired_branches(branches)
+    for type in branches:
+        for i in range(1, number_of_conformers + 1):
+            database.update_job(name, type, i, 'running')
+        resp2.prepare_respyte(name=prefix, resname=resname, type=type, opt_folder=folder,
+                              number_of_conformers=number_of_conformers, preset=preset)
+        success = resp2.generate_esp(name=prefix, type=type, number_of_conformers=number_of_conformers,
+                                     timeout=timeout, pair=pair, preset=preset)
+        for i in range(1, number_of_conformers + 1):
+            database.update_job(name, type, i, 'done' if success.get(i) else 'failed')
+        # A failed conformer fails the molecule instead of a fit to the remaining ones
+        resp2.require_esp(success, type=type, name=name)
+        resp2.fit_respyte(name=prefix, type=type, timeout=timeout)
+    return 0
+
+
+def run_molecule(db=None, name='', smiles='', resname='MOL', workdir='.', opt=True, charge_type='RESP2', delta=1.0,
+                 timeout=None, preset=None, preoptimize=None, deduplicate=False, adaptive=False,
+                 max_conformers=None, sequential=False):
+    """
+    Calculates the charges of a single molecule and records every stage in the job database.
+
+    :param db: Path to the job database.
+    :param name: Name of the molecule. Folders are named accordingly.
+    :param smiles: SMILES Code of the molecule.
+    :param resname: Abbreviation of the Residue. Specified in the mol2
+    :param workdir: Folder the molecule folders are created in.
+    :param opt: True when generated conformers should be locally optimized.
+    :param charge_type: RESP1 or RESP2
+    :param delta: Mixing parameter of the charges.
+    :param timeout: Wall-clock limit in seconds for every external program call.
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
+    :param preoptimize: Force field the conformers are pre-optimized with, e.g. MMFF94 (see conformers).
+    :param deduplicate: Remove duplicate conformers before and after the optimization (see conformers).
+    :param adaptive: Choose the number of conformers from the flexibility of the molecule (see conformers).
+    :param max_conformers: Upper limit of the number of conformers. default=None (resp2.MAX_CONFORMERS)
+    :param sequential: Stop adding conformers once the charges converged (see resp2.sequential_charges).
+                       Conformers which are not needed are recorded as skipped.
+    :return: True if the charges were created.
+    """
+    database = JobDatabase(db)
+    database.set_molecule_status(name, 'running')
+    # The folder names of the stages are derived from the name, a path prefix keeps them in workdir
+    prefix = os.path.join(workdir, name)
+    folder = prefix + '-liquid'
+    try:
+        with database.job(name, 'structure'):
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            resp2.create_structure(smi=smiles, folder=folder, resname=resname)
+
+        with database.job(name, 'conformers'):
+            number_of_conformers = resp2.create_conformers(infile=resname + '.mol2',
+                                                           outfile=resname + '-conformers.mol2',
+                                                           resname=resname, folder=folder,
+                                                           preoptimize=preoptimize, deduplicate=deduplicate,
+                                                           adaptive=adaptive, max_conformers=max_conformers)
+        branches = resp2.required_branches(charge_types=[charge_type], deltas=[delta])
+        for i in range(1, number_of_conformers + 1):
+            for stage in ['optimization'] + branches:
+                database.add_job(name, stage, i)
+
+        if sequential:
+            for i in range(1, number_of_conformers + 1):
+                for stage in ['optimization'] + branches:
+                    database.update_job(name, stage, i, 'running')
+            record = resp2.sequential_charges(name=prefix, resname=resname, folder=folder,
+                                              number_of_conformers=number_of_conformers, branches=branches,
+                                              timeout=timeout, preset=preset)
+            for i in range(1, number_of_conformers + 1):
+                status = 'done' if i in record['order'] else 'duplicate' if i in record['duplicates'] else 'skipped'
+                for stage in ['optimization'] + branches:
+                    database.update_job(name, stage, i, status)
+        else:
+            _run_branches(database, name, prefix, resname, folder, number_of_conformers, branches, opt=opt,
+                          timeout=timeout, preset=preset, deduplicate=deduplicate)
+
+        with database.job(name, 'charges'):
+            resp2.create_charge_file(name=prefix, resname=resname, type=charge_type, delta=delta)
+    except Exception as e:
+        log.error('Charge calculation of {} FAILED: {}'.format(name, e))
+        database.set_molecule_status(name, 'failed')
+        return False
+    database.set_molecule_status(name, 'done')
+    return True
+
+
+def run_campaign(table='', db='campaign.db', workdir='.', nworkers=1, opt=True, charge_type='RESP2', delta=1.0,
+                 timeout=None, executor=None, preset=None, preoptimize=None, deduplicate=False, adaptive=False,
+                 qm_budget=None, sequential=False, status_file=None, report_interval=30.0):
+    """
+    Runs the charge calculations of all molecules of a table.
+
+    :param table: Path to the csv file with the molecules (see read_smiles_table).
+    :param db: Path to the job database.
+    :param workdir: Folder the molecule folders are created in.
+    :param nworkers: Number of molecules processed at the same time.
+    :param opt: True when generated conformers should be locally optimized.
+    :param charge_type: RESP1 or RESP2
+    :param delta: Mixing parameter of the charges.
+    :param timeout: Wall-clock limit in seconds for every external program call.
+    :param executor: concurrent.futures.Executor running the molecules (see executors). It is not shut down.
+                     The paths of db and workdir have to be valid for its workers.
+                     default=None (a local process pool with nworkers processes, each with its share of the host)
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
+    :param preoptimize: Force field the conformers are pre-optimized with, e.g. MMFF94 (see conformers).
+    :param deduplicate: Remove duplicate conformers before and after the optimization (see conformers).
+    :param adaptive: Choose the number of conformers from the flexibility of every molecule (see conformers).
+    :param qm_budget: QM budget of the molecules to process in core-hours. The conformers are distributed
+                      over the molecules by flexibility (see resp2.budget_conformers). default=None
+    :param sequential: Stop adding conformers to a molecule once its charges converged
+                       (see resp2.sequential_charges). default=False
+    :param status_file: JSON file the progress of the QM jobs of all workers is written to (see progress).
+                        default=None
+    :param report_interval: Seconds between progress reports in the log and the status file. default=30
+    :return: Dictionary molecule name -> True if the charges were created.
+    """
+    database = JobDatabase(db)
+    for molecule in read_smiles_table(table):
+        name = 'mol{:04d}'.format(molecule['index'])
+        database.add_molecule(name, molecule['smiles'], molecule_resname(molecule['index']), molecule['properties'])
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    todo = [molecule for molecule in database.molecules() if molecule['status'] != 'done']
+    # Longest job first across molecules
+    cost_model = cost.get_cost_model()
+    level = presets.get_preset(preset)
+    todo.sort(key=lambda molecule: -cost_model.estimate_optimization(cost.elements_from_smiles(molecule['smiles']),
+                                                                     level.ladder, level.hf_hessian))
+    log.info('Campaign {}: {} molecules to process with {} workers'.format(db, len(todo), nworkers))
+    max_conformers = {}
+    if qm_budget is not None:
+        counts = resp2.budget_conformers([dict(molecule, folder=os.path.join(workdir, molecule['name']) + '-liquid')
+                                          for molecule in todo], budget=qm_budget, charge_types=[charge_type],
+                                         deltas=[delta], preset=preset)
+        max_conformers = {molecule['name']: count for molecule, count in zip(todo, counts)}
+        adaptive = True
+
+    pool = executor
+    if executor is None:
+        shares = multiprocessing.Queue()
+        for share in host_shares(nworkers):
+            shares.put(share)
+        pool = executors.LocalExecutor(max_workers=nworkers, initializer=_init_worker, initargs=(shares,))
+    results = {}
+    # The workers report their jobs through a journal in the workdir (see progress.Forwarded)
+    journal = tempfile.mkdtemp(prefix='.progress-', dir=workdir)
+    reporter = progress.Reporter(path=status_file, interval=report_interval, journal=journal).start()
+    try:
+        futures = {pool.submit(progress.Forwarded(run_molecule, journal), db=db, name=molecule['name'], smiles=molecule['smiles'],
+                               resname=molecule['resname'], workdir=workdir, opt=opt, charge_type=charge_type,
+                               delta=delta, timeout=timeout, preset=preset,
+                               preoptimize=preoptimize, deduplicate=deduplicate, adaptive=adaptive,
+                               max_conformers=max_conformers.get(molecule['name']),
+                               sequential=sequential): molecule['name']
+                   for molecule in todo}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+    finally:
+        if executor is None:
+            pool.shutdown()
+        reporter.stop()
+        shutil.rmtree(journal, ignore_errors=True)
+    return results
+
+
+def plan_campaign(table='', workdir='.', opt=True, charge_type='RESP2', delta=1.0, preset=None):
+    """
+    Estimates the jobs and resources of a campaign without running anything (see plan.plan_molecule).
+
+    :param table: Path to the csv file with the molecules (see read_smiles_table).
+    :param workdir: Folder the molecule folders are created in.
+    :param opt: True when generated conformers should be locally optimized.
+    :param charge_type: RESP1 or RESP2
+    :param delta: Mixing parameter of the charges.
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
+    :return: List of plan.PlannedJobs
+    """
+    molecules = []
+    for molecule in read_smiles_table(table):
+        name = 'mol{:04d}'.format(molecule['index'])
+        molecules.append(dict(name=name, smiles=molecule['smiles'], resname=molecule_resname(molecule['index']),
+                              folder=os.path.join(workdir, name) + '-liquid'))
+    return plan.plan_molecules(molecules, opt=opt, charge_types=[charge_type], deltas=[delta], preset=preset)
+
+
+def campaign_progress(db='campaign.db'):
+    """
+    Progress of a campaign in the format of progress.Tracker.snapshot. The throughput is measured over
+    the last progress.WINDOW seconds; the ETA extrapolates the rate at which molecules were finished.
+
+    :param db: Path to the job database.
+    :return: Dictionary with the keys time, elapsed, eta and stages.
+    """
+    database = JobDatabase(db)
+    now = time.time()
+    jobs = database.jobs()
+    started = min([job['started'] for job in jobs if job['started']] or [now])
+    window = min(progress.WINDOW, max(now - started, 1.0))
+    stages = {}
+    for job in jobs:
+        counts = stages.setdefault(job['stage'], dict(queued=0, running=0, done=0, failed=0, per_hour=0.0))
+        counts[job['status']] = counts.get(job['status'], 0) + 1
+        if job['status'] == 'done' and job['finished'] and job['finished'] > now - window:
+            counts['per_hour'] += 3600.0 / window
+    molecules = database.molecules()
+    remaining = len([molecule for molecule in molecules if molecule['status'] in ('queued', 'running')])
+    rate = stages.get('charges', {}).get('per_hour', 0.0)
+    eta = remaining / rate * 3600.0 if rate > 0 else None
+    return dict(time=now, elapsed=now - started, eta=eta, stages=stages)
+
+
+def print_status(db='campaign.db', output=sys.stdout):
+    """
+    Prints the number of jobs per stage and status, followed by the running and failed jobs.
+
+    :param db: Path to the job database.
+    :param output: File to write to.
+    :return: 0 if successful
+    """
+    database = JobDatabase(db)
+    summary = database.summary()
+    output.write('{:<14}'.format('stage') + ''.join('{:>9}'.format(status) for status in STATUSES) + '\n')
+    for stage in ['structure', 'conformers', 'optimization'] + BRANCHES + ['charges']:
+        if stage in summary:
+            output.write('{:<14}'.format(stage) +
+                         ''.join('{:>9}'.format(summary[stage].get(status, 0)) for status in STATUSES) + '\n')
+    output.write(progress.format_snapshot(campaign_progress(db)) + '\n')
+    for status in ['running', 'failed']:
+        for job in database.jobs(status=status):
+            output.write('{:<8} {:<10} {:<14} conformer {:<3} {} {}\n'.format(
+                status, job['molecule'], job['stage'], job['conformer'], job['host'] or '', job['message'] or ''))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run RESP2 charge calculations for a table of molecules.')
+    subparsers = parser.add_subparsers(dest='command')
+    run = subparsers.add_parser('run', help='Run (or continue) a campaign.')
+    run.add_argument('table', type=str, help='csv file with index, SMILES and property columns')
+    run.add_argument('--db', type=str, default='campaign.db', help='Job database.')
+    run.add_argument('--workdir', type=str, default='.', help='Folder for the molecule folders.')
+    run.add_argument('--workers', type=int, default=1, help='Number of molecules processed at the same time.')
+    run.add_argument('--charge-type', type=str, default='RESP2', help='RESP1 or RESP2')
+    run.add_argument('--delta', type=float, default=1.0, help='Mixing parameter of the charges.')
+    run.add_argument('--timeout', type=float, default=None, help='Time limit of external programs in seconds.')
+    run.add_argument('--preset', type=str, default=None, help='Level of theory: production (default) or screening')
+    run.add_argument('--preoptimize', type=str, default=None,
+                     help='Force field the conformers are pre-optimized with before psi4, e.g. MMFF94')
+    run.add_argument('--deduplicate', action='store_true',
+                     help='Remove duplicate conformers before and after the optimization.')
+    run.add_argument('--adaptive-conformers', action='store_true',
+                     help='Choose the number of conformers from the flexibility of every molecule.')
+    run.add_argument('--qm-budget', type=float, default=None,
+                     help='QM budget of the campaign in core-hours, distributed over the molecules by flexibility.')
+    run.add_argument('--sequential', action='store_true',
+                     help='Optimize and fit the conformers one after the other until the charges converge.')
+    run.add_argument('--status-file', type=str, default=None,
+                     help='JSON file the progress of the QM jobs (jobs per stage, throughput, ETA) is written to.')
+    run.add_argument('--executor', type=str, default='local', help='local (process pool), thread or shared (task queue)')
+    run.add_argument('--queue', type=str, default=None, help='Task queue database of the shared executor.')
+    status = subparsers.add_parser('status', help='Show the state of a campaign.')
+    status.add_argument('--db', type=str, default='campaign.db', help='Job database.')
+    status.add_argument('--json', action='store_true', help='Write the progress as JSON.')
+    dry_run = subparsers.add_parser('plan', help='Estimate the jobs, core-hours and disk of a campaign.')
+    dry_run.add_argument('table', type=str, help='csv file with index, SMILES and property columns')
+    dry_run.add_argument('--workdir', type=str, default='.', help='Folder for the molecule folders.')
+    dry_run.add_argument('--charge-type', type=str, default='RESP2', help='RESP1 or RESP2')
+    dry_run.add_argument('--delta', type=float, default=1.0, help='Mixing parameter of the charges.')
+    dry_run.add_argument('--preset', type=str, default=None, help='Level of theory: production (default) or screening')
+    dry_run.add_argument('--json', action='store_true', help='Write the plan as JSON instead of a table.')
+    dry_run.add_argument('--output', type=str, default=None, help='File to write the plan to. default: stdout')
+    args = parser.parse_args(sys.argv[1:])
+    if args.command == 'run':
+        log.getLogger().setLevel(log.INFO)
+        executor = None
+        if args.executor != 'local':
+            executor = executors.get_executor(args.executor, max_workers=args.workers, queue=args.queue)
+        try:
+            run_campaign(table=args.table, db=os.path.abspath(args.db), workdir=os.path.abspath(args.workdir),
+                         nworkers=args.workers, charge_type=args.charge_type, delta=args.delta, timeout=args.timeout,
+                         executor=executor, preset=args.preset, preoptimize=args.preoptimize,
+                         deduplicate=args.deduplicate, adaptive=args.adaptive_conformers,
+                         qm_budget=args.qm_budget, sequential=args.sequential, status_file=args.status_file)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    elif args.command == 'status':
+        if args.json:
+            sys.stdout.write(json.dumps(campaign_progress(db=args.db), indent=1) + '\n')
+        else:
+            print_status(db=args.db)
+    elif args.command == 'plan':
+        planned = plan_campaign(table=args.table, workdir=args.workdir, charge_type=args.charge_type,
+                                delta=args.delta, preset=args.preset)
+        output = open(args.output, 'w') if args.output else sys.stdout
+        if args.json:
+            output.write(plan.to_json(planned) + '\n')
+        else:
+            plan.write_table(planned, output=output)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
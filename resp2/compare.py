@@ -0,0 +1,175 @@
+"""
+compare.py measures how close a level of theory preset comes to production and how much faster it is.
+
+The same molecules are calculated with every preset (see presets) in separate folders
+({workdir}/{preset}/{name}-*). For every charge model (type and delta) the charges of each preset are
+compared atom by atom with the reference preset: RMS and maximum absolute deviation in e, per molecule
+and over all atoms. The speed-up is the wall-clock time of the reference divided by the one of the
+preset for the whole batch.
+
+    python -m resp2.compare molecules.csv --preset screening --workdir compare --output report.json
+"""
+
+import argparse
+import json
+import logging as log
+import os
+import sys
+import time
+
+import numpy as np
+
+try:
+    import resp2.pipeline as pipeline
+    import resp2.presets as presets
+    import resp2.campaign as campaign
+except ModuleNotFoundError:
+    import pipeline
+    import presets
+    import campaign
+
+
+def run_preset(molecules, preset, workdir='.', **settings):
+    """
+    Calculates the charges of molecules with one preset.
+
+    :param molecules: List of molecule dictionaries (name, resname, smiles).
+    :param preset: Name of the preset.
+    :param workdir: The folders of the preset are created in {workdir}/{preset}.
+    :param settings: Further settings of pipeline.run_pipeline.
+    :return: Tuple of the molecule dictionaries returned by the pipeline and the wall-clock time in seconds.
+    """
+    folder = os.path.join(workdir, presets.get_preset(preset).name)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    # The folder names of the stages are derived from the name, a path prefix keeps them in folder
+    items = []
+    for molecule in molecules:
+        prefix = os.path.join(folder, molecule['name'])
+        items.append(dict(molecule, name=prefix, folder=prefix + '-liquid'))
+    t0 = time.time()
+    results = pipeline.run_pipeline(items, preset=preset, **settings)
+    elapsed = time.time() - t0
+    for molecule in results:
+        molecule['name'] = os.path.basename(molecule['name'])
+    return results, elapsed
+
+
+def _charges(results):
+    # molecule name -> (type, delta) -> charges
+    charges = {}
+    for molecule in results:
+        if molecule.get('error') is not None or not molecule.get('charges'):
+            continue
+        charges[molecule['name']] = {(model['type'], model['delta']): np.asarray(model['charges'], dtype=float)
+                                     for model in molecule['charges']}
+    return charges
+
+
+def charge_deviations(reference, results):
+    """
+    Compares the charges of two runs atom by atom. Molecules missing in one of them are skipped.
+
+    :param reference: Molecule dictionaries of the reference run (see run_preset).
+    :param results: Molecule dictionaries of the compared run.
+    :return: List of dictionaries with the keys type, delta, molecules, atoms, rms, max and per_molecule
+             (molecule name -> dictionary with rms and max) in e.
+    """
+    reference, results = _charges(reference), _charges(results)
+    models = {}
+    for name in sorted(set(reference) & set(results)):
+        for model in sorted(set(reference[name]) & set(results[name])):
+            if len(reference[name][model]) != len(results[name][model]):
+                log.warning('Different number of atoms of {} in the compared runs'.format(name))
+                continue
+            models.setdefault(model, {})[name] = results[name][model] - reference[name][model]
+    deviations = []
+    for (type, delta), differences in sorted(models.items()):
+        all_atoms = np.concatenate(list(differences.values()))
+        deviations.append(dict(type=type, delta=delta, molecules=len(differences), atoms=len(all_atoms),
+                               rms=float(np.sqrt(np.mean(all_atoms ** 2))), max=float(np.max(np.abs(all_atoms))),
+                               per_molecule={name: dict(rms=float(np.sqrt(np.mean(d ** 2))),
+                                                        max=float(np.max(np.abs(d))))
+                                             for name, d in differences.items()}))
+    return deviations
+
+
+def compare_presets(molecules, presets_to_compare=('screening',), reference='production', workdir='.',
+                    **settings):
+    """
+    Calculates the charges of the molecules with the reference and every other preset.
+
+    :param molecules: List of molecule dictionaries (name, resname, smiles).
+    :param presets_to_compare: Names of the presets compared with the reference.
+    :param reference: Name of the reference preset.
+    :param workdir: Folder the preset folders are created in.
+    :param settings: Further settings of pipeline.run_pipeline (e.g. charge_types, deltas, psi4_pool).
+    :return: Report dictionary with the keys reference, molecules and presets (list of dictionaries with the
+             keys preset, elapsed, speedup, failed and deviations, see charge_deviations).
+    """
+    reference_results, reference_elapsed = run_preset(molecules, reference, workdir=workdir, **settings)
+    report = dict(reference=dict(preset=reference, elapsed=reference_elapsed,
+                                 failed=sorted(m['name'] for m in reference_results if m.get('error') is not None)),
+                  molecules=len(molecules), presets=[])
+    for preset in presets_to_compare:
+        results, elapsed = run_preset(molecules, preset, workdir=workdir, **settings)
+        report['presets'].append(dict(preset=preset, elapsed=elapsed,
+                                      speedup=reference_elapsed / elapsed if elapsed > 0 else None,
+                                      failed=sorted(m['name'] for m in results if m.get('error') is not None),
+                                      deviations=charge_deviations(reference_results, results)))
+    return report
+
+
+def write_report(report, output=sys.stdout):
+    """
+    Prints the accuracy and speed-up of every preset as table.
+
+    :param report: Report of compare_presets.
+    :param output: File to write to.
+    :return: 0 if successful
+    """
+    output.write('Reference {}: {} molecules in {:.1f} s\n'.format(report['reference']['preset'],
+                                                                  report['molecules'],
+                                                                  report['reference']['elapsed']))
+    output.write('{:<12} {:<8} {:>6} {:>10} {:>6} {:>10} {:>10} {:>8}\n'.format(
+        'preset', 'type', 'delta', 'molecules', 'atoms', 'RMS [e]', 'max [e]', 'speed-up'))
+    for entry in report['presets']:
+        speedup = '{:.1f}x'.format(entry['speedup']) if entry['speedup'] else '-'
+        for deviation in entry['deviations']:
+            output.write('{:<12} {:<8} {:>6.2f} {:>10} {:>6} {:>10.4f} {:>10.4f} {:>8}\n'.format(
+                entry['preset'], deviation['type'], deviation['delta'], deviation['molecules'], deviation['atoms'],
+                deviation['rms'], deviation['max'], speedup))
+        if entry['failed']:
+            output.write('{}: {} molecules failed ({})\n'.format(entry['preset'], len(entry['failed']),
+                                                                ', '.join(entry['failed'])))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the charges and run times of level of theory presets.')
+    parser.add_argument('table', type=str, help='csv file with index, SMILES and property columns')
+    parser.add_argument('--workdir', type=str, default='.', help='Folder for the preset folders.')
+    parser.add_argument('--preset', type=str, action='append', default=None,
+                        help='Preset compared with the reference (repeatable). default: screening')
+    parser.add_argument('--reference', type=str, default='production', help='Reference preset.')
+    parser.add_argument('--charge-type', type=str, default='RESP2', help='RESP1 or RESP2')
+    parser.add_argument('--delta', type=float, action='append', default=None,
+                        help='Mixing parameter of the charges (repeatable). default: 0.6')
+    parser.add_argument('--timeout', type=float, default=None, help='Time limit of external programs in seconds.')
+    parser.add_argument('--output', type=str, default=None, help='JSON file the full report is written to.')
+    args = parser.parse_args()
+    log.getLogger().setLevel(log.INFO)
+    molecules = [dict(name='mol{:04d}'.format(molecule['index']), smiles=molecule['smiles'],
+                      resname=campaign.molecule_resname(molecule['index']))
+                 for molecule in campaign.read_smiles_table(args.table)]
+    report = compare_presets(molecules, presets_to_compare=args.preset or ['screening'], reference=args.reference,
+                             workdir=os.path.abspath(args.workdir), charge_types=[args.charge_type],
+                             deltas=args.delta or [0.6], timeout=args.timeout)
+    write_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,483 @@
+"""
+conformers.py prepares the omega conformers of a molecule for the QM optimization.
+
+- preoptimize_conformers relaxes every conformer with a force field (openbabel, MMFF94 by default),
+  ranks them by the force field energy and drops those outside an energy window which is tighter than
+  the 9 kcal/mol of omega. psi4 then starts closer to a minimum and optimizes fewer structures.
+- unique_conformers finds conformers which are the same structure: the RMSD of the heavy atoms and
+  polar hydrogens after optimal superposition (vectorized Kabsch over all pairs, minimized over the
+  symmetry permutations of the molecule) is below a threshold, and so is the energy difference if
+  energies are known. It is used on the omega conformers and again on the optimized structures,
+  where different starting conformers often end in the same minimum.
+- conformer_policy sets the number of conformers omega may generate and its RMS range from the
+  flexibility of the molecule (rotatable bonds and sp3 ring atoms, see flexibility), and
+  allocate_conformers distributes a QM budget of a batch over its molecules.
+- renumber_conformers keeps the files of the selected conformers and numbers them 1..n again, so that
+  all later stages see a consecutive range of conformers.
+
+The conformer files are {folder}/{resname}-conformers_{i}.mol2 (and .xyz, .in, .out once converted and
+optimized) and {folder}/{resname}-confermers_opt_{i}.xyz. Only the coordinates of the mol2 files are
+replaced, atom names and types stay those written by omega.
+"""
+
+import glob
+import logging as log
+import os
+
+import numpy as np
+
+try:
+    import resp2.esp as esp
+except ModuleNotFoundError:
+    import esp
+
+try:
+    import openbabel
+except ModuleNotFoundError:
+    print('Could not import openbabel')
+
+# Force field, energy window in kcal/mol and maximum number of steps of the pre-optimization
+PREOPT_FORCEFIELD = 'MMFF94'
+PREOPT_WINDOW = 5.0
+PREOPT_STEPS = 500
+
+# RMSD in Angstrom and energy difference in kcal/mol below which two conformers are the same
+DEDUP_RMSD = 0.25
+DEDUP_ENERGY = 0.2
+# Maximum number of symmetry permutations tried in the RMSD
+MAX_PERMUTATIONS = 64
+
+# Upper limit of the adaptive number of conformers and the omega RMS range (start and increment in Angstrom)
+MAX_ADAPTIVE_CONFORMERS = 10
+RMS_START = 0.5
+RMS_INCREMENT = 0.5
+RMS_STEPS = 7
+
+# kcal/mol per Hartree
+HARTREE = 627.5095
+
+# Prefixes of the files of conformer i, all files starting with them are renumbered
+CONFORMER_FILES = ('{resname}-conformers_{i}.', '{resname}-confermers_opt_{i}.')
+
+
+def conformer_file(folder, resname, i, extension='.mol2'):
+    """
+    :return: Path of the file of conformer i.
+    """
+    return os.path.join(folder, '{}-conformers_{}{}'.format(resname, i, extension))
+
+
+def read_mol2_coordinates(filename):
+    """
+    :param filename: Path to a mol2 file.
+    :return: List of element symbols (from the atom types) and coordinates (n x 3 array) in Angstrom.
+    """
+    elements, coordinates = [], []
+    section = None
+    for line in open(filename):
+        if line.startswith('@<TRIPOS>'):
+            section = line.strip()
+        elif section == '@<TRIPOS>ATOM' and line.split():
+            entry = line.split()
+            elements.append(entry[5].split('.')[0])
+            coordinates.append([float(x) for x in entry[2:5]])
+    return elements, np.array(coordinates)
+
+
+def replace_mol2_coordinates(lines, coordinates):
+    """
+    :param lines: Lines of a mol2 file.
+    :param coordinates: List of (x, y, z) in the order of the atoms.
+    :return: Lines with the new coordinates in the ATOM section.
+    """
+    new_lines = []
+    section = None
+    k = 0
+    for line in lines:
+        if line.startswith('@<TRIPOS>'):
+            section = line.strip()
+        elif section == '@<TRIPOS>ATOM' and line.split():
+            entry = line.split()
+            x, y, z = coordinates[k]
+            k += 1
+            line = '{:>7} {:<8} {:>10.4f} {:>10.4f} {:>10.4f} {}\n'.format(entry[0], entry[1], x, y, z,
+                                                                            ' '.join(entry[5:]))
+        new_lines.append(line)
+    return new_lines
+
+
+def read_mol2_graph(filename):
+    """
+    :param filename: Path to a mol2 file.
+    :return: List of atom types and list of bonds (index a, index b, bond type), indices starting at 0.
+    """
+    types, bonds = [], []
+    section = None
+    for line in open(filename):
+        if line.startswith('@<TRIPOS>'):
+            section = line.strip()
+        elif section == '@<TRIPOS>ATOM' and line.split():
+            types.append(line.split()[5])
+        elif section == '@<TRIPOS>BOND' and len(line.split()) >= 4:
+            entry = line.split()
+            bonds.append((int(entry[1]) - 1, int(entry[2]) - 1, entry[3]))
+    return types, bonds
+
+
+def _connected(neighbors, a, b, removed):
+    # True if a and b are connected without the bond removed
+    seen, todo = {a}, [a]
+    while todo:
+        c = todo.pop()
+        for d in neighbors[c]:
+            if {c, d} == set(removed) or d in seen:
+                continue
+            if d == b:
+                return True
+            seen.add(d)
+            todo.append(d)
+    return False
+
+
+def flexibility(filename):
+    """
+    Counts the degrees of freedom which give distinct conformers.
+
+    Rotatable bonds are single bonds outside rings between atoms with at least two heavy neighbors each.
+    Hydroxyl and thiol groups count as rotor if the heavy atom they are bonded to has another heavy
+    neighbor (their orientation changes the ESP, except next to a methyl group).
+
+    :param filename: Path to a mol2 file with bonds.
+    :return: Dictionary with the number of rotors and of sp3 atoms in rings (ring_atoms).
+    """
+    types, bonds = read_mol2_graph(filename)
+    elements = [t.split('.')[0] for t in types]
+    neighbors = [[] for _ in types]
+    for a, b, _ in bonds:
+        neighbors[a].append(b)
+        neighbors[b].append(a)
+    heavy = [[c for c in neighbors[a] if elements[c] != 'H'] for a in range(len(types))]
+    ring_atoms = set()
+    rotors = 0
+    for a, b, order in bonds:
+        in_ring = _connected(neighbors, a, b, (a, b))
+        if in_ring:
+            ring_atoms.update([a, b])
+        elif order == '1' and 'H' not in (elements[a], elements[b]):
+            if len(heavy[a]) >= 2 and len(heavy[b]) >= 2:
+                rotors += 1
+            else:
+                for x, y in [(a, b), (b, a)]:
+                    if types[x] in ('O.3', 'S.3') and len(heavy[x]) == 1 and len(heavy[y]) >= 2 and \
+                            len(neighbors[x]) == 2:
+                        rotors += 1
+    return dict(rotors=rotors, ring_atoms=len([a for a in ring_atoms if types[a].endswith('.3')]))
+
+
+def conformer_policy(rotors=0, ring_atoms=0, max_conformers=MAX_ADAPTIVE_CONFORMERS):
+    """
+    :param rotors: Number of rotatable bonds (see flexibility).
+    :param ring_atoms: Number of sp3 ring atoms.
+    :param max_conformers: Upper limit of the number of conformers.
+    :return: Maximum number of conformers and the RMS range of omega in Angstrom. Rigid molecules get a
+             single conformer, every rotor and every three sp3 ring atoms one more. Beyond three rotors the
+             RMS range starts higher, so that the conformers spread over the larger conformational space.
+    """
+    number = max(1, min(max_conformers, 1 + rotors + ring_atoms // 3))
+    start = min(RMS_START + 0.25 * max(rotors - 3, 0), 2.0)
+    return number, [start + RMS_INCREMENT * k for k in range(RMS_STEPS)]
+
+
+def allocate_conformers(wanted, costs, budget=None):
+    """
+    Distributes a QM budget over the molecules of a batch. Every molecule gets one conformer, then
+    conformers are added one by one to the molecule with the smallest fraction of its wanted number, as
+    long as the budget allows.
+
+    :param wanted: List of the wanted numbers of conformers (see conformer_policy).
+    :param costs: List of the costs of one conformer of every molecule.
+    :param budget: Total cost of the batch in the units of costs. default=None (no limit)
+    :return: List of the numbers of conformers.
+    """
+    if budget is None:
+        return list(wanted)
+    counts = [1] * len(wanted)
+    spent = sum(costs)
+    if spent > budget:
+        log.warning('The budget is too small for one conformer per molecule ({:.1f} > {:.1f})'.format(spent, budget))
+    while True:
+        candidates = [k for k in range(len(wanted)) if counts[k] < wanted[k] and spent + costs[k] <= budget]
+        if not candidates:
+            return counts
+        k = min(candidates, key=lambda k: (counts[k] / float(wanted[k]), costs[k]))
+        counts[k] += 1
+        spent += costs[k]
+
+
+def select_conformers(energies, window=PREOPT_WINDOW):
+    """
+    :param energies: List of energies of the conformers in kcal/mol (None for failed ones).
+    :param window: Energy window in kcal/mol above the lowest energy.
+    :return: Indices of the conformers within the window, lowest energy first.
+    """
+    ranked = sorted((e, k) for k, e in enumerate(energies) if e is not None)
+    if not ranked:
+        return []
+    return [k for e, k in ranked if e - ranked[0][0] <= window]
+
+
+def renumber_conformers(folder, resname, order, number_of_conformers, prefixes=CONFORMER_FILES):
+    """
+    Renames the conformer files, so that conformer order[k] becomes conformer k + 1. Files of conformers
+    not in order are removed.
+
+    :param folder: Folder of the conformer files.
+    :param resname: Abbreviation of the Residue.
+    :param order: List of the old conformer numbers (starting at 1) to keep, in their new order.
+    :param number_of_conformers: Old number of conformers.
+    :param prefixes: File name prefixes of the files of a conformer (see CONFORMER_FILES).
+    :return: New number of conformers.
+    """
+    order = list(order)
+    if order == list(range(1, number_of_conformers + 1)):
+        return number_of_conformers
+    # Two steps, because the old and new numbers overlap
+    moves = []
+    for prefix in prefixes:
+        for i in range(1, number_of_conformers + 1):
+            old = os.path.join(folder, prefix.format(resname=resname, i=i))
+            for path in glob.glob(glob.escape(old) + '*'):
+                if i in order:
+                    new = os.path.join(folder, prefix.format(resname=resname, i=order.index(i) + 1))
+                    os.replace(path, path + '.renumber')
+                    moves.append((path + '.renumber', new + path[len(old):]))
+                else:
+                    os.remove(path)
+    for path, new in moves:
+        os.replace(path, new)
+    if order != list(range(1, len(order) + 1)):
+        log.info('Renumbered the conformers of {} in {}: {}'.format(resname, folder, list(order)))
+    return len(order)
+
+
+def symmetry_permutations(elements, bonds, max_permutations=MAX_PERMUTATIONS):
+    """
+    Finds the permutations of the atoms which keep the elements and the bonds (graph automorphisms).
+
+    :param elements: List of element symbols (or other atom labels).
+    :param bonds: Boolean bond matrix (see esp.bond_matrix).
+    :param max_permutations: The search stops after this many permutations.
+    :return: List of permutations (arrays of atom indices), the identity first.
+    """
+    n = len(elements)
+    bonds = np.asarray(bonds, dtype=bool)
+    neighbors = [list(np.flatnonzero(bonds[a])) for a in range(n)]
+    # Atoms can only be mapped onto atoms of the same class, refined from the element by the neighbors
+    classes = [elements[a] for a in range(n)]
+    for _ in range(n):
+        labels = [(classes[a], tuple(sorted(str(classes[b]) for b in neighbors[a]))) for a in range(n)]
+        names = {label: k for k, label in enumerate(sorted(set(labels), key=str))}
+        refined = [names[label] for label in labels]
+        if len(set(refined)) == len(set(classes)):
+            classes = refined
+            break
+        classes = refined
+    permutations = []
+    mapping = [-1] * n
+    used = [False] * n
+
+    def extend(a):
+        if len(permutations) >= max_permutations:
+            return
+        if a == n:
+            permutations.append(np.array(mapping))
+            return
+        for b in range(n):
+            if used[b] or classes[b] != classes[a]:
+                continue
+            if any(bonds[a, c] != bonds[b, mapping[c]] for c in range(a)):
+                continue
+            mapping[a], used[b] = b, True
+            extend(a + 1)
+            mapping[a], used[b] = -1, False
+
+    extend(0)
+    return permutations
+
+
+def rmsd_matrix(coordinates, permutations=None):
+    """
+    RMSD of all pairs of conformers after optimal superposition. The rotations of all pairs are found at
+    once from the singular values of the correlation matrices (Kabsch), without building them.
+
+    :param coordinates: Array (conformers x atoms x 3) in Angstrom.
+    :param permutations: Symmetry permutations of the atoms (see symmetry_permutations). The smallest RMSD
+                         over all permutations is used. default=None (identity only)
+    :return: Symmetric matrix (conformers x conformers) of RMSDs in Angstrom.
+    """
+    X = np.asarray(coordinates, dtype=float)
+    X = X - X.mean(axis=1, keepdims=True)
+    norms = np.sum(X ** 2, axis=(1, 2))
+    n = X.shape[1]
+    best = None
+    for permutation in permutations or [np.arange(n)]:
+        H = np.einsum('iak,jal->ijkl', X, X[:, permutation, :])
+        s = np.linalg.svd(H, compute_uv=False)
+        # A reflection is not a rotation, the smallest singular value is counted negative then
+        s[..., -1] *= np.sign(np.linalg.det(H))
+        msd = (norms[:, None] + norms[None, :] - 2.0 * s.sum(axis=-1)) / n
+        rmsd = np.sqrt(np.clip(msd, 0.0, None))
+        best = rmsd if best is None else np.minimum(best, rmsd)
+    return np.minimum(best, best.T)
+
+
+def unique_conformers(structures, energies=None, rmsd_threshold=DEDUP_RMSD, energy_threshold=DEDUP_ENERGY):
+    """
+    Finds the distinct conformers. A conformer is a duplicate of a kept one if the RMSD of the heavy atoms
+    and polar hydrogens is below rmsd_threshold and, if both energies are known, their difference is below
+    energy_threshold. Conformers are considered lowest energy first, so the lowest of the duplicates is kept.
+
+    :param structures: List of (elements, coordinates) of the conformers, None for missing ones.
+    :param energies: List of energies in kcal/mol (or None for unknown ones). default=None
+    :param rmsd_threshold: RMSD in Angstrom.
+    :param energy_threshold: Energy difference in kcal/mol.
+    :return: Indices of the distinct conformers in their original order.
+    """
+    present = [k for k, structure in enumerate(structures) if structure is not None]
+    if not present:
+        return []
+    energies = list(energies) if energies is not None else [None] * len(structures)
+    elements, reference = structures[present[0]]
+    bonds = esp.bond_matrix(elements, reference)
+    # Hydrogens on carbon are left out, those on heteroatoms change the ESP
+    atoms = [a for a, element in enumerate(elements)
+             if element != 'H' or not any(elements[b] == 'C' for b in np.flatnonzero(bonds[a]))]
+    # Atoms are only exchanged with atoms of the same element and number of hydrogens
+    labels = ['{}{}'.format(elements[a], sum(elements[b] == 'H' for b in np.flatnonzero(bonds[a]))) for a in atoms]
+    permutations = symmetry_permutations(labels, bonds[np.ix_(atoms, atoms)])
+    rmsd = rmsd_matrix(np.array([structures[k][1][atoms] for k in present]), permutations)
+    ranked = sorted(range(len(present)), key=lambda m: (energies[present[m]] is None, energies[present[m]] or 0.0, m))
+    kept = []
+    for m in ranked:
+        e = energies[present[m]]
+        duplicate = [j for j in kept if rmsd[m, j] < rmsd_threshold and
+                     (e is None or energies[present[j]] is None or abs(e - energies[present[j]]) < energy_threshold)]
+        if duplicate:
+            log.info('Conformer {} is a duplicate of conformer {} (RMSD {:.3f} A)'.format(
+                present[m] + 1, present[duplicate[0]] + 1, rmsd[m, duplicate[0]]))
+        else:
+            kept.append(m)
+    return sorted(present[m] for m in kept)
+
+
+def deduplicate_conformers(folder='', resname='MOL', number_of_conformers=1, energies=None,
+                           rmsd_threshold=DEDUP_RMSD, energy_threshold=DEDUP_ENERGY):
+    """
+    Removes duplicate omega conformers (see unique_conformers) and renumbers the remaining ones.
+
+    :param folder: Folder of the conformer files.
+    :param resname: Abbreviation of the Residue. Specified in the mol2
+    :param number_of_conformers: Number of conformers.
+    :param energies: List of energies of the conformers in kcal/mol. default=None (RMSD only)
+    :param rmsd_threshold: RMSD in Angstrom.
+    :param energy_threshold: Energy difference in kcal/mol.
+    :return: Number of remaining conformers.
+    """
+    structures = [read_mol2_coordinates(conformer_file(folder, resname, i))
+                  for i in range(1, number_of_conformers + 1)]
+    order = [k + 1 for k in unique_conformers(structures, energies, rmsd_threshold, energy_threshold)]
+    log.info('{} of {} conformers of {} are distinct'.format(len(order), number_of_conformers, resname))
+    return renumber_conformers(folder, resname, order, number_of_conformers)
+
+
+def _force_field(filename, forcefield):
+    """
+    :return: openbabel molecule of a mol2 file and the force field set up for it (None if that failed).
+    """
+    conversion = openbabel.OBConversion()
+    conversion.SetInFormat('mol2')
+    mol = openbabel.OBMol()
+    conversion.ReadFile(mol, filename)
+    ff = openbabel.OBForceField.FindForceField(forcefield)
+    if ff is None or not ff.Setup(mol):
+        log.warning('Could not set up {} for {}'.format(forcefield, filename))
+        return mol, None
+    return mol, ff
+
+
+def _energy(ff):
+    # kJ/mol for GAFF and Ghemical, kcal/mol for MMFF94 and UFF
+    energy = ff.Energy()
+    if ff.GetUnit().startswith('kJ'):
+        energy /= 4.184
+    return energy
+
+
+def force_field_energies(folder='', resname='MOL', number_of_conformers=1, forcefield=PREOPT_FORCEFIELD):
+    """
+    Force field energies of the conformers at their current coordinates, without minimization.
+
+    :param folder: Folder of the conformer files.
+    :param resname: Abbreviation of the Residue. Specified in the mol2
+    :param number_of_conformers: Number of conformers.
+    :param forcefield: Name of the openbabel force field.
+    :return: List of energies in kcal/mol, None for conformers the force field could not be set up for.
+    """
+    energies = []
+    for i in range(1, number_of_conformers + 1):
+        mol, ff = _force_field(conformer_file(folder, resname, i), forcefield)
+        energies.append(_energy(ff) if ff is not None else None)
+    return energies
+
+
+def relax_mol2(filename, forcefield=PREOPT_FORCEFIELD, steps=PREOPT_STEPS):
+    """
+    Minimizes a conformer with an openbabel force field and writes the new coordinates to its mol2 file.
+
+    :param filename: Path to the mol2 file.
+    :param forcefield: Name of the openbabel force field.
+    :param steps: Maximum number of conjugate gradient steps.
+    :return: Energy in kcal/mol, or None if the force field could not be set up.
+    """
+    mol, ff = _force_field(filename, forcefield)
+    if ff is None:
+        return None
+    ff.ConjugateGradients(steps)
+    ff.GetCoordinates(mol)
+    energy = _energy(ff)
+    coordinates = [(atom.GetX(), atom.GetY(), atom.GetZ()) for atom in openbabel.OBMolAtomIter(mol)]
+    lines = replace_mol2_coordinates(open(filename).readlines(), coordinates)
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+    return energy
+
+
+def preoptimize_conformers(resname='MOL', number_of_conformers=1, folder='', forcefield=PREOPT_FORCEFIELD,
+                           window=PREOPT_WINDOW, steps=PREOPT_STEPS, deduplicate=False):
+    """
+    Relaxes the omega conformers with a force field, ranks them by energy and keeps those within window.
+    Conformers which relaxed into the same structure are removed if deduplicate is set.
+
+    :param resname: Abbreviation of the Residue. Specified in the mol2
+    :param number_of_conformers: Number of conformers created by omega.
+    :param folder: Folder of the conformer files.
+    :param forcefield: Name of the openbabel force field.
+    :param window: Energy window in kcal/mol above the lowest conformer.
+    :param steps: Maximum number of minimization steps.
+    :param deduplicate: Remove duplicates with the force field energies (see deduplicate_conformers).
+    :return: Number of remaining conformers.
+    """
+    energies = [relax_mol2(conformer_file(folder, resname, i), forcefield=forcefield, steps=steps)
+                for i in range(1, number_of_conformers + 1)]
+    if all(energy is None for energy in energies):
+        log.warning('Pre-optimization of {} failed, keeping the omega conformers'.format(resname))
+        return number_of_conformers
+    order = [k + 1 for k in select_conformers(energies, window)]
+    log.info('{} of {} conformers of {} are within {} kcal/mol after the {} pre-optimization'.format(
+        len(order), number_of_conformers, resname, window, forcefield))
+    number_of_conformers = renumber_conformers(folder, resname, order, number_of_conformers)
+    if deduplicate:
+        number_of_conformers = deduplicate_conformers(folder=folder, resname=resname,
+                                                      number_of_conformers=number_of_conformers,
+                                                      energies=[energies[i - 1] for i in order])
+    return number_of_conformers
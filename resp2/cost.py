@@ -0,0 +1,308 @@
+"""
+cost.py estimates how expensive a QM job is.
+
+The cost of a job is estimated in core-seconds from the number of basis functions of the molecule at
+the requested level of theory, whether PCM is used, and whether the job is a single point or an
+optimization. The prefactors of the model are calibrated from the timings of finished jobs, which
+are appended to a JSON lines file (RESP2_TIMINGS or ~/.resp2/timings.jsonl).
+
+The estimates are used to start the most expensive jobs first (longest job first), which keeps
+one large molecule started last from setting the makespan of a whole campaign.
+"""
+
+import json
+import logging as log
+import math
+import os
+import re
+
+# Levels of theory of the ESP calculations: type -> (method, basis, pcm)
+ESP_LEVELS = {'RESP1': ('HF', '6-31G*', False),
+              'RESP2GAS': ('PW6B95', 'aug-cc-pV(D+d)Z', False),
+              'RESP2LIQUID': ('PW6B95', 'aug-cc-pV(D+d)Z', True)}
+
+# Levels of theory of the three step optimization in optimize_conformers
+OPTIMIZATION_LADDER = [('HF', '6-31G*'), ('HF', 'cc-pV(D+d)Z'), ('PW6B95', 'cc-pV(D+d)Z')]
+
+# Number of basis functions per atom: basis -> (H/He, Li-Ne, Na-Ar, heavier elements)
+# 6-31G* uses cartesian d functions in psi4, the Dunning basis sets spherical ones.
+BASIS_FUNCTIONS = {'6-31G*': (2, 15, 19, 29),
+                   'cc-pV(D+d)Z': (5, 14, 23, 32),
+                   'jun-cc-pV(D+d)Z': (5, 18, 27, 36),
+                   'aug-cc-pV(D+d)Z': (9, 23, 32, 41)}
+
+ELEMENTS = ['H', 'He', 'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne', 'Na', 'Mg', 'Al', 'Si', 'P', 'S', 'Cl', 'Ar']
+
+# Cost of a HF/6-31G* single point with 100 basis functions in core-seconds
+_REFERENCE_COST = 5.0
+_REFERENCE_NBF = 100.0
+_METHOD_FACTORS = {'HF': 1.0, 'PW6B95': 2.5}
+_PCM_FACTOR = 1.4
+_DIFFUSE_FACTOR = 1.5
+
+
+def _row(element):
+    element = element.capitalize()
+    if element not in ELEMENTS:
+        return 3
+    index = ELEMENTS.index(element)
+    return 0 if index < 2 else 1 if index < 10 else 2
+
+
+def count_basis_functions(elements, basis):
+    """
+    Estimates the number of basis functions of a molecule.
+
+    :param elements: List of element symbols.
+    :param basis: Name of the basis set.
+    :return: Number of basis functions.
+    """
+    per_row = BASIS_FUNCTIONS.get(basis, BASIS_FUNCTIONS['cc-pV(D+d)Z'])
+    return sum(per_row[_row(element)] for element in elements)
+
+
+def estimate_scratch(elements, basis):
+    """
+    Estimates the scratch disk of a density fitted psi4 job, which is dominated by the three-index
+    integrals (nbf^2 x naux doubles with about three auxiliary functions per basis function).
+
+    :param elements: List of element symbols.
+    :param basis: Name of the basis set.
+    :return: Scratch disk in GB.
+    """
+    nbf = count_basis_functions(elements, basis)
+    return 24.0 * nbf ** 3 / 1024 ** 3
+
+
+def optimization_steps(natoms):
+    """
+    :param natoms: Number of atoms.
+    :return: Expected number of gradient evaluations of a geometry optimization.
+    """
+    return 8 + 0.5 * natoms
+
+
+def read_elements(filename):
+    """
+    Reads the element symbols of a xyz or mol2 file.
+
+    :param filename: Path to the file.
+    :return: List of element symbols.
+    """
+    lines = open(filename).readlines()
+    if filename.endswith('.mol2'):
+        elements = []
+        v = 0
+        for line in lines:
+            if '@<TRIPOS>ATOM' in line:
+                v = 1
+            elif line.startswith('@<TRIPOS>'):
+                v = 2
+            elif v == 1 and line.split():
+                elements.append(line.split()[5].split('.')[0])
+        return elements
+    return [line.split()[0] for line in lines[2:] if line.split()]
+
+
+def elements_from_smiles(smiles):
+    """
+    Rough element list of a molecule from its SMILES string, used to rank molecules before any
+    structure exists. Implicit hydrogens are not resolved; one hydrogen per heavy atom is assumed.
+
+    :param smiles: SMILES Code of the molecule.
+    :return: List of element symbols.
+    """
+    heavy = []
+    for match in re.finditer(r'\[([A-Z][a-z]?|[a-z]{1,2})[^\]]*\]|Cl|Br|[BCNOFPSI]|[bcnops]', smiles):
+        symbol = match.group(1) if match.group(1) is not None else match.group(0)
+        if symbol.upper() != 'H':
+            heavy.append(symbol.capitalize())
+    return heavy + ['H'] * len(heavy)
+
+
+def timings_file():
+    """
+    :return: Path of the file the job timings are recorded in.
+    """
+    return os.environ.get('RESP2_TIMINGS', os.path.join(os.path.expanduser('~'), '.resp2', 'timings.jsonl'))
+
+
+def record_timing(method, basis, pcm, jobtype, elements, elapsed, threads=1, path=None):
+    """
+    Appends the timing of a finished job to the timings file.
+
+    :param method: QM method ('ladder' for a multi step optimization)
+    :param basis: Basis set (see ladder_name for multi step optimizations)
+    :param pcm: True if PCM was used
+    :param jobtype: 'sp' or 'opt'
+    :param elements: List of element symbols of the molecule
+    :param elapsed: Wall-clock time of the job in seconds
+    :param threads: Number of threads the job used
+    :param path: Timings file. default: timings_file()
+    :return: 0 if successful
+    """
+    if path is None:
+        path = timings_file()
+    try:
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'a') as f:
+            f.write(json.dumps(dict(method=method, basis=basis, pcm=bool(pcm), jobtype=jobtype,
+                                    elements=list(elements), elapsed=elapsed, threads=threads)) + '\n')
+    except OSError as e:
+        log.warning('Could not record timing in {}: {}'.format(path, e))
+    return 0
+
+
+def load_timings(path=None):
+    """
+    :param path: Timings file. default: timings_file()
+    :return: List of timing records (dictionaries).
+    """
+    if path is None:
+        path = timings_file()
+    if not os.path.isfile(path):
+        return []
+    records = []
+    for line in open(path):
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            log.warning('Skip corrupt line in {}'.format(path))
+    return records
+
+
+def ladder_name(ladder=None):
+    """
+    :param ladder: List of (method, basis) optimization steps. default: OPTIMIZATION_LADDER
+    :return: Name under which timings of the whole multi step optimization are recorded.
+    """
+    if ladder is None:
+        ladder = OPTIMIZATION_LADDER
+    return ';'.join('{}/{}'.format(method, basis) for method, basis in ladder)
+
+
+def hessian_step(ladder, hessian=True):
+    """
+    :param ladder: List of (method, basis) optimization steps.
+    :param hessian: True if the preset computes the HF Hessian (see presets.Preset).
+    :return: (method, basis) of the HF Hessian after the first step, None if there is none.
+    """
+    if hessian and len(ladder) > 1 and ladder[0][0] == 'HF':
+        return tuple(ladder[0])
+    return None
+
+
+class CostModel(object):
+    """
+    Estimates the cost of QM jobs in core-seconds.
+
+    The default model is prefactor * nbf^exponent (times the number of steps for optimizations), with
+    prefactors depending on the method, diffuse functions and PCM. Calibration determines a correction
+    factor per level of theory; levels without timings are corrected with the average factor.
+
+    :param exponent: Scaling exponent with respect to the number of basis functions.
+    """
+
+    def __init__(self, exponent=3.0):
+        self.exponent = exponent
+        # (method, basis, pcm, jobtype) -> correction factor of the default model
+        self.corrections = {}
+        self.speed = 1.0
+
+    def _default_estimate(self, elements, method, basis, pcm, jobtype):
+        if method == 'ladder':
+            return sum(self._default_estimate(elements, *step.split('/', 1), pcm=pcm, jobtype=jobtype)
+                       for step in basis.split(';'))
+        cost = _REFERENCE_COST * (count_basis_functions(elements, basis) / _REFERENCE_NBF) ** self.exponent
+        cost *= _METHOD_FACTORS.get(method, 2.0)
+        if basis.startswith('aug'):
+            cost *= _DIFFUSE_FACTOR
+        if pcm:
+            cost *= _PCM_FACTOR
+        if jobtype == 'opt':
+            # A gradient costs about twice the energy
+            cost *= 2.0 * optimization_steps(len(elements))
+        elif jobtype == 'hessian':
+            # The analytic Hessian solves coupled perturbed equations for every nuclear displacement
+            cost *= 2.0 * len(elements)
+        return cost
+
+    def estimate(self, elements, method, basis, pcm=False, jobtype='sp'):
+        """
+        :param elements: List of element symbols.
+        :param method: QM method ('ladder' for a multi step optimization, see ladder_name)
+        :param basis: Basis set
+        :param pcm: True if PCM is used
+        :param jobtype: 'sp' (single point), 'opt' (optimization) or 'hessian'
+        :return: Estimated cost in core-seconds.
+        """
+        key = (method, basis, bool(pcm), jobtype)
+        return self._default_estimate(elements, *key) * self.corrections.get(key, self.speed)
+
+    def estimate_optimization(self, elements, ladder=None, hessian=False):
+        """
+        :param elements: List of element symbols.
+        :param ladder: List of (method, basis) optimization steps. default: OPTIMIZATION_LADDER
+        :param hessian: True if an HF Hessian follows an HF first step (see presets.Preset).
+        :return: Estimated cost of the multi step optimization in core-seconds.
+        """
+        if ladder is None:
+            ladder = OPTIMIZATION_LADDER
+        total = self.estimate(elements, 'ladder', ladder_name(ladder), jobtype='opt')
+        step = hessian_step(ladder, hessian)
+        if step is not None:
+            total += self.estimate(elements, *step, jobtype='hessian')
+        return total
+
+    def estimate_esp(self, elements, type='RESP1', levels=None):
+        """
+        :param elements: List of element symbols.
+        :param type: RESP1, RESP2GAS or RESP2LIQUID
+        :param levels: Dictionary type -> (method, basis, pcm). default: ESP_LEVELS
+        :return: Estimated cost of the ESP single point of one conformer in core-seconds.
+        """
+        method, basis, pcm = (levels or ESP_LEVELS)[type]
+        return self.estimate(elements, method, basis, pcm=pcm, jobtype='sp')
+
+    def calibrate(self, records):
+        """
+        Fits the correction factors to recorded timings.
+
+        :param records: List of timing records (see record_timing).
+        :return: self
+        """
+        ratios = {}
+        for record in records:
+            if record.get('elapsed', 0) <= 0:
+                continue
+            key = (record['method'], record['basis'], bool(record['pcm']), record['jobtype'])
+            core_seconds = record['elapsed'] * record.get('threads', 1)
+            ratios.setdefault(key, []).append(math.log(core_seconds / self._default_estimate(record['elements'], *key)))
+        for key, values in ratios.items():
+            # Geometric mean is robust against single slow jobs
+            self.corrections[key] = math.exp(sum(values) / len(values))
+        if ratios:
+            self.speed = math.exp(sum(math.log(value) for value in self.corrections.values()) / len(self.corrections))
+        return self
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        :param path: Timings file. default: timings_file()
+        :return: CostModel calibrated with all recorded timings.
+        """
+        return cls().calibrate(load_timings(path))
+
+
+_cost_model = None
+
+
+def get_cost_model():
+    """
+    :return: CostModel calibrated with the recorded timings. Loaded once per process.
+    """
+    global _cost_model
+    if _cost_model is None:
+        _cost_model = CostModel.load()
+    return _cost_model
@@ -18,9 +18,13 @@ try:
     import openmoltools
 except ModuleNotFoundError:
     print('Could not import openmoltools')
-import os, sys, time, argparse, subprocess
+import os, sys, time, argparse
 import shutil
 import logging as log
+try:
+    import resp2.jobs as jobs
+except ModuleNotFoundError:
+    import jobs
 
 def CalculateMolecularWeight(mol):
     """
@@ -69,7 +73,7 @@ def CalculateBoxSize(nmol, molwt, density):
     length = volume**(1./3)/1e-9
     return length
 
-def GenerateBox(pdbin, pdbout, box, nmol, tries):
+def GenerateBox(pdbin, pdbout, box, nmol, tries, timeout=None, workdir=None):
     """
     Call genbox. (Confirmed working with Gromacs version 4.6.7 and 5.1.4).
     Mainly checks whether genbox ran correctly.
@@ -86,6 +90,11 @@ def GenerateBox(pdbin, pdbout, box, nmol, tries):
         Number of molecules to go into the solvent box
     tries : int
         Parameter for genbox to try inserting each molecule (tries) times
+    timeout : float
+        Wall-clock limit for genbox in seconds. None means no limit.
+    workdir : str
+        Folder for the intermediate files (genbox.pdb, genbox.out, genbox.err).
+        Defaults to the folder of pdbout. The current directory is never used implicitly.
 
     Returns
     -------
@@ -93,25 +102,28 @@ def GenerateBox(pdbin, pdbout, box, nmol, tries):
         If successful, produces "pdbout" containing solvent box.
     """
     if which('gmx'):
-        gmxcmd='gmx insert-molecules'
+        gmxcmd=['gmx', 'insert-molecules']
     elif which('genbox'):
-        gmxcmd='genbox'
+        gmxcmd=['genbox']
     else:
         raise RuntimeError('gmx and/or genbox not in PATH. Please source Gromacs environment variables.')
 
-    fout=open('genbox.out', 'w')
-    ferr=open('genbox.err', 'w')
-    p = subprocess.Popen('%s -ci %s -o genbox.pdb -box %.3f %.3f %.3f -nmol %i -try %i'
-                         % (gmxcmd, pdbin, box, box, box, nmol, tries),
-                         shell=True, stdout=fout, stderr=ferr)
-    fout.close()
-    ferr.close()
-    t0 = time.time()
-    log.info("Running %s to create a solvent box..." % gmxcmd)
-    stdout, stderr = p.communicate()
-    log.info("Time elapsed: % .3f seconds" % (time.time() - t0))
+    if workdir is None:
+        workdir = os.path.dirname(os.path.abspath(pdbout))
+    genbox_pdb = os.path.join(workdir, 'genbox.pdb')
+    genbox_err = os.path.join(workdir, 'genbox.err')
+    log.info("Running %s to create a solvent box..." % ' '.join(gmxcmd))
+    # Disable Gromacs backup file creation
+    result = jobs.run_job(jobs.Job(gmxcmd + ['-ci', os.path.abspath(pdbin), '-o', os.path.abspath(genbox_pdb),
+                                            '-box', '%.3f' % box, '%.3f' % box, '%.3f' % box, '-nmol', nmol,
+                                            '-try', tries],
+                                   cwd=workdir, stdout=os.path.join(workdir, 'genbox.out'), stderr=genbox_err,
+                                   env=dict(os.environ, GMX_MAXBACKUP='-1'), timeout=timeout, name='genbox'))
+    log.info("Time elapsed: % .3f seconds" % result.elapsed)
+    if result.timed_out:
+        raise RuntimeError('genbox exceeded its time limit of %s seconds' % timeout)
     nmol_out = 0
-    for line in open('genbox.err').readlines():
+    for line in open(genbox_err).readlines():
         if 'Output configuration contains' in line:
             nmol_out = int(line.split()[-2])
     if nmol_out == 0:
@@ -122,7 +134,7 @@ def GenerateBox(pdbin, pdbout, box, nmol, tries):
     else:
         # genbox throws away the CONECT records in the PDB, this operation adds them back.
         M1 = Molecule(pdbin, build_topology=False)
-        M = Molecule('genbox.pdb', build_topology=False)
+        M = Molecule(genbox_pdb, build_topology=False)
         solventbox_bonds = []
         # Loop over the number of molecules in the solvent box
         for i in range(nmol):
@@ -139,10 +151,9 @@ def run_create_mol2_pdb(**kwargs):
     resname = kwargs['resname']
     density = kwargs['density']
     tries = kwargs['tries']
+    timeout = kwargs.get('timeout')
     output_folder=os.path.dirname(input_txt)
     log.debug('The output folder is: '+output_folder)
-    # Disable Gromacs backup file creation
-    os.environ['GMX_MAXBACKUP']="-1"
 
     smiles_string = open(input_txt).readlines()[0].strip()
     log.info("The following SMILES string will be converted: %s" % smiles_string)
@@ -184,9 +195,9 @@ def run_create_mol2_pdb(**kwargs):
     fullresname = os.path.join(output_folder,resname)
 
     try:
-        GenerateBox('%sS.pdb' % fullresname, '%s-box.pdb' % fullresname, boxlen, nmol, tries)
+        GenerateBox('%sS.pdb' % fullresname, '%s-box.pdb' % fullresname, boxlen, nmol, tries, timeout=timeout)
     except Exception:
-        GenerateBox('%s.pdb' % fullresname, '%s-box.pdb' % fullresname, boxlen, nmol, tries)
+        GenerateBox('%s.pdb' % fullresname, '%s-box.pdb' % fullresname, boxlen, nmol, tries, timeout=timeout)
     else:
         shutil.copyfile('%sS.pdb' % fullresname, '%s.pdb' % fullresname)
         log.info("""
@@ -215,6 +226,7 @@ def main():
     parser.add_argument('--density', type=int, default=600, help='Specify target density of the solvent box; should be somewhat smaller than true liquid density due to imperfect packing.')
     parser.add_argument('--nmol', type=int, default=256, help='Specify desired number of molecules in the solvent box.')
     parser.add_argument('--tries', type=int, default=10, help='Pass number of tries per molecule to be passed to genbox. Higher = longer runtime but may achieve higher density.')
+    parser.add_argument('--timeout', type=float, default=None, help='Wall-clock limit of every genbox call in seconds.')
     parser.add_argument('input', type=str, help='Input file containing a single SMILES string')
     parser.add_argument('resname', type=str, help='Specify a custom residue name for the molecule.')
     print('%s called with the following command line:' % __file__)
@@ -0,0 +1,245 @@
+"""
+daemon.py keeps a charge calculation service running on a local (unix) socket.
+
+Imports and the initialization of openeye and openbabel are paid once when the daemon starts instead
+of for every molecule. Requests are JSON objects, one per line:
+
+    {"id": 1, "smiles": "CCO", "charge_types": ["RESP2"], "deltas": [0.6]}
+    {"id": 2, "mol2": "/path/to/ligand.mol2", "resname": "LIG"}
+
+and every response is written to the same connection as soon as the molecule is finished, in the
+order of completion:
+
+    {"id": 1, "key": "...", "error": null, "charges": [{"type": "RESP2", "delta": 0.6, "file": ..., "charges": [...]}]}
+
+Identical requests (same structure, charge models and settings) are calculated once, also if they
+arrive from different clients at the same time; finished results are kept for later requests. All
+molecules share the workers of one streaming pipeline (see pipeline), so many small molecules are
+processed at the same time and their cheap stages overlap with the QM of others.
+
+    python -m resp2.daemon serve --socket /tmp/resp2.sock --workdir charges
+    python -m resp2.daemon request --socket /tmp/resp2.sock --smiles CCO
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging as log
+import os
+import queue
+import shutil
+import socket
+import sys
+import threading
+
+try:
+    import resp2.pipeline as pipeline
+    import resp2.manifest as manifest
+except ModuleNotFoundError:
+    import pipeline
+    import manifest
+
+_STOP = object()
+
+# Keys of a request which change the result
+REQUEST_KEYS = ['smiles', 'resname', 'charge_types', 'deltas', 'opt']
+
+
+def request_key(request):
+    """
+    :param request: Request dictionary.
+    :return: Hash identifying the result of the request.
+    """
+    identity = {key: request.get(key) for key in REQUEST_KEYS}
+    if request.get('mol2'):
+        identity['mol2'] = manifest.hash_file(request['mol2'])
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+class ChargeDaemon(object):
+    """
+    Charge calculation service.
+
+    :param socket_path: Path of the unix socket.
+    :param workdir: Folder the molecule folders are created in.
+    :param workers: Dictionary stage name -> number of workers of the pipeline (see pipeline.STAGE_WORKERS).
+    :param maxsize: Maximum number of molecules waiting in front of every stage.
+    :param charge_pipeline: pipeline.Pipeline to use. default: pipeline.charge_pipeline(workers, maxsize)
+    :param settings: Defaults for all molecules (e.g. opt, timeout).
+    """
+
+    def __init__(self, socket_path, workdir='.', workers=None, maxsize=2, charge_pipeline=None, **settings):
+        self.socket_path = socket_path
+        self.workdir = os.path.abspath(workdir)
+        self.pipeline = charge_pipeline or pipeline.charge_pipeline(workers=workers, maxsize=maxsize)
+        self.settings = settings
+        self._inbox = queue.Queue()
+        self._pending = {}
+        self._results = {}
+        self._loop = None
+        self._server = None
+
+    def _requests(self):
+        while True:
+            item = self._inbox.get()
+            if item is _STOP:
+                return
+            yield item
+
+    def _consume(self):
+        for molecule in self.pipeline.stream(self._requests()):
+            self._loop.call_soon_threadsafe(self._finish, molecule)
+
+    def _finish(self, molecule):
+        result = dict(key=molecule['key'], error=molecule.get('error'), charges=molecule.get('charges'))
+        if result['error'] is None:
+            self._results[molecule['key']] = result
+        for future in self._pending.pop(molecule['key'], []):
+            future.set_result(result)
+
+    def submit(self, request):
+        """
+        Queues a request unless the same request is already queued or finished. Has to be called in the
+        event loop of the daemon.
+
+        :param request: Request dictionary (smiles or mol2, optional resname, charge_types, deltas, opt).
+        :return: asyncio.Future with the result dictionary (key, error, charges).
+        """
+        if not request.get('smiles') and not request.get('mol2'):
+            raise ValueError('A request needs a smiles string or a mol2 file')
+        future = self._loop.create_future()
+        key = request_key(request)
+        if key in self._results:
+            future.set_result(self._results[key])
+            return future
+        if key in self._pending:
+            log.info('Request {} is already queued'.format(key[:12]))
+            self._pending[key].append(future)
+            return future
+        self._pending[key] = [future]
+        name = os.path.join(self.workdir, 'mol-' + key[:12])
+        molecule = dict(self.settings, key=key, name=name, resname=request.get('resname') or 'MOL',
+                        smiles=request.get('smiles'))
+        for option in ['charge_types', 'deltas', 'opt']:
+            if request.get(option) is not None:
+                molecule[option] = request[option]
+        if request.get('mol2'):
+            if not os.path.isdir(name + '-liquid'):
+                os.makedirs(name + '-liquid')
+            shutil.copyfile(request['mol2'], os.path.join(name + '-liquid', molecule['resname'] + '.mol2'))
+        self._inbox.put(molecule)
+        return future
+
+    async def _respond(self, request, writer, lock):
+        try:
+            result = await self.submit(request)
+        except Exception as e:
+            result = dict(key=None, error='Invalid request: {!r}'.format(e), charges=None)
+        async with lock:
+            writer.write((json.dumps(dict(result, id=request.get('id'))) + '\n').encode())
+            await writer.drain()
+
+    async def _handle(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                request = {'error': e}
+            tasks.append(asyncio.ensure_future(self._respond(request, writer, lock)))
+        await asyncio.gather(*tasks)
+        writer.close()
+
+    async def serve(self):
+        """
+        Runs the daemon until stop is called.
+        """
+        self._loop = asyncio.get_running_loop()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        consumer = threading.Thread(target=self._consume, name='resp2-daemon', daemon=True)
+        consumer.start()
+        self._server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        log.info('RESP2 daemon listening on {}'.format(self.socket_path))
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._inbox.put(_STOP)
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def stop(self):
+        """
+        Stops the daemon. Thread-safe.
+        """
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+        return 0
+
+
+def request_charges(requests, socket_path):
+    """
+    Sends requests to a running daemon and yields the responses as soon as they arrive.
+
+    :param requests: List of request dictionaries. Requests without id are numbered.
+    :param socket_path: Path of the unix socket of the daemon.
+    :return: Generator of response dictionaries (in the order the molecules are finished).
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    try:
+        for k, request in enumerate(requests):
+            client.sendall((json.dumps(dict({'id': k}, **request)) + '\n').encode())
+        client.shutdown(socket.SHUT_WR)
+        for line in client.makefile('r'):
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RESP2 charge calculation daemon.')
+    subparsers = parser.add_subparsers(dest='command')
+    serve = subparsers.add_parser('serve', help='Run the daemon.')
+    serve.add_argument('--socket', type=str, default='resp2.sock', help='Path of the unix socket.')
+    serve.add_argument('--workdir', type=str, default='.', help='Folder for the molecule folders.')
+    serve.add_argument('--workers', type=str, nargs='*', default=[],
+                       help='Number of workers per stage, e.g. optimization=2 esp=2')
+    serve.add_argument('--timeout', type=float, default=None, help='Time limit of external programs in seconds.')
+    request = subparsers.add_parser('request', help='Request charges from a running daemon.')
+    request.add_argument('--socket', type=str, default='resp2.sock', help='Path of the unix socket.')
+    request.add_argument('--smiles', type=str, nargs='*', default=[], help='SMILES strings.')
+    request.add_argument('--mol2', type=str, nargs='*', default=[], help='mol2 files.')
+    request.add_argument('--charge-type', type=str, default='RESP2', help='RESP1 or RESP2')
+    request.add_argument('--delta', type=float, nargs='*', default=[1.0], help='Mixing parameters.')
+    args = parser.parse_args(sys.argv[1:])
+    if args.command == 'serve':
+        log.getLogger().setLevel(log.INFO)
+        workers = {stage: int(number) for stage, number in (item.split('=') for item in args.workers)}
+        daemon = ChargeDaemon(args.socket, workdir=args.workdir, workers=workers, timeout=args.timeout)
+        asyncio.run(daemon.serve())
+    elif args.command == 'request':
+        requests = [dict(smiles=smiles) for smiles in args.smiles] + \
+                   [dict(mol2=os.path.abspath(mol2)) for mol2 in args.mol2]
+        for request in requests:
+            request.update(charge_types=[args.charge_type], deltas=args.delta)
+        for response in request_charges(requests, args.socket):
+            sys.stdout.write(json.dumps(response) + '\n')
+            sys.stdout.flush()
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
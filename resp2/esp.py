@@ -0,0 +1,271 @@
+"""
+esp.py keeps ESP grids and values as numpy arrays, from the grid selection to the charge fit.
+
+- msk_grid selects Merz-Singh-Kollman points on scaled van der Waals surfaces of a conformer.
+- The ESP (and optionally the electric field) is evaluated on the points inside the QM session
+  (psi4pool.Psi4Task of kind 'esp') and comes back as arrays.
+- save_esp / load_esp store the arrays of a conformer in binary form (numpy .npz).
+- resp_fit fits charges to the ESPs of all conformers with the two stage hyperbolic restraints of
+  RESP (Bayly et al. 1993). Symmetry equivalent atoms get the same charge.
+
+The grid and fit settings are those written to respyte's input files (see RESPYTE_GRID,
+RESPYTE_BOUNDARY and RESPYTE_RESTRAINT and resp2.create_respyte_input_files), so that both ESP paths
+fit the same points with the same restraints.
+
+Coordinates and grids are in Angstrom, ESPs in Hartree / e and fields in Hartree / (e Bohr).
+"""
+
+import numpy as np
+
+# Angstrom per Bohr
+BOHR = 0.52917721067
+
+# Bondi radii in Angstrom
+BONDI_RADII = {'H': 1.20, 'He': 1.40, 'Li': 1.82, 'C': 1.70, 'N': 1.55, 'O': 1.52, 'F': 1.47, 'Ne': 1.54,
+               'Na': 2.27, 'Mg': 1.73, 'Si': 2.10, 'P': 1.80, 'S': 1.80, 'Cl': 1.75, 'Ar': 1.88, 'Br': 1.85,
+               'I': 1.98}
+
+# Covalent radii in Angstrom, used to find bonds
+COVALENT_RADII = {'H': 0.31, 'C': 0.76, 'N': 0.71, 'O': 0.66, 'F': 0.57, 'Si': 1.11, 'P': 1.07, 'S': 1.05,
+                  'Cl': 1.02, 'Br': 1.20, 'I': 1.39}
+
+# Scale factors of the van der Waals radii and point density (points per Angstrom^2) of the MSK grid
+MSK_SCALES = (1.4, 1.6, 1.8, 2.0)
+MSK_DENSITY = 1.0
+
+# grid_setting of respyte's input.yml; the msk grid type uses the MSK shells above. input.yml keeps the key
+# 'innner' of the original RESP2 inputs, so that the grids of existing calculations do not change.
+RESPYTE_GRID = dict(type='msk', radii='bondi', space=0.4, inner=1.6, outer=2.1)
+# boundary_select of respyte.yml: points closer than inner or farther than outer van der Waals radii
+# from the molecule are not fitted
+RESPYTE_BOUNDARY = (1.3, 2.1)
+# restraint of respyte.yml (2-stg-fit)
+RESPYTE_RESTRAINT = dict(a1=0.0005, a2=0.001, b=0.1)
+
+# PCM settings of the RESP2LIQUID ESP
+PCM_WATER = """
+    Units = Angstrom
+    Medium {
+    SolverType = IEFPCM
+    Solvent = Water
+    }
+    Cavity {
+    RadiiSet = UFF
+    Type = GePol
+    Scaling = False
+    Area = 0.3
+    Mode = Implicit
+    }
+"""
+
+
+def read_xyz(filename):
+    """
+    :param filename: Path to a xyz file.
+    :return: List of element symbols and coordinates (n x 3 array) in Angstrom.
+    """
+    lines = open(filename).readlines()[2:]
+    fields = [line.split() for line in lines if len(line.split()) >= 4]
+    return [f[0] for f in fields], np.array([[float(x) for x in f[1:4]] for f in fields])
+
+
+def _sphere(n):
+    # n nearly uniform points on the unit sphere (golden spiral)
+    k = np.arange(n) + 0.5
+    theta = np.arccos(1.0 - 2.0 * k / n)
+    phi = np.pi * (1.0 + 5.0 ** 0.5) * k
+    return np.column_stack([np.cos(phi) * np.sin(theta), np.sin(phi) * np.sin(theta), np.cos(theta)])
+
+
+def msk_grid(elements, coordinates, scales=MSK_SCALES, density=MSK_DENSITY, boundary=RESPYTE_BOUNDARY):
+    """
+    Selects the points of a Merz-Singh-Kollman grid.
+
+    :param elements: List of element symbols.
+    :param coordinates: n x 3 array in Angstrom.
+    :param scales: Scale factors of the van der Waals radii, one layer per factor.
+    :param density: Points per Angstrom^2 on every layer.
+    :param boundary: Inner and outer scale factor of the points which are kept (see select_boundary).
+    :return: m x 3 array of grid points in Angstrom.
+    """
+    coordinates = np.asarray(coordinates, dtype=float)
+    radii = np.array([BONDI_RADII.get(element, 2.0) for element in elements])
+    layers = []
+    for scale in scales:
+        scaled = radii * scale
+        for center, radius in zip(coordinates, scaled):
+            points = center + radius * _sphere(max(int(4.0 * np.pi * radius ** 2 * density), 1))
+            # Keep the points outside the scaled spheres of all atoms
+            distances = np.linalg.norm(points[:, None, :] - coordinates[None, :, :], axis=2)
+            layers.append(points[np.all(distances >= scaled[None, :] - 1e-8, axis=1)])
+    grid = np.concatenate(layers) if layers else np.zeros((0, 3))
+    return select_boundary(elements, coordinates, grid, *boundary) if boundary is not None else grid
+
+
+def select_boundary(elements, coordinates, grid, inner, outer):
+    """
+    Keeps the grid points which are at least inner van der Waals radii away from every atom and within
+    outer van der Waals radii of at least one atom, like respyte's boundary_select.
+
+    :param elements: List of element symbols.
+    :param coordinates: n x 3 array in Angstrom.
+    :param grid: m x 3 array in Angstrom.
+    :param inner: Inner scale factor of the van der Waals radii.
+    :param outer: Outer scale factor of the van der Waals radii.
+    :return: Array of the kept points.
+    """
+    radii = np.array([BONDI_RADII.get(element, 2.0) for element in elements])
+    scaled = np.linalg.norm(np.asarray(grid)[:, None, :] - np.asarray(coordinates)[None, :, :], axis=2) / radii
+    return np.asarray(grid)[np.all(scaled >= inner - 1e-8, axis=1) & np.any(scaled <= outer + 1e-8, axis=1)]
+
+
+def save_esp(filename, grid, esp, field=None, elements=None, coordinates=None):
+    """
+    Stores the ESP of a conformer as numpy .npz file.
+
+    :return: 0 if successful
+    """
+    arrays = dict(grid=np.asarray(grid), esp=np.asarray(esp))
+    if field is not None:
+        arrays['field'] = np.asarray(field)
+    if elements is not None:
+        arrays['elements'] = np.asarray(elements)
+    if coordinates is not None:
+        arrays['coordinates'] = np.asarray(coordinates)
+    np.savez(filename, **arrays)
+    return 0
+
+
+def load_esp(filename):
+    """
+    :return: Dictionary with the arrays grid, esp and, if stored, field, elements and coordinates.
+    """
+    with np.load(filename) as data:
+        return {key: data[key] for key in data.files}
+
+
+def coulomb_matrix(coordinates, grid):
+    """
+    :return: Matrix (grid points x atoms) of 1/r in 1/Bohr. The ESP of point charges q is coulomb_matrix @ q.
+    """
+    distances = np.linalg.norm(np.asarray(grid)[:, None, :] - np.asarray(coordinates)[None, :, :], axis=2)
+    return BOHR / distances
+
+
+def bond_matrix(elements, coordinates):
+    """
+    :return: Boolean matrix (atoms x atoms) of the bonds, from the distances and covalent radii.
+    """
+    coordinates = np.asarray(coordinates)
+    distances = np.linalg.norm(coordinates[:, None, :] - coordinates[None, :, :], axis=2)
+    radii = np.array([COVALENT_RADII.get(element, 1.5) for element in elements])
+    bonded = distances < 1.2 * (radii[:, None] + radii[None, :])
+    np.fill_diagonal(bonded, False)
+    return bonded
+
+
+def bonded_hydrogens(elements, coordinates):
+    """
+    :return: Dictionary atom index -> list of indices of the hydrogens bonded to it.
+    """
+    coordinates = np.asarray(coordinates)
+    distances = np.linalg.norm(coordinates[:, None, :] - coordinates[None, :, :], axis=2)
+    bonded = bond_matrix(elements, coordinates)
+    hydrogens = {}
+    for h in [i for i, element in enumerate(elements) if element == 'H']:
+        partners = [j for j in np.flatnonzero(bonded[h]) if j != h]
+        if partners:
+            partner = min(partners, key=lambda j: distances[h, j])
+            hydrogens.setdefault(partner, []).append(h)
+    return hydrogens
+
+
+def symmetry_classes(elements, coordinates):
+    """
+    Finds the symmetry equivalent atoms from the bond graph: atoms are refined by their element and the
+    classes of their neighbors until the number of classes stays the same.
+
+    :param elements: List of element symbols.
+    :param coordinates: n x 3 array in Angstrom.
+    :return: List of symmetry classes (lists of atom indices), ordered by their first atom.
+    """
+    bonds = bond_matrix(elements, coordinates)
+    neighbors = [np.flatnonzero(row) for row in bonds]
+    labels = list(elements)
+    count = len(set(labels))
+    while True:
+        keys = [(labels[a], tuple(sorted(labels[b] for b in neighbors[a]))) for a in range(len(elements))]
+        index = {key: k for k, key in enumerate(sorted(set(keys), key=str))}
+        labels = [str(index[key]) for key in keys]
+        if len(index) == count:
+            break
+        count = len(index)
+    classes = {}
+    for a, label in enumerate(labels):
+        classes.setdefault(label, []).append(a)
+    return sorted(classes.values())
+
+
+def _fit(A, B, total_charge, restrained, a, b, groups, fixed, tolerance=1e-6, max_iterations=100):
+    # Charges in groups share one parameter, fixed charges are kept. Solved with a Lagrange multiplier for
+    # the total charge, iterating the hyperbolic restraint to self-consistency.
+    n = len(B)
+    free = [group for group in groups if not any(i in fixed for i in group)]
+    T = np.zeros((n, len(free)))
+    for k, group in enumerate(free):
+        T[group, k] = 1.0
+    q_fixed = np.zeros(n)
+    for i, value in fixed.items():
+        q_fixed[i] = value
+    q = q_fixed.copy()
+    for _ in range(max_iterations):
+        R = np.diag(np.where(restrained, a / np.sqrt(q ** 2 + b ** 2), 0.0))
+        M = T.T @ (A + R) @ T
+        rhs = T.T @ (B - (A + R) @ q_fixed)
+        ones = T.sum(axis=0)
+        system = np.block([[M, ones[:, None]], [ones[None, :], np.zeros((1, 1))]])
+        solution = np.linalg.solve(system, np.append(rhs, total_charge - q_fixed.sum()))
+        q_new = q_fixed + T @ solution[:-1]
+        if np.max(np.abs(q_new - q)) < tolerance:
+            return q_new
+        q = q_new
+    return q
+
+
+def resp_fit(elements, conformers, total_charge=0, a1=RESPYTE_RESTRAINT['a1'], a2=RESPYTE_RESTRAINT['a2'],
+             b=RESPYTE_RESTRAINT['b']):
+    """
+    Fits RESP charges to the ESPs of several conformers in two stages: first all charges with a weak
+    restraint on the heavy atoms, then the charges of carbons with two or more hydrogens (and those
+    hydrogens) with a stronger restraint, keeping all others. Symmetry equivalent atoms (see
+    symmetry_classes) share one charge in both stages, except the hydrogens of the carbons refitted in
+    the second stage, which are only made equivalent there.
+
+    :param elements: List of element symbols.
+    :param conformers: List of (coordinates, grid, esp) arrays (Angstrom, Angstrom, Hartree / e).
+    :param total_charge: Total charge of the molecule.
+    :param a1: Restraint of the first stage.
+    :param a2: Restraint of the second stage.
+    :param b: Hyperbolic restraint width.
+    :return: Array of charges.
+    """
+    n = len(elements)
+    A = np.zeros((n, n))
+    B = np.zeros(n)
+    for coordinates, grid, esp in conformers:
+        C = coulomb_matrix(coordinates, grid)
+        A += C.T @ C
+        B += C.T @ np.asarray(esp)
+    restrained = np.array([element != 'H' for element in elements])
+    classes = symmetry_classes(elements, conformers[0][0])
+    hydrogens = bonded_hydrogens(elements, conformers[0][0])
+    refit = [c for c, hs in hydrogens.items() if elements[c] == 'C' and len(hs) >= 2]
+    free = set(refit + [h for c in refit for h in hydrogens[c]])
+    groups = [[i] for group in classes for i in group if i in free and elements[i] == 'H']
+    groups += [[i for i in group if i not in free or elements[i] != 'H'] for group in classes]
+    q = _fit(A, B, total_charge, restrained, a1, b, [group for group in groups if group], {})
+    if not refit:
+        return q
+    groups = [[i for i in group if i in free] for group in classes]
+    fixed = {i: q[i] for i in range(n) if i not in free}
+    return _fit(A, B, total_charge, restrained, a2, b, [group for group in groups if group], fixed)
@@ -0,0 +1,190 @@
+"""
+esppair.py calculates the gas phase (RESP2GAS) and the PCM (RESP2LIQUID) ESP of a conformer in one psi4 session.
+
+Both branches use the same level of theory, geometry and grid and only differ in the PCM. respyte's
+esp_generator starts psi4 on the input it wrote; this module is put in front of psi4 as a wrapper
+(see pair_environment) and works in two modes:
+
+- pair: used for the RESP2LIQUID branch. The PCM input is run as a combined input which first
+  converges the gas phase, keeps its ESP, and then starts the PCM SCF from the gas phase orbitals
+  (guess read). The gas phase ESP and the output are stored in a cache, keyed by the gas phase input
+  and the grid.
+- cached: used for the RESP2GAS branch afterwards. If the cache has the results for the same input and
+  grid, they are copied instead of running psi4. Otherwise psi4 runs as usual.
+
+respyte still selects the grids, writes the inputs and reads the results, so both branches produce
+the same files as separate runs.
+"""
+
+import hashlib
+import logging as log
+import os
+import re
+import shutil
+import stat
+import subprocess
+import sys
+
+if __name__ == '__main__':
+    # Run as script by the psi4 wrapper (see pair_environment). The folder of this file is the first entry of
+    # sys.path, where resp2 would be resp2/resp2.py with all its optional dependencies instead of the package.
+    import retry
+else:
+    try:
+        import resp2.retry as retry
+    except ModuleNotFoundError:
+        import retry
+
+# Files psi4 writes for the properties GRID_ESP and GRID_FIELD
+GRID_FILE = 'grid.dat'
+RESULT_FILES = ['grid_esp.dat', 'grid_field.dat']
+# psi4 command line options followed by a value
+VALUE_OPTIONS = ['-n', '--nthread', '-s', '--scratch', '-p', '--prefix', '--memory']
+
+_PCM_BLOCK = re.compile(r'^\s*pcm\s*=\s*\{')
+_PCM_OPTION = re.compile(r'^\s*(set\s+)?pcm(_scf_type)?\s+\S+\s*$', re.IGNORECASE)
+
+_RENAME = """
+import os
+for _name in {files!r}:
+    if os.path.exists(_name):
+        os.replace(_name, 'gas_' + _name)
+"""
+
+
+def strip_pcm(text):
+    """
+    :param text: Content of a psi4 input.
+    :return: The input without PCM options and pcm block.
+    """
+    lines = []
+    depth = 0
+    for line in text.splitlines(True):
+        if depth == 0 and _PCM_BLOCK.match(line):
+            depth = line.count('{') - line.count('}')
+            continue
+        if depth > 0:
+            depth += line.count('{') - line.count('}')
+            continue
+        if _PCM_OPTION.match(line):
+            continue
+        lines.append(line)
+    return ''.join(lines)
+
+
+def combined_input(text):
+    """
+    :param text: Content of a psi4 input with PCM.
+    :return: Input which runs the gas phase first (results renamed to gas_*) and then the PCM calculation
+             starting from the gas phase orbitals.
+    """
+    return strip_pcm(text) + _RENAME.format(files=RESULT_FILES) + '\n' + \
+        retry.escalate_input(text, dict(options={'guess': 'read'}))
+
+
+def pair_key(text, grid_file=GRID_FILE):
+    """
+    :param text: Content of a psi4 input (with or without PCM).
+    :param grid_file: Grid the ESP is calculated on.
+    :return: Hash of the gas phase calculation, or None without grid.
+    """
+    if not os.path.isfile(grid_file):
+        return None
+    normalized = '\n'.join(line.strip() for line in strip_pcm(text).splitlines() if line.strip())
+    sha = hashlib.sha256(normalized.encode())
+    sha.update(open(grid_file, 'rb').read())
+    return sha.hexdigest()
+
+
+def _output_name(input_file):
+    # psi4 writes input.dat to output.dat and everything else to {base}.out
+    if os.path.basename(input_file) == 'input.dat':
+        return os.path.join(os.path.dirname(input_file), 'output.dat')
+    return os.path.splitext(input_file)[0] + '.out'
+
+
+def _split_arguments(argv):
+    positional, options = [], []
+    args = iter(argv)
+    for arg in args:
+        if arg in VALUE_OPTIONS:
+            options += [arg, next(args, '')]
+        elif arg.startswith('-'):
+            options.append(arg)
+        else:
+            positional.append(arg)
+    return positional, options
+
+
+def run(argv, mode, cache, psi4='psi4'):
+    """
+    Runs psi4 like 'psi4 {argv}' in the given mode.
+
+    :param argv: Arguments of the psi4 call (input file, optional output file and options).
+    :param mode: pair, cached or anything else (plain psi4).
+    :param cache: Folder of the cached gas phase results.
+    :param psi4: The psi4 executable.
+    :return: Exit code.
+    """
+    positional, options = _split_arguments(argv)
+    input_file = positional[0] if positional else 'input.dat'
+    output_file = os.path.abspath(positional[1] if len(positional) > 1 else _output_name(input_file))
+    text = open(input_file).read() if os.path.isfile(input_file) else ''
+    key = pair_key(text, os.path.join(os.path.dirname(input_file), GRID_FILE)) if text else None
+    folder = os.path.dirname(os.path.abspath(input_file))
+
+    if mode == 'cached' and key is not None and os.path.isfile(os.path.join(cache, key, 'output.dat')):
+        log.info('Using the gas phase ESP of the combined calculation {}'.format(key[:12]))
+        for name in RESULT_FILES + ['output.dat']:
+            if os.path.isfile(os.path.join(cache, key, name)):
+                shutil.copyfile(os.path.join(cache, key, name),
+                                output_file if name == 'output.dat' else os.path.join(folder, name))
+        return 0
+
+    if mode == 'pair' and key is not None and strip_pcm(text) != text:
+        combined_file = os.path.join(folder, 'input.pair.dat')
+        with open(combined_file, 'w') as f:
+            f.write(combined_input(text))
+        code = subprocess.call([psi4, combined_file, output_file] + options, cwd=folder)
+        if code == 0 and 'beer' in open(output_file).read():
+            target = os.path.join(cache, key)
+            os.makedirs(target, exist_ok=True)
+            for name in RESULT_FILES:
+                if os.path.isfile(os.path.join(folder, 'gas_' + name)):
+                    os.replace(os.path.join(folder, 'gas_' + name), os.path.join(target, name))
+            shutil.copyfile(output_file, os.path.join(target, 'output.dat'))
+        return code
+
+    return subprocess.call([psi4] + argv)
+
+
+def pair_environment(cache, mode, psi4=None):
+    """
+    Creates a psi4 wrapper in {cache}/bin and returns the environment which puts it in front of psi4.
+
+    :param cache: Folder of the cached gas phase results.
+    :param mode: pair (RESP2LIQUID) or cached (RESP2GAS).
+    :param psi4: The psi4 executable. default: psi4 found in PATH
+    :return: Environment dictionary, or None if psi4 was not found.
+    """
+    psi4 = psi4 or shutil.which('psi4')
+    if psi4 is None:
+        return None
+    cache = os.path.abspath(cache)
+    bin_folder = os.path.join(cache, 'bin')
+    os.makedirs(bin_folder, exist_ok=True)
+    wrapper = os.path.join(bin_folder, 'psi4')
+    with open(wrapper, 'w') as f:
+        f.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, os.path.abspath(__file__)))
+    os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return dict(os.environ, PATH=bin_folder + os.pathsep + os.environ.get('PATH', ''), RESP2_ESP_PAIR=mode,
+                RESP2_ESP_CACHE=cache, RESP2_PSI4=os.path.abspath(psi4))
+
+
+def main():
+    sys.exit(run(sys.argv[1:], os.environ.get('RESP2_ESP_PAIR'), os.environ.get('RESP2_ESP_CACHE', '.'),
+                 psi4=os.environ.get('RESP2_PSI4', 'psi4')))
+
+
+if __name__ == "__main__":
+    main()
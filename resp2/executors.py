@@ -0,0 +1,374 @@
+"""
+executors.py runs the stages and jobs of charge calculations on interchangeable backends.
+
+All backends implement concurrent.futures.Executor (submit returns a Future), so they can be passed
+wherever a pool is used (scheduler.run_task_graph, campaign.run_campaign):
+
+- InlineExecutor runs every function immediately in the calling process. Used for tests and debugging.
+- LocalExecutor is a process pool on the local host.
+- ThreadExecutor is a thread pool in the current process. The stages never change the working
+  directory and the expensive work runs in external programs, so threads can drive many molecules
+  without the memory and startup cost of a process per molecule.
+- SharedExecutor writes the tasks into a SQLite database on a shared filesystem. Worker processes on
+  any number of nodes claim tasks atomically, run them and write the results back:
+
+      python -m resp2.executors worker --queue /shared/campaign-queue.db
+
+  A worker which stops sending heartbeats (killed node) has its task requeued. Several local worker
+  processes behave exactly like workers on several nodes, which is how the backend is tested.
+
+Functions and arguments of shared tasks are pickled, so they have to be module level.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import logging as log
+import os
+import pickle
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload BLOB,
+    cost REAL DEFAULT 0,
+    status TEXT DEFAULT 'queued',
+    worker TEXT,
+    submitted REAL,
+    started REAL,
+    heartbeat REAL,
+    finished REAL,
+    result BLOB,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, cost);
+"""
+
+# Seconds between heartbeats of a worker. A running task without heartbeat for STALE_AFTER seconds is requeued.
+HEARTBEAT = 30.0
+STALE_AFTER = 300.0
+
+
+class TaskError(RuntimeError):
+    """
+    Failure of a shared task whose exception could not be passed back as it was (see TaskQueue.finish).
+    The message holds the description and the traceback of the original exception.
+    """
+    pass
+
+
+class InlineExecutor(concurrent.futures.Executor):
+    """
+    Runs every submitted function immediately in the calling process.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class LocalExecutor(concurrent.futures.ProcessPoolExecutor):
+    """
+    Process pool on the local host.
+    """
+    pass
+
+
+class ThreadExecutor(concurrent.futures.ThreadPoolExecutor):
+    """
+    Thread pool in the current process.
+    """
+    pass
+
+
+class TaskQueue(object):
+    """
+    Queue of pickled tasks in a SQLite database. Every operation opens its own connection and claiming
+    a task is a single write transaction, so any number of processes on any node can share the queue.
+
+    :param path: Path to the database file on a filesystem all nodes can access.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        connection = sqlite3.connect(self.path, timeout=120)
+        try:
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    @contextlib.contextmanager
+    def _transaction(self, immediate=False):
+        connection = sqlite3.connect(self.path, timeout=120, isolation_level=None)
+        try:
+            # BEGIN IMMEDIATE takes the write lock before reading, which makes claiming atomic
+            connection.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+    def put(self, function, args=(), kwargs=None, cost=0.0):
+        """
+        :return: Id of the new task.
+        """
+        payload = pickle.dumps((function, tuple(args), dict(kwargs or {})))
+        with self._transaction() as connection:
+            return connection.execute('INSERT INTO tasks (payload, cost, submitted) VALUES (?,?,?)',
+                                      (payload, cost, time.time())).lastrowid
+
+    def claim(self, worker):
+        """
+        Marks the most expensive (or else the oldest) queued task as running.
+
+        :param worker: Name of the claiming worker.
+        :return: (id, function, args, kwargs) or None if no task is queued.
+        """
+        now = time.time()
+        with self._transaction(immediate=True) as connection:
+            row = connection.execute("SELECT id, payload FROM tasks WHERE status='queued' "
+                                     "ORDER BY cost DESC, id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE tasks SET status='running', worker=?, started=?, heartbeat=? WHERE id=?",
+                               (worker, now, now, row[0]))
+        return (row[0],) + pickle.loads(row[1])
+
+    def heartbeat(self, task_id):
+        with self._transaction() as connection:
+            connection.execute("UPDATE tasks SET heartbeat=? WHERE id=? AND status='running'", (time.time(), task_id))
+        return 0
+
+    def finish(self, task_id, result=None, error=None, traceback=None):
+        """
+        Writes the result (or the exception) of a task back. An exception which cannot be pickled and
+        unpickled (e.g. holding psi4 objects), or a result which cannot be pickled, is replaced by a
+        TaskError with the description and the traceback.
+
+        :param traceback: Formatted traceback of the exception.
+        """
+        message = None
+        if error is None:
+            try:
+                payload = pickle.dumps(result)
+            except Exception as e:
+                error = TaskError('Result of task {} could not be pickled: {!r}'.format(task_id, e))
+        if error is not None:
+            message = repr(error) + ('\n' + traceback if traceback else '')
+            try:
+                payload = pickle.dumps(error)
+                pickle.loads(payload)
+            except Exception:
+                payload = pickle.dumps(TaskError(message))
+        with self._transaction() as connection:
+            connection.execute('UPDATE tasks SET status=?, finished=?, result=?, error=? WHERE id=?',
+                               ('failed' if error is not None else 'done', time.time(), payload, message, task_id))
+        return 0
+
+    def cancel(self, task_id):
+        """
+        :return: True if the task was still queued and is now cancelled.
+        """
+        with self._transaction(immediate=True) as connection:
+            return connection.execute("UPDATE tasks SET status='cancelled' WHERE id=? AND status='queued'",
+                                      (task_id,)).rowcount == 1
+
+    def requeue_stale(self, stale_after=STALE_AFTER):
+        """
+        Requeues running tasks whose worker did not send a heartbeat for stale_after seconds.
+
+        :return: Number of requeued tasks.
+        """
+        with self._transaction(immediate=True) as connection:
+            return connection.execute("UPDATE tasks SET status='queued', worker=NULL WHERE status='running' "
+                                      "AND heartbeat<?", (time.time() - stale_after,)).rowcount
+
+    def results(self, task_ids):
+        """
+        :return: Dictionary id -> (status, pickled result) of the finished tasks among task_ids.
+        """
+        if not task_ids:
+            return {}
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT id, status, result FROM tasks WHERE status IN ('done', 'failed') "
+                                      "AND id IN ({})".format(','.join('?' * len(task_ids))), list(task_ids))
+            return {row[0]: (row[1], row[2]) for row in rows.fetchall()}
+
+    def counts(self):
+        """
+        :return: Dictionary status -> number of tasks.
+        """
+        with self._transaction() as connection:
+            return dict(connection.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall())
+
+
+class SharedExecutor(concurrent.futures.Executor):
+    """
+    Submits tasks to a TaskQueue and collects their results. The tasks are run by worker processes
+    (see worker), which can be started on any node with access to the queue.
+
+    :param path: Path to the queue database on a shared filesystem.
+    :param poll_interval: Seconds between checks for finished tasks.
+    """
+
+    def __init__(self, path, poll_interval=1.0):
+        self.queue = TaskQueue(path)
+        self.poll_interval = poll_interval
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._poller = threading.Thread(target=self._poll, name='resp2-shared-executor', daemon=True)
+        self._poller.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues a function. Tasks are claimed in the order they were submitted.
+        """
+        if self._shutdown:
+            raise RuntimeError('cannot schedule new futures after shutdown')
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        task_id = self.queue.put(fn, args, kwargs)
+        with self._lock:
+            self._futures[task_id] = future
+        return future
+
+    def _poll(self):
+        while True:
+            with self._lock:
+                pending = list(self._futures)
+                if self._shutdown and not pending:
+                    return
+            try:
+                finished = self.queue.results(pending)
+            except sqlite3.Error as e:
+                log.warning('Could not read the task queue {}: {}'.format(self.queue.path, e))
+                finished = {}
+            for task_id, (status, payload) in finished.items():
+                with self._lock:
+                    future = self._futures.pop(task_id)
+                value = pickle.loads(payload)
+                if status == 'done':
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+            time.sleep(self.poll_interval)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        if cancel_futures:
+            with self._lock:
+                for task_id in list(self._futures):
+                    if self.queue.cancel(task_id):
+                        self._futures.pop(task_id).set_exception(concurrent.futures.CancelledError())
+        self._shutdown = True
+        if wait:
+            self._poller.join()
+
+
+def worker(path, poll_interval=5.0, idle_timeout=None, max_tasks=None, name=None):
+    """
+    Claims and runs tasks of a shared queue until it is idle for idle_timeout seconds.
+
+    :param path: Path to the queue database.
+    :param poll_interval: Seconds to wait if no task is queued.
+    :param idle_timeout: Stop after this many seconds without work. default=None (never)
+    :param max_tasks: Stop after this many tasks. default=None (no limit)
+    :param name: Name of the worker. default: host:pid
+    :return: Number of tasks run.
+    """
+    queue = TaskQueue(path)
+    name = name or '{}:{}'.format(socket.gethostname(), os.getpid())
+    ntasks = 0
+    idle_since = time.time()
+    while max_tasks is None or ntasks < max_tasks:
+        queue.requeue_stale()
+        task = queue.claim(name)
+        if task is None:
+            if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                break
+            time.sleep(poll_interval)
+            continue
+        task_id, function, args, kwargs = task
+        log.info('Worker {} runs task {} ({})'.format(name, task_id, getattr(function, '__name__', function)))
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(queue, task_id, stop), daemon=True)
+        beat.start()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            log.error('Task {} FAILED: {!r}'.format(task_id, e))
+            queue.finish(task_id, error=e, traceback=traceback.format_exc())
+        else:
+            queue.finish(task_id, result=result)
+        finally:
+            stop.set()
+            beat.join()
+        ntasks += 1
+        idle_since = time.time()
+    return ntasks
+
+
+def _heartbeat(queue, task_id, stop):
+    while not stop.wait(HEARTBEAT):
+        try:
+            queue.heartbeat(task_id)
+        except sqlite3.Error as e:
+            log.warning('Heartbeat of task {} failed: {}'.format(task_id, e))
+
+
+def get_executor(kind='local', max_workers=1, queue=None):
+    """
+    :param kind: inline, thread, local or shared
+    :param max_workers: Number of processes of the local pool.
+    :param queue: Path to the queue database of the shared executor.
+    :return: concurrent.futures.Executor
+    """
+    if kind == 'inline':
+        return InlineExecutor()
+    if kind == 'thread':
+        return ThreadExecutor(max_workers=max_workers)
+    if kind == 'local':
+        return LocalExecutor(max_workers=max_workers)
+    if kind == 'shared':
+        if queue is None:
+            raise ValueError('The shared executor needs the path to a queue database')
+        return SharedExecutor(queue)
+    raise ValueError('Unknown executor {}. Use inline, thread, local or shared.'.format(kind))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker of a shared RESP2 task queue.')
+    subparsers = parser.add_subparsers(dest='command')
+    run = subparsers.add_parser('worker', help='Claim and run tasks of a shared queue.')
+    run.add_argument('--queue', type=str, required=True, help='Queue database on a shared filesystem.')
+    run.add_argument('--idle-timeout', type=float, default=None, help='Stop after this many idle seconds.')
+    run.add_argument('--max-tasks', type=int, default=None, help='Stop after this many tasks.')
+    status = subparsers.add_parser('status', help='Show the number of tasks per status.')
+    status.add_argument('--queue', type=str, required=True, help='Queue database on a shared filesystem.')
+    args = parser.parse_args(sys.argv[1:])
+    if args.command == 'worker':
+        log.getLogger().setLevel(log.INFO)
+        worker(args.queue, idle_timeout=args.idle_timeout, max_tasks=args.max_tasks)
+    elif args.command == 'status':
+        for status, number in sorted(TaskQueue(args.queue).counts().items()):
+            print('{:<10} {}'.format(status, number))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
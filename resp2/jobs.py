@@ -0,0 +1,284 @@
+"""
+jobs.py runs external programs (psi4, respyte, gmx) through a single asyncio based job runner.
+
+The runner owns an event loop in a background thread. All jobs go through one semaphore, which
+limits the number of external programs running at the same time in this process. Every job can
+have a wall-clock timeout; if it is exceeded the whole process group of the job is killed, so
+programs started by the job (e.g. psi4 started by respyte) are terminated as well.
+
+Blocking functions (run_job, run_jobs) are provided for the sequential parts of the code and
+awaitable ones (run_job_async, run_jobs_async) for asyncio code.
+"""
+
+import asyncio
+import logging as log
+import os
+import signal
+import threading
+import time
+
+try:
+    import resp2.progress as progress
+except ModuleNotFoundError:
+    import progress
+
+
+class Job(object):
+    """
+    Description of a single external program call.
+
+    :param command: List of program arguments. The program is not run in a shell.
+    :param cwd: Working directory of the program.
+    :param timeout: Wall-clock time limit in seconds. None means no limit.
+    :param stdout: Filename the standard output is written to. None inherits the output of this process.
+    :param stderr: Filename the standard error is written to. None inherits the output of this process.
+    :param env: Dictionary of environment variables which are added to the current environment.
+    :param name: Name used in log messages. Defaults to the program name.
+    :param cpus: List of CPU ids the program is pinned to. None means no pinning.
+    :param cost: Estimated cost (see cost.CostModel). Jobs submitted together start most expensive first.
+    :param stage: Stage the job belongs to. If given, the start of the job is reported to progress.get_tracker().
+    """
+
+    def __init__(self, command, cwd=None, timeout=None, stdout=None, stderr=None, env=None, name=None, cpus=None,
+                 cost=0.0, stage=None):
+        self.command = [str(arg) for arg in command]
+        self.cwd = cwd
+        self.timeout = timeout
+        self.stdout = stdout
+        self.stderr = stderr
+        self.env = env
+        self.name = name if name is not None else os.path.basename(self.command[0])
+        self.cpus = cpus
+        self.cost = cost
+        self.stage = stage
+
+
+class JobResult(object):
+    """
+    Outcome of a job.
+
+    :param job: The Job which was executed.
+    :param returncode: Exit code of the program. Negative values indicate termination by a signal.
+    :param timed_out: True if the job was killed because it exceeded its timeout.
+    :param elapsed: Wall-clock time of the job in seconds.
+    """
+
+    def __init__(self, job, returncode=None, timed_out=False, elapsed=0.0):
+        self.job = job
+        self.returncode = returncode
+        self.timed_out = timed_out
+        self.elapsed = elapsed
+
+    @property
+    def success(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def __repr__(self):
+        return 'JobResult({}, returncode={}, timed_out={}, elapsed={:.1f})'.format(
+            self.job.name, self.returncode, self.timed_out, self.elapsed)
+
+
+def _kill_process_group(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class JobRunner(object):
+    """
+    Runs jobs in an event loop in a background thread.
+
+    :param max_jobs: Maximum number of jobs running at the same time. Defaults to the number of cores.
+    :param kill_grace: Seconds between SIGTERM and SIGKILL when a job is killed after a timeout.
+    """
+
+    def __init__(self, max_jobs=None, kill_grace=10.0):
+        self.max_jobs = max_jobs if max_jobs is not None else (os.cpu_count() or 1)
+        self.kill_grace = kill_grace
+        self._loop = None
+        self._pid = None
+        self._semaphore = None
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def _get_loop(self):
+        with self._lock:
+            # A forked child process (e.g. a worker of a process pool) inherits the loop but not its thread
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                self._semaphore = None
+                self._processes = set()
+                thread = threading.Thread(target=self._loop.run_forever, name='resp2-job-runner', daemon=True)
+                thread.start()
+            return self._loop
+
+    async def _execute(self, job):
+        # The semaphore has to be created inside the loop it is used in
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_jobs)
+        async with self._semaphore:
+            env = None
+            if job.env is not None:
+                env = dict(os.environ)
+                env.update(job.env)
+            stdout = open(job.stdout, 'w') if job.stdout is not None else None
+            stderr = open(job.stderr, 'w') if job.stderr is not None else None
+            t0 = time.time()
+            result = JobResult(job)
+            try:
+                log.info('Starting {}: {}'.format(job.name, ' '.join(job.command)))
+                try:
+                    # A new session makes the job the leader of its own process group
+                    process = await asyncio.create_subprocess_exec(*job.command, cwd=job.cwd, env=env,
+                                                                   stdout=stdout, stderr=stderr,
+                                                                   start_new_session=True)
+                except OSError as e:
+                    log.error('Could not start {}: {}'.format(job.name, e))
+                    result.returncode = 127
+                    return result
+                self._processes.add(process)
+                if job.stage is not None:
+                    progress.get_tracker().start(job.stage)
+                if job.cpus:
+                    # Threads started later by the program inherit the affinity
+                    try:
+                        os.sched_setaffinity(process.pid, job.cpus)
+                    except (AttributeError, OSError) as e:
+                        log.warning('Could not pin {} to cpus {}: {}'.format(job.name, job.cpus, e))
+                try:
+                    result.returncode = await asyncio.wait_for(process.wait(), job.timeout)
+                except asyncio.TimeoutError:
+                    result.timed_out = True
+                    log.error('{} exceeded its time limit of {} s and is killed'.format(job.name, job.timeout))
+                    _kill_process_group(process.pid, signal.SIGTERM)
+                    try:
+                        await asyncio.wait_for(process.wait(), self.kill_grace)
+                    except asyncio.TimeoutError:
+                        _kill_process_group(process.pid, signal.SIGKILL)
+                    result.returncode = await process.wait()
+                finally:
+                    self._processes.discard(process)
+            finally:
+                for handle in (stdout, stderr):
+                    if handle is not None:
+                        handle.close()
+            result.elapsed = time.time() - t0
+            log.info('Finished {} with exit code {} after {:.1f} s'.format(job.name, result.returncode,
+                                                                         result.elapsed))
+            return result
+
+    async def _execute_all(self, jobs, max_concurrent, slots):
+        if slots:
+            # Every running job takes a slot and hands it back when it is finished
+            free_slots = asyncio.Queue()
+            for slot in slots:
+                free_slots.put_nowait(slot)
+            max_concurrent = len(slots) if max_concurrent is None else min(max_concurrent, len(slots))
+        limit = asyncio.Semaphore(max_concurrent) if max_concurrent is not None else None
+
+        async def execute(job):
+            if limit is None:
+                return await self._execute(job)
+            async with limit:
+                if not slots:
+                    return await self._execute(job)
+                slot = await free_slots.get()
+                try:
+                    job.cpus = slot.cpus
+                    return await self._execute(job)
+                finally:
+                    free_slots.put_nowait(slot)
+
+        # Longest job first: the waiting jobs acquire the semaphores in the order they are started
+        order = sorted(range(len(jobs)), key=lambda k: -jobs[k].cost)
+        results = await asyncio.gather(*[execute(jobs[k]) for k in order])
+        return [result for _, result in sorted(zip(order, results), key=lambda item: item[0])]
+
+    def terminate_all(self):
+        """
+        Sends SIGTERM to the process groups of all running jobs (e.g. when the calculation is preempted).
+        """
+        for process in list(self._processes):
+            _kill_process_group(process.pid, signal.SIGTERM)
+
+    def submit(self, job):
+        """
+        Starts a job and returns immediately.
+
+        :param job: Job to run.
+        :return: concurrent.futures.Future with the JobResult.
+        """
+        return asyncio.run_coroutine_threadsafe(self._execute(job), self._get_loop())
+
+    def submit_all(self, jobs, max_concurrent=None, slots=None):
+        """
+        Starts several jobs and returns immediately.
+
+        :param jobs: List of Jobs.
+        :param max_concurrent: Additional limit for the number of these jobs running at the same time.
+        :param slots: List of resources.JobSlot. Each running job is pinned to the cpus of a free slot.
+        :return: concurrent.futures.Future with the list of JobResults (same order as jobs).
+        """
+        return asyncio.run_coroutine_threadsafe(self._execute_all(list(jobs), max_concurrent, slots),
+                                                self._get_loop())
+
+
+_runner = JobRunner()
+
+
+def get_runner():
+    """
+    :return: The job runner all external programs of resp2 go through.
+    """
+    return _runner
+
+
+def set_max_jobs(max_jobs):
+    """
+    Sets the maximum number of external programs running at the same time.
+    Jobs which are already running are not affected.
+
+    :param max_jobs: Number of jobs
+    :return: 0 if successful
+    """
+    global _runner
+    _runner = JobRunner(max_jobs=max_jobs)
+    return 0
+
+
+def run_job(job):
+    """
+    Runs a job and blocks until it has finished.
+
+    :param job: Job to run.
+    :return: JobResult
+    """
+    return get_runner().submit(job).result()
+
+
+def run_jobs(jobs, max_concurrent=None, slots=None):
+    """
+    Runs several jobs concurrently and blocks until all of them have finished.
+
+    :param jobs: List of Jobs.
+    :param max_concurrent: Additional limit for the number of these jobs running at the same time.
+    :param slots: List of resources.JobSlot. Each running job is pinned to the cpus of a free slot.
+    :return: List of JobResults in the order of jobs.
+    """
+    return get_runner().submit_all(jobs, max_concurrent=max_concurrent, slots=slots).result()
+
+
+async def run_job_async(job):
+    """
+    Awaitable version of run_job.
+    """
+    return await asyncio.wrap_future(get_runner().submit(job))
+
+
+async def run_jobs_async(jobs, max_concurrent=None, slots=None):
+    """
+    Awaitable version of run_jobs.
+    """
+    return await asyncio.wrap_future(get_runner().submit_all(jobs, max_concurrent=max_concurrent, slots=slots))
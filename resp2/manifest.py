@@ -0,0 +1,206 @@
+"""
+manifest.py makes the stages of a charge calculation resumable.
+
+After a stage has finished, a manifest is written which contains a hash of the stage's inputs (files
+and parameters), the list of its output files with their hashes, and the return value of the stage.
+When the calculation is rerun, a stage is skipped if its manifest exists, the inputs did not change
+and all outputs are still present and unchanged. Otherwise the stage is run again.
+
+Manifests are written atomically, so a job killed at any point leaves either a complete manifest or
+none. install_sigterm_handler turns SIGTERM (used by most clusters to preempt jobs) into a Preempted
+exception: running external programs are terminated and no manifest is written for unfinished stages.
+"""
+
+import glob
+import hashlib
+import json
+import logging as log
+import os
+import signal
+import threading
+import time
+
+try:
+    import resp2.jobs as jobs
+except ModuleNotFoundError:
+    import jobs
+
+MANIFEST_FOLDER = 'manifests'
+
+
+class Preempted(Exception):
+    """
+    Raised when the calculation receives SIGTERM.
+    """
+    pass
+
+
+def expand(patterns):
+    """
+    :param patterns: List of file names or glob patterns.
+    :return: Sorted list of existing files matching the patterns.
+    """
+    files = set()
+    for pattern in patterns:
+        files.update(glob.glob(pattern))
+    return sorted(files)
+
+
+def hash_file(path):
+    """
+    :param path: Path to a file.
+    :return: sha256 hex digest of the content of the file.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def hash_inputs(inputs=(), params=None):
+    """
+    :param inputs: List of file names or glob patterns.
+    :param params: JSON serializable parameters of the stage.
+    :return: sha256 hex digest of the content of all input files and the parameters.
+    """
+    sha = hashlib.sha256()
+    for path in expand(inputs):
+        sha.update(os.path.basename(path).encode())
+        sha.update(hash_file(path).encode())
+    sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def manifest_path(folder, stage):
+    """
+    :param folder: Folder of the molecule.
+    :param stage: Name of the stage.
+    :return: Path of the manifest of the stage.
+    """
+    return os.path.join(folder, MANIFEST_FOLDER, '{}.json'.format(stage))
+
+
+def write_manifest(folder, stage, inputs=(), params=None, outputs=(), result=None):
+    """
+    Records that a stage has finished.
+
+    :param folder: Folder of the molecule.
+    :param stage: Name of the stage.
+    :param inputs: List of input files or glob patterns.
+    :param params: JSON serializable parameters of the stage.
+    :param outputs: List of output files or glob patterns.
+    :param result: JSON serializable return value of the stage.
+    :return: 0 if successful
+    """
+    path = manifest_path(folder, stage)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    manifest = dict(stage=stage, finished=time.time(), input_hash=hash_inputs(inputs, params),
+                    outputs={output: hash_file(output) for output in expand(outputs)}, result=result)
+    # Write to a temporary file first, so that an interruption never leaves a broken manifest
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, path)
+    return 0
+
+
+def read_manifest(folder, stage, inputs=(), params=None):
+    """
+    Checks if a stage is complete.
+
+    :param folder: Folder of the molecule.
+    :param stage: Name of the stage.
+    :param inputs: List of input files or glob patterns.
+    :param params: JSON serializable parameters of the stage.
+    :return: The manifest (dictionary) if the stage is complete and up to date, otherwise None.
+    """
+    path = manifest_path(folder, stage)
+    if not os.path.isfile(path):
+        return None
+    try:
+        manifest = json.load(open(path))
+    except ValueError:
+        log.warning('Manifest {} is corrupt'.format(path))
+        return None
+    if manifest.get('input_hash') != hash_inputs(inputs, params):
+        log.info('Inputs of stage {} in {} changed'.format(stage, folder))
+        return None
+    for output, digest in manifest.get('outputs', {}).items():
+        if not os.path.isfile(output) or hash_file(output) != digest:
+            log.info('Output {} of stage {} is missing or changed'.format(output, stage))
+            return None
+    return manifest
+
+
+def invalidate(folder, stage):
+    """
+    Removes the manifest of a stage, so that it is run again.
+    """
+    path = manifest_path(folder, stage)
+    if os.path.isfile(path):
+        os.remove(path)
+    return 0
+
+
+def update_result(folder, stage, result=None):
+    """
+    Changes the recorded result of a finished stage whose outputs were changed afterwards by a later stage
+    (e.g. conformers removed as duplicates). The outputs which still exist are hashed again, the input
+    hash is kept.
+
+    :return: 0 if successful, 1 if the stage has no manifest
+    """
+    path = manifest_path(folder, stage)
+    if not os.path.isfile(path):
+        return 1
+    manifest = json.load(open(path))
+    manifest.update(result=result, outputs={output: hash_file(output) for output in manifest.get('outputs', {})
+                                            if os.path.isfile(output)})
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, path)
+    return 0
+
+
+def run_stage(folder='', stage='', function=None, kwargs=None, inputs=(), outputs=(), params=None):
+    """
+    Runs a stage unless it is already complete. Module level, so that it can be used as scheduler task.
+
+    :param folder: Folder of the molecule (the manifest is stored in {folder}/manifests).
+    :param stage: Name of the stage.
+    :param function: Function of the stage.
+    :param kwargs: Keyword arguments of the function. They are part of the input hash.
+    :param inputs: List of input files or glob patterns.
+    :param outputs: List of output files or glob patterns. A stage without any output is never complete.
+    :param params: Additional JSON serializable parameters which invalidate the stage when changed.
+    :return: Return value of the function (stored in the manifest if the stage is skipped).
+    """
+    kwargs = dict(kwargs or {})
+    params = dict(kwargs=kwargs, params=params)
+    manifest = read_manifest(folder, stage, inputs, params)
+    if manifest is not None and manifest['outputs']:
+        log.info('Stage {} in {} is complete, skipping it'.format(stage, folder))
+        return manifest['result']
+    result = function(**kwargs)
+    write_manifest(folder, stage, inputs, params, outputs, result=result)
+    return result
+
+
+def _handle_sigterm(signum, frame):
+    log.error('Received SIGTERM, terminating running jobs and checkpointing')
+    jobs.get_runner().terminate_all()
+    raise Preempted('Received SIGTERM')
+
+
+def install_sigterm_handler():
+    """
+    Turns SIGTERM into a Preempted exception. Only possible in the main thread.
+
+    :return: The previous handler, or None if the handler could not be installed.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return None
+    return signal.signal(signal.SIGTERM, _handle_sigterm)
@@ -0,0 +1,340 @@
+"""
+pipeline.py processes a batch of molecules as a streaming pipeline.
+
+The stages of a charge calculation (omega conformers, mol2 -> xyz conversion, psi4 optimization,
+ESP generation, respyte fit, charge file) are connected by bounded queues. Every stage has its own
+worker threads, so cheap stages for the next molecule run while psi4 is busy with the current one.
+The QM stages get few workers, as every worker already fills the host with psi4 jobs (see
+resources.plan_psi4_jobs); the light stages get their own workers and do not take cores from them.
+Threads are sufficient because all expensive work is done by external programs.
+
+A molecule is a dictionary with at least the keys name, resname and smiles (or an existing
+{folder}/{resname}.mol2). The charge models are given by charge_type and delta, or by the lists
+charge_types and deltas. The stages add their results to the dictionary; the last stage stores the
+charge files and charges under the key 'charges'. If a stage fails the error is stored under the key
+'error' and the molecule skips all remaining stages.
+"""
+
+import asyncio
+import logging as log
+import os
+import queue
+import threading
+
+try:
+    import resp2.resp2 as resp2
+    import resp2.progress as progress
+except ModuleNotFoundError:
+    import resp2
+    import progress
+
+# Default number of workers per stage
+STAGE_WORKERS = {'conformers': 1, 'convert': 1, 'optimization': 1, 'esp': 1, 'fit': 2, 'charges': 1}
+
+_STOP = object()
+
+
+class Stage(object):
+    """
+    A step of the pipeline.
+
+    :param name: Name of the stage.
+    :param function: Function taking a molecule dictionary. It can modify and return it.
+    :param workers: Number of worker threads of this stage.
+    """
+
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+
+
+class Pipeline(object):
+    """
+    Stages connected by bounded queues.
+
+    :param stages: List of Stages in the order they are applied.
+    :param maxsize: Maximum number of molecules waiting in front of every stage.
+    """
+
+    def __init__(self, stages, maxsize=2):
+        self.stages = stages
+        self.maxsize = maxsize
+
+    def _work(self, stage, inbox, outbox, remaining, lock, nstops):
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                with lock:
+                    remaining[stage.name] -= 1
+                    last = remaining[stage.name] == 0
+                # The last worker of a stage shuts down all workers of the next stage
+                if last:
+                    for _ in range(nstops):
+                        outbox.put(_STOP)
+                return
+            if item.get('error') is None:
+                try:
+                    log.info('Stage {} started for {}'.format(stage.name, item.get('name')))
+                    result = stage.function(item)
+                    if result is not None:
+                        item = result
+                except Exception as e:
+                    log.error('Stage {} FAILED for {}: {}'.format(stage.name, item.get('name'), e))
+                    item['error'] = '{}: {!r}'.format(stage.name, e)
+            outbox.put(item)
+
+    def stream(self, items):
+        """
+        Feeds the molecules into the pipeline and yields them as soon as they left the last stage.
+        If iterating items fails, the molecules fed so far are finished and the error is raised afterwards.
+
+        :param items: Iterable of molecule dictionaries.
+        :return: Generator of molecule dictionaries (in the order they are finished).
+        """
+        queues = [queue.Queue(maxsize=self.maxsize) for _ in self.stages] + [queue.Queue()]
+        remaining = {stage.name: stage.workers for stage in self.stages}
+        lock = threading.Lock()
+        threads = []
+        for k, stage in enumerate(self.stages):
+            nstops = self.stages[k + 1].workers if k + 1 < len(self.stages) else 1
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self._work,
+                                          args=(stage, queues[k], queues[k + 1], remaining, lock, nstops),
+                                          name='resp2-{}'.format(stage.name), daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        errors = []
+
+        def feed():
+            try:
+                for item in items:
+                    queues[0].put(item)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # Without the stop signals the workers and the consumer would wait forever
+                for _ in range(self.stages[0].workers):
+                    queues[0].put(_STOP)
+
+        feeder = threading.Thread(target=feed, name='resp2-feeder', daemon=True)
+        feeder.start()
+        while True:
+            item = queues[-1].get()
+            if item is _STOP:
+                break
+            yield item
+        for thread in threads:
+            thread.join()
+        feeder.join()
+        if errors:
+            raise errors[0]
+
+    def run(self, items):
+        """
+        :param items: Iterable of molecule dictionaries.
+        :return: List of all molecule dictionaries after the last stage.
+        """
+        return list(self.stream(items))
+
+
+### Stages of the charge calculation
+
+def _folder(molecule):
+    return molecule.get('folder') or molecule['name'] + '-liquid'
+
+
+def conformer_stage(molecule):
+    folder = _folder(molecule)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    resp2.create_structure(smi=molecule.get('smiles'), folder=folder, resname=molecule['resname'])
+    molecule['number_of_conformers'] = resp2.create_conformers(infile=molecule['resname'] + '.mol2',
+                                                               outfile=molecule['resname'] + '-conformers.mol2',
+                                                               resname=molecule['resname'], folder=folder,
+                                                               preoptimize=molecule.get('preoptimize'),
+                                                               deduplicate=molecule.get('deduplicate', False),
+                                                               adaptive=molecule.get('adaptive', False),
+                                                               max_conformers=molecule.get('max_conformers'))
+    return molecule
+
+
+def convert_stage(molecule):
+    resp2.convert_conformers(name=molecule['name'], resname=molecule['resname'], folder=_folder(molecule),
+                             number_of_conformers=molecule['number_of_conformers'])
+    return molecule
+
+
+def optimization_stage(molecule):
+    if molecule.get('sequential'):
+        # Optimization, ESPs and fit conformer by conformer; the esp and fit stages have nothing left to do
+        molecule['sequential'] = resp2.sequential_charges(
+            name=molecule['name'], resname=molecule['resname'], folder=_folder(molecule),
+            number_of_conformers=molecule['number_of_conformers'], pool=molecule.get('psi4_pool'),
+            branches=_branches(molecule), tolerance=molecule.get('tolerance', resp2.CHARGE_TOLERANCE), convert=False,
+            timeout=molecule.get('timeout'), preset=molecule.get('preset'))
+        return molecule
+    molecule['optimization'] = resp2.optimize_conformers(name=molecule['name'], resname=molecule['resname'],
+                                                         opt=molecule.get('opt', True), folder=_folder(molecule),
+                                                         number_of_conformers=molecule['number_of_conformers'],
+                                                         timeout=molecule.get('timeout'), convert=False,
+                                                         pool=molecule.get('psi4_pool'),
+                                                         preset=molecule.get('preset'))
+    if molecule.get('deduplicate'):
+        molecule['number_of_conformers'] = resp2.deduplicate_optimized(
+            name=molecule['name'], resname=molecule['resname'], folder=_folder(molecule),
+            number_of_conformers=molecule['number_of_conformers'], preset=molecule.get('preset'))
+    return molecule
+
+
+def _charge_models(molecule):
+    charge_types = molecule.get('charge_types') or [molecule.get('charge_type', 'RESP2')]
+    deltas = molecule.get('deltas') or [molecule.get('delta', 1.0)]
+    return charge_types, deltas
+
+
+def _branches(molecule):
+    if molecule.get('branches'):
+        return molecule['branches']
+    charge_types, deltas = _charge_models(molecule)
+    return resp2.required_branches(charge_types=charge_types, deltas=deltas)
+
+
+def esp_stage(molecule):
+    if molecule.get('sequential'):
+        return molecule
+    molecule['esp'] = {}
+    branches = _branches(molecule)
+    if molecule.get('esp_arrays'):
+        # The ESPs are calculated by the warm psi4 workers and kept in memory for the fit
+        molecule['esp_data'] = {}
+        for type in branches:
+            molecule['esp_data'][type] = resp2.calculate_esp_arrays(
+                type=type, name=molecule['name'], resname=molecule['resname'], pool=molecule['psi4_pool'],
+                number_of_conformers=molecule['number_of_conformers'], opt_folder=_folder(molecule),
+                preset=molecule.get('preset'))
+            molecule['esp'][type] = {i: data is not None for i, data in molecule['esp_data'][type].items()}
+            resp2.require_esp(molecule['esp'][type], type=type, name=molecule['name'])
+        return molecule
+    # The same steps as create_respyte without the fit, which is the next stage
+    pair = resp2.paired_branches(branches)
+    for type in sorted(branches, key=lambda type: type != 'RESP2LIQUID'):
+        molecule['esp'][type] = resp2.esp_respyte(type=type, name=molecule['name'], resname=molecule['resname'],
+                                                  number_of_conformers=molecule['number_of_conformers'],
+                                                  opt_folder=_folder(molecule), timeout=molecule.get('timeout'),
+                                                  pair=pair, preset=molecule.get('preset'))
+    return molecule
+
+
+def fit_stage(molecule):
+    if molecule.get('sequential'):
+        return molecule
+    for type in _branches(molecule):
+        if molecule.get('esp_arrays'):
+            resp2.fit_esp_arrays(type=type, name=molecule['name'], resname=molecule['resname'],
+                                 number_of_conformers=molecule['number_of_conformers'], opt_folder=_folder(molecule),
+                                 data=molecule.get('esp_data', {}).get(type))
+        else:
+            resp2.fit_respyte(type=type, name=molecule['name'], timeout=molecule.get('timeout'))
+    molecule.pop('esp_data', None)
+    return molecule
+
+
+def charge_stage(molecule):
+    charge_types, deltas = _charge_models(molecule)
+    for charge_type in charge_types:
+        for delta in deltas:
+            resp2.create_charge_file(name=molecule['name'], resname=molecule['resname'], type=charge_type, delta=delta)
+    molecule['charges'] = resp2.collect_charges(name=molecule['name'], resname=molecule['resname'],
+                                                charge_types=charge_types, deltas=deltas)
+    return molecule
+
+
+def charge_pipeline(workers=None, maxsize=2):
+    """
+    Builds the pipeline of the RESP2 charge calculation.
+
+    :param workers: Dictionary stage name -> number of workers. Missing stages use STAGE_WORKERS.
+    :param maxsize: Maximum number of molecules waiting in front of every stage.
+    :return: Pipeline
+    """
+    workers = dict(STAGE_WORKERS, **(workers or {}))
+    functions = [('conformers', conformer_stage), ('convert', convert_stage), ('optimization', optimization_stage),
+                 ('esp', esp_stage), ('fit', fit_stage), ('charges', charge_stage)]
+    return Pipeline([Stage(name, function, workers[name]) for name, function in functions], maxsize=maxsize)
+
+
+def iter_charges(molecules, workers=None, maxsize=2, **settings):
+    """
+    Calculates the charges of a batch of molecules and yields every molecule as soon as it is finished.
+
+    :param molecules: Iterable of molecule dictionaries (name, resname, smiles; optionally folder).
+    :param workers: Dictionary stage name -> number of workers.
+    :param maxsize: Maximum number of molecules waiting in front of every stage.
+    :param settings: Defaults for all molecules (see run_pipeline).
+    :return: Generator of (molecule, charges) in the order the molecules are finished. charges is the list
+             of resp2.collect_charges, or None if the molecule failed (the error is in molecule['error']).
+    """
+    items = (dict(settings, **molecule) for molecule in molecules)
+    for molecule in charge_pipeline(workers=workers, maxsize=maxsize).stream(items):
+        yield molecule, molecule.get('charges')
+
+
+async def iter_charges_async(molecules, workers=None, maxsize=2, **settings):
+    """
+    Asynchronous generator counterpart of iter_charges. The pipeline runs in its own threads.
+
+    :return: Asynchronous generator of (molecule, charges) in the order the molecules are finished.
+    """
+    loop = asyncio.get_running_loop()
+    finished = asyncio.Queue()
+
+    def produce():
+        try:
+            for item in iter_charges(molecules, workers=workers, maxsize=maxsize, **settings):
+                loop.call_soon_threadsafe(finished.put_nowait, item)
+        finally:
+            loop.call_soon_threadsafe(finished.put_nowait, _STOP)
+
+    threading.Thread(target=produce, name='resp2-iter-charges', daemon=True).start()
+    while True:
+        item = await finished.get()
+        if item is _STOP:
+            return
+        yield item
+
+
+def run_pipeline(molecules, workers=None, maxsize=2, status_file=None, **settings):
+    """
+    Calculates the charges of a batch of molecules with overlapping stages.
+    The progress is logged periodically and written to status_file (see progress).
+
+    :param molecules: List of molecule dictionaries (name, resname, smiles; optionally folder).
+    :param workers: Dictionary stage name -> number of workers.
+    :param maxsize: Maximum number of molecules waiting in front of every stage.
+    :param status_file: JSON file the progress is written to. default=None
+    :param settings: Defaults for all molecules, e.g. opt, timeout, charge_type, delta. By default only the
+                     branches required by charge_type and delta are calculated. psi4_pool (psi4pool.Psi4Pool)
+                     runs the optimizations of all molecules in one pool of warm psi4 workers. With
+                     esp_arrays=True the ESPs are calculated in the pool as well and fitted from memory
+                     instead of with respyte (see resp2.calculate_esp_arrays). preset selects the level of
+                     theory (see presets), preoptimize the force field the conformers are pre-optimized
+                     with and deduplicate=True removes duplicate conformers before and after the
+                     optimization (see conformers). With adaptive=True the number of conformers follows
+                     the flexibility of every molecule, qm_budget (core-hours) limits the conformers of
+                     the whole batch (see resp2.budget_conformers). With sequential=True the conformers
+                     are optimized and fitted one after the other (in psi4_pool, if given) until the charges
+                     change by less than tolerance (see resp2.sequential_charges); molecule['sequential'] records
+                     how many conformers were needed.
+    :return: List of molecule dictionaries. Failed molecules contain the key 'error'.
+    """
+    items = [dict(settings, **molecule) for molecule in molecules]
+    if items and settings.get('qm_budget') is not None:
+        charge_types, deltas = _charge_models(items[0])
+        counts = resp2.budget_conformers(items, budget=settings['qm_budget'], charge_types=charge_types,
+                                         deltas=deltas, preset=settings.get('preset'))
+        for item, count in zip(items, counts):
+            item.update(adaptive=True, max_conformers=count)
+    with progress.report(path=status_file):
+        return charge_pipeline(workers=workers, maxsize=maxsize).run(items)
@@ -0,0 +1,208 @@
+"""
+plan.py estimates the size of a charge calculation before it is started (dry run).
+
+Every job a run would launch is enumerated: omega conformer generation, the tiers of the psi4
+optimization of every conformer, the ESP calculations of the required branches, the respyte fits
+and, if a density is given, the gmx box generation of the liquid target. For every job the cores,
+core-hours, memory and scratch disk are estimated with the calibrated cost model (see cost.py) and
+the job sizes of resources.py. No external program is started.
+
+The number of conformers is only known after omega ran. If the conformer files do not exist yet,
+the maximum number omega generates (resp2.MAX_CONFORMERS) is assumed, so the plan is an upper bound.
+"""
+
+import json
+import os
+import sys
+
+try:
+    import resp2.resp2 as resp2
+    import resp2.cost as cost
+    import resp2.resources as resources
+    import resp2.presets as presets
+except ModuleNotFoundError:
+    import resp2
+    import cost
+    import resources
+    import presets
+
+# Core-seconds of the light jobs, which are not covered by the cost model
+OMEGA_COST = 30.0
+FIT_COST = 60.0
+# Core-seconds of one genbox insertion try per molecule
+GENBOX_COST = 1e-4
+
+COLUMNS = ['molecule', 'stage', 'conformer', 'program', 'threads', 'memory', 'core_hours', 'scratch']
+
+
+class PlannedJob(object):
+    """
+    A job a run would launch.
+
+    :param molecule: Name of the molecule.
+    :param stage: Name of the stage (e.g. conformers, optimization HF/6-31G*, RESP2LIQUID, fit RESP1, box).
+    :param conformer: Number of the conformer, 0 for jobs of the whole molecule.
+    :param program: External program running the job.
+    :param threads: Number of cores of the job.
+    :param memory: Memory in GB.
+    :param core_hours: Estimated cost in core-hours.
+    :param scratch: Scratch disk in GB.
+    """
+
+    def __init__(self, molecule, stage, conformer=0, program='', threads=1, memory=0.0, core_hours=0.0, scratch=0.0):
+        self.molecule = molecule
+        self.stage = stage
+        self.conformer = conformer
+        self.program = program
+        self.threads = threads
+        self.memory = memory
+        self.core_hours = core_hours
+        self.scratch = scratch
+
+    def as_dict(self):
+        return {column: getattr(self, column) for column in COLUMNS}
+
+    def __repr__(self):
+        return 'PlannedJob({} {} conformer {}: {:.2f} core-hours)'.format(self.molecule, self.stage, self.conformer,
+                                                                       self.core_hours)
+
+
+def _count_conformers(folder, resname):
+    number = 0
+    while os.path.isfile(os.path.join(folder, '{}-conformers_{}.mol2'.format(resname, number + 1))):
+        number += 1
+    return number
+
+
+def plan_molecule(name='', smiles=None, folder=None, resname='MOL', opt=True, charge_types=('RESP2',),
+                  deltas=(1.0,), number_of_conformers=None, density=None, nmol=700, tries=2000, cost_model=None,
+                  preset=None):
+    """
+    Enumerates the jobs of the charge calculation of one molecule (see create_RESP2).
+
+    :param name: Name of the molecule.
+    :param smiles: SMILES Code of the molecule. Used if {folder}/{resname}.mol2 does not exist.
+    :param folder: Folder of the molecule. default: {name}-liquid
+    :param resname: Abbreviation of the Residue.
+    :param opt: True when the conformers are optimized.
+    :param charge_types: Charge models to create (RESP1 and/or RESP2).
+    :param deltas: List of mixing parameters.
+    :param number_of_conformers: default: existing conformer files, otherwise resp2.MAX_CONFORMERS
+    :param density: Density in kg / m3. If given, the liquid box of the target is planned as well.
+    :param nmol: Number of molecules in the liquid box.
+    :param tries: Number of insertion tries of genbox.
+    :param cost_model: cost.CostModel. default: cost.get_cost_model()
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
+    :return: List of PlannedJobs
+    """
+    preset = presets.get_preset(preset)
+    if folder is None:
+        folder = name + '-liquid'
+    if cost_model is None:
+        cost_model = cost.get_cost_model()
+    structure = os.path.join(folder, resname + '.mol2')
+    if os.path.isfile(structure):
+        elements = cost.read_elements(structure)
+    elif smiles:
+        elements = cost.elements_from_smiles(smiles)
+    else:
+        raise ValueError('Neither {} nor a SMILES string for {} is available'.format(structure, name))
+    if number_of_conformers is None:
+        number_of_conformers = _count_conformers(folder, resname) or resp2.MAX_CONFORMERS
+    heavy_atoms = len([element for element in elements if element.upper() not in ('H', 'D')])
+    threads, memory = resources.psi4_job_requirements(heavy_atoms)
+
+    planned = [PlannedJob(name, 'conformers', 0, 'omega', core_hours=OMEGA_COST / 3600)]
+    if opt:
+        # Timings are recorded for the whole ladder, its estimate is split according to the tier estimates
+        total = cost_model.estimate_optimization(elements, preset.ladder)
+        tiers = [cost_model.estimate(elements, method, basis, jobtype='opt')
+                 for method, basis in preset.ladder]
+        for i in range(1, number_of_conformers + 1):
+            for (method, basis), tier in zip(preset.ladder, tiers):
+                planned.append(PlannedJob(name, 'optimization {}/{}'.format(method, basis), i, 'psi4', threads,
+                                          memory, total * tier / sum(tiers) / 3600,
+                                          cost.estimate_scratch(elements, basis)))
+            hessian = cost.hessian_step(preset.ladder, preset.hf_hessian)
+            if hessian is not None:
+                planned.append(PlannedJob(name, 'hessian {}/{}'.format(*hessian), i, 'psi4', threads, memory,
+                                          cost_model.estimate(elements, *hessian, jobtype='hessian') / 3600,
+                                          cost.estimate_scratch(elements, hessian[1])))
+    branches = resp2.required_branches(charge_types=charge_types, deltas=deltas)
+    pair = resp2.paired_branches(branches)
+    for type in branches:
+        basis = preset.esp_levels[type][1]
+        core_hours = cost_model.estimate_esp(elements, type, preset.esp_levels) / 3600
+        program = 'psi4'
+        if pair and type == 'RESP2LIQUID':
+            # The gas phase is converged in the same session first
+            core_hours += cost_model.estimate_esp(elements, 'RESP2GAS', preset.esp_levels) / 3600
+        elif pair and type == 'RESP2GAS':
+            core_hours, program = 0.0, 'cached'
+        for i in range(1, number_of_conformers + 1):
+            # respyte runs psi4 with its default settings: one thread and psi4's default memory
+            planned.append(PlannedJob(name, type, i, program, 1, 0.5, core_hours,
+                                      cost.estimate_scratch(elements, basis)))
+        planned.append(PlannedJob(name, 'fit ' + type, 0, 'respyte', core_hours=FIT_COST / 3600))
+    if density is not None:
+        # Several densities are tried if genbox fails; the plan assumes the first one works
+        planned.append(PlannedJob(name, 'box', 0, 'gmx', memory=0.5,
+                                  core_hours=GENBOX_COST * nmol * tries / 3600,
+                                  scratch=nmol * len(elements) * 81 / 1024 ** 3))
+    return planned
+
+
+def plan_molecules(molecules, **settings):
+    """
+    :param molecules: List of dictionaries with the keyword arguments of plan_molecule (at least name).
+    :param settings: Defaults for all molecules (see plan_molecule).
+    :return: List of PlannedJobs of all molecules.
+    """
+    planned = []
+    for molecule in molecules:
+        planned += plan_molecule(**dict(settings, **molecule))
+    return planned
+
+
+def summarize(planned):
+    """
+    :param planned: List of PlannedJobs.
+    :return: Dictionary with the number of jobs, the total core-hours, the peak memory and scratch disk
+             of a single job, and the core-hours per stage.
+    """
+    stages = {}
+    for job in planned:
+        stages[job.stage] = stages.get(job.stage, 0.0) + job.core_hours
+    return dict(jobs=len(planned), molecules=len(set(job.molecule for job in planned)),
+                core_hours=sum(job.core_hours for job in planned),
+                peak_memory=max([job.memory for job in planned] or [0.0]),
+                peak_scratch=max([job.scratch for job in planned] or [0.0]),
+                stages=stages)
+
+
+def to_json(planned):
+    """
+    :param planned: List of PlannedJobs.
+    :return: JSON string with the keys jobs (list of jobs) and summary (see summarize).
+    """
+    return json.dumps(dict(jobs=[job.as_dict() for job in planned], summary=summarize(planned)), indent=1)
+
+
+def write_table(planned, output=sys.stdout):
+    """
+    Prints the jobs of a plan and its totals as table.
+
+    :param planned: List of PlannedJobs.
+    :param output: File to write to.
+    :return: 0 if successful
+    """
+    output.write('{:<12} {:<32} {:>4} {:<8} {:>7} {:>8} {:>10} {:>9}\n'.format(
+        'molecule', 'stage', 'conf', 'program', 'threads', 'mem [GB]', 'core-hours', 'disk [GB]'))
+    for job in planned:
+        output.write('{:<12} {:<32} {:>4} {:<8} {:>7} {:>8.1f} {:>10.3f} {:>9.2f}\n'.format(
+            job.molecule, job.stage, job.conformer or '', job.program, job.threads, job.memory, job.core_hours,
+            job.scratch))
+    summary = summarize(planned)
+    output.write('{} jobs for {} molecules: {:.2f} core-hours, peak memory {:.1f} GB, peak scratch {:.2f} GB\n'.format(
+        summary['jobs'], summary['molecules'], summary['core_hours'], summary['peak_memory'], summary['peak_scratch']))
+    return 0
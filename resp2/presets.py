@@ -0,0 +1,83 @@
+"""
+presets.py defines named levels of theory for the charge calculations.
+
+- production: the published RESP2 protocol. HF/6-31G* (RESP1) and PW6B95/aug-cc-pV(D+d)Z with and without
+  PCM (RESP2) ESPs on conformers optimized with HF/6-31G*, HF/cc-pV(D+d)Z and PW6B95/cc-pV(D+d)Z.
+- screening: for large virtual libraries. Density-fitted SCF with looser thresholds, a two step
+  optimization with a loose convergence criterion and the ESPs with jun-cc-pV(D+d)Z, which has no
+  diffuse functions on hydrogen and none of d symmetry on the heavy atoms.
+
+The settings of a preset are passed as psi4 options wherever resp2 writes the psi4 input (optimizations,
+ESP arrays). respyte only takes method and basis; psi4 uses density fitting by default there.
+How close a preset comes to production is measured with compare.compare_presets.
+"""
+
+try:
+    import resp2.cost as cost
+except ModuleNotFoundError:
+    import cost
+
+
+class Preset(object):
+    """
+    A level of theory of the whole charge calculation.
+
+    :param name: Name of the preset.
+    :param esp_levels: Dictionary type -> (method, basis, pcm) of the ESP calculations (see cost.ESP_LEVELS).
+    :param ladder: List of (method, basis) optimization steps (see cost.OPTIMIZATION_LADDER).
+    :param scf_options: psi4 options of all SCF calculations.
+    :param optimization_options: Additional psi4 options of the optimizations.
+    :param description: One line description.
+    :param hf_hessian: True if the optimization steps after an HF first step start from an HF Hessian at its
+                       geometry instead of the guess Hessian of optking. The Hessian is an additional job
+                       (see cost.CostModel.estimate_optimization).
+    """
+
+    def __init__(self, name, esp_levels, ladder, scf_options=None, optimization_options=None, description='',
+                 hf_hessian=False):
+        self.name = name
+        self.esp_levels = dict(esp_levels)
+        self.ladder = list(ladder)
+        self.scf_options = dict(scf_options or {})
+        self.optimization_options = dict(optimization_options or {})
+        self.description = description
+        self.hf_hessian = hf_hessian
+
+    def options(self, optimization=False):
+        """
+        :param optimization: True for the options of the optimizations.
+        :return: Dictionary of psi4 options.
+        """
+        if optimization:
+            return dict(self.scf_options, **self.optimization_options)
+        return dict(self.scf_options)
+
+
+PRESETS = {
+    'production': Preset('production', cost.ESP_LEVELS, cost.OPTIMIZATION_LADDER,
+                         description='Published RESP2 protocol'),
+    'screening': Preset('screening',
+                        {'RESP1': ('HF', '6-31G*', False),
+                         'RESP2GAS': ('PW6B95', 'jun-cc-pV(D+d)Z', False),
+                         'RESP2LIQUID': ('PW6B95', 'jun-cc-pV(D+d)Z', True)},
+                        [('HF', '6-31G*'), ('PW6B95', 'cc-pV(D+d)Z')],
+                        scf_options={'scf_type': 'df', 'e_convergence': 1e-5, 'd_convergence': 1e-5},
+                        optimization_options={'g_convergence': 'gau_loose'},
+                        description='Density fitting, two step optimization, smaller ESP basis'),
+}
+
+DEFAULT = 'production'
+
+
+def get_preset(preset=None):
+    """
+    :param preset: Name of a preset, a Preset or None (production).
+    :return: Preset
+    """
+    if preset is None:
+        preset = DEFAULT
+    if isinstance(preset, Preset):
+        return preset
+    if preset not in PRESETS:
+        raise ValueError('Unknown preset {}. Use one of {}.'.format(preset, ', '.join(sorted(PRESETS))))
+    return PRESETS[preset]
@@ -0,0 +1,288 @@
+"""
+progress.py reports the progress of charge calculations.
+
+The stages (conformer optimization, ESP branches, ...) announce their jobs to a Tracker when they are
+queued, started and finished, together with the estimated cost of every job (see cost.CostModel).
+From this the tracker derives:
+
+- the number of queued, running, done and failed jobs per stage,
+- the throughput per stage in jobs per hour over a rolling window,
+- an ETA: the estimated cost of the remaining jobs divided by the rate at which estimated cost has
+  been finished so far. The rate is measured on finished jobs, so it calibrates the cost model to
+  the speed and parallelism of the current run.
+
+A Reporter writes the snapshot periodically as JSON to a status file and logs a one line summary:
+
+    with progress.report('status.json', interval=30):
+        create_RESP2(...)
+
+Every process has its own tracker (get_tracker). Stages run by other processes (a process pool or the
+workers of a shared task queue) are wrapped with Forwarded: the worker appends the events of its tracker
+to its own file in a journal folder, which the reporter of the parent replays into the parent's tracker
+before every update. The journal folder has to be on a filesystem the workers can write to.
+"""
+
+import collections
+import glob
+import json
+import logging as log
+import os
+import socket
+import threading
+import time
+
+# Window of the throughput in seconds
+WINDOW = 3600.0
+
+
+class Tracker(object):
+    """
+    Thread-safe counters of the jobs of a run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Journal file the events are appended to in a worker process (see Forwarded)
+        self.journal = None
+        self._offsets = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.stages = collections.OrderedDict()
+            self._finished = collections.deque()
+            self._finished_cost = 0.0
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = dict(queued=0, running=0, done=0, failed=0, remaining_cost=0.0)
+        return self.stages[stage]
+
+    def _record(self, event, **values):
+        if self.journal is None:
+            return
+        with self._lock:
+            with open(self.journal, 'a') as f:
+                f.write(json.dumps(dict(values, event=event)) + '\n')
+
+    def add(self, stage, n=1, cost=0.0):
+        """
+        Announces n queued jobs of a stage with an estimated cost (core-seconds) per job.
+        """
+        self._record('add', stage=stage, n=n, cost=cost)
+        with self._lock:
+            counts = self._stage(stage)
+            counts['queued'] += n
+            counts['remaining_cost'] += n * cost
+        return 0
+
+    def start(self, stage, n=1):
+        """
+        Marks n queued jobs of a stage as running.
+        """
+        self._record('start', stage=stage, n=n)
+        with self._lock:
+            counts = self._stage(stage)
+            counts['queued'] = max(counts['queued'] - n, 0)
+            counts['running'] += n
+        return 0
+
+    def finish(self, stage, n=1, success=True, cost=0.0):
+        """
+        Marks n running jobs of a stage as done (or failed).
+
+        :param cost: Estimated cost of every job, as announced in add.
+        """
+        self._record('finish', stage=stage, n=n, success=success, cost=cost)
+        now = time.time()
+        with self._lock:
+            counts = self._stage(stage)
+            counts['running'] = max(counts['running'] - n, 0)
+            counts['done' if success else 'failed'] += n
+            counts['remaining_cost'] = max(counts['remaining_cost'] - n * cost, 0.0)
+            self._finished_cost += n * cost
+            for _ in range(n):
+                self._finished.append((now, stage))
+        return 0
+
+    def follow(self, journal):
+        """
+        Applies the events which worker processes appended to the files in the journal folder since the
+        last call (see Forwarded).
+
+        :param journal: Journal folder.
+        :return: Number of applied events.
+        """
+        applied = 0
+        for path in sorted(glob.glob(os.path.join(journal, '*.jsonl'))):
+            offset = self._offsets.get(path, 0)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+            # A line which is still being written is applied with the next call
+            data = data[:data.rfind(b'\n') + 1]
+            self._offsets[path] = offset + len(data)
+            for line in data.decode().splitlines():
+                event = json.loads(line)
+                getattr(self, event.pop('event'))(**event)
+                applied += 1
+        return applied
+
+    def snapshot(self):
+        """
+        :return: Dictionary with the counts and throughput (jobs per hour) per stage, the elapsed time
+                 and the ETA in seconds (None until the first job with a cost estimate finished).
+        """
+        now = time.time()
+        with self._lock:
+            while self._finished and self._finished[0][0] < now - WINDOW:
+                self._finished.popleft()
+            window = min(WINDOW, max(now - self.started, 1.0))
+            throughput = collections.Counter(stage for _, stage in self._finished)
+            stages = {}
+            for stage, counts in self.stages.items():
+                stages[stage] = dict(counts, per_hour=throughput[stage] * 3600.0 / window)
+            remaining = sum(counts['remaining_cost'] for counts in self.stages.values())
+            elapsed = now - self.started
+            eta = None
+            if self._finished_cost > 0:
+                eta = remaining / (self._finished_cost / elapsed)
+        return dict(time=now, elapsed=elapsed, eta=eta, stages=stages)
+
+
+def format_snapshot(snapshot):
+    """
+    :param snapshot: Dictionary of Tracker.snapshot
+    :return: One line summary, e.g. 'optimization 3/5 done (1 running, 2.1/h) | ETA 00:12:30'
+    """
+    parts = []
+    for stage, counts in snapshot['stages'].items():
+        total = counts['queued'] + counts['running'] + counts['done'] + counts['failed']
+        text = '{} {}/{} done ({} running, {:.1f}/h)'.format(stage, counts['done'], total, counts['running'],
+                                                             counts['per_hour'])
+        if counts['failed']:
+            text += ' {} failed'.format(counts['failed'])
+        parts.append(text)
+    eta = snapshot['eta']
+    if eta is None:
+        parts.append('ETA unknown')
+    elif eta < 86400:
+        parts.append('ETA ' + time.strftime('%H:%M:%S', time.gmtime(eta)))
+    else:
+        parts.append('ETA {:.1f} days'.format(eta / 86400))
+    return ' | '.join(parts)
+
+
+class Reporter(object):
+    """
+    Writes the snapshot of a tracker periodically to a status file and to the log.
+
+    :param tracker: Tracker, or any object with a snapshot method. default: get_tracker()
+    :param path: JSON status file, replaced atomically on every update. default=None (log only)
+    :param interval: Seconds between updates.
+    :param journal: Journal folder of forwarded stages, replayed into the tracker before every update.
+    """
+
+    def __init__(self, tracker=None, path=None, interval=30.0, journal=None):
+        self.tracker = tracker or get_tracker()
+        self.path = path
+        self.interval = interval
+        self.journal = journal
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        if self.journal is not None:
+            self.tracker.follow(self.journal)
+        snapshot = self.tracker.snapshot()
+        log.info('Progress: ' + format_snapshot(snapshot))
+        if self.path is not None:
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(snapshot, f, indent=1)
+            os.replace(tmp, self.path)
+        return snapshot
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                log.warning('Could not write status file {}: {}'.format(self.path, e))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='resp2-progress', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the reporter and writes a final update.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+        return 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def report(path=None, interval=30.0):
+    """
+    :return: Reporter of the tracker of this process, to be used as context manager.
+    """
+    return Reporter(path=path, interval=interval)
+
+
+def process_name():
+    """
+    :return: Name of the current process, unique across the hosts of a shared task queue.
+    """
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class Forwarded(object):
+    """
+    A function whose tracker events reach the tracker of the process which wrapped it. If the function
+    runs in another process, the events of the tracker of that process are appended to a file in the
+    journal folder while it runs (see Reporter). Picklable, so it can be run by any executor.
+
+    :param function: Module level function, e.g. of a scheduler task.
+    :param journal: Journal folder.
+    """
+
+    def __init__(self, function, journal):
+        self.function = function
+        self.journal = journal
+        self.parent = process_name()
+
+    def __call__(self, *args, **kwargs):
+        if process_name() == self.parent:
+            return self.function(*args, **kwargs)
+        tracker = get_tracker()
+        tracker.journal = os.path.join(self.journal, process_name() + '.jsonl')
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            tracker.journal = None
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_tracker():
+    """
+    :return: The Tracker of this process.
+    """
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = Tracker()
+    return _tracker
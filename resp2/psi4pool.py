@@ -0,0 +1,301 @@
+"""
+psi4pool.py runs psi4 calculations in a pool of long-lived worker processes.
+
+Every worker imports psi4 once and then runs many calculations through psi4's Python API, so the
+startup of the interpreter and of psi4 is paid once per worker instead of once per conformer. The
+workers run in separate processes because psi4 keeps global state (options, scratch files) and is
+not thread-safe; the state is cleaned after every task.
+
+The backend is pluggable. Psi4Backend uses psi4, FakeBackend returns deterministic results without
+any QM and is used to test scheduling and result handling where psi4 is not installed:
+
+    with Psi4Pool(nworkers=4, threads=2, memory=4.0) as pool:
+        futures = [pool.submit(Psi4Task('optimize', geometry, xyz_file=path)) for geometry, path in ...]
+        results = [future.result() for future in futures]
+"""
+
+import concurrent.futures
+import logging as log
+import os
+import time
+
+import numpy as np
+
+try:
+    from resp2.cost import OPTIMIZATION_LADDER
+    import resp2.esp as esp
+except ModuleNotFoundError:
+    from cost import OPTIMIZATION_LADDER
+    import esp
+
+
+class Psi4Task(object):
+    """
+    A psi4 calculation.
+
+    :param kind: 'optimize' (the levels of ladder one after the other), 'energy' (single point at ladder[0]) or
+                 'esp' (single point at ladder[0] and the ESP on grid)
+    :param geometry: List of xyz lines (symbol x y z) in Angstrom.
+    :param ladder: List of (method, basis). default: cost.OPTIMIZATION_LADDER
+    :param charge: Total charge.
+    :param multiplicity: Spin multiplicity.
+    :param options: Dictionary of additional psi4 options (e.g. from retry.ESCALATIONS).
+    :param output: psi4 output file. default=None (no output file)
+    :param xyz_file: Path the final geometry is written to. default=None
+    :param checkpoints: Paths the geometries after all but the last step of an optimization are written to.
+    :param reuse: Every optimization step starts from the orbitals of the previous step
+                  (see resp2.optimization_input).
+    :param hessian: The steps after an HF first step start from its HF Hessian (see presets.Preset).
+    :param grid: m x 3 array of points in Angstrom the ESP is evaluated on (kind 'esp').
+    :param field: True if the electric field is evaluated on the grid as well (kind 'esp').
+    :param pcm: psi4 pcm block (see esp.PCM_WATER). default=None (gas phase)
+    :param memory: Memory in GB. default=None (the memory of the pool)
+    :param name: Name used in log messages.
+    :param cost: Estimated cost in core-seconds (see cost.CostModel).
+    """
+
+    def __init__(self, kind, geometry, ladder=None, charge=0, multiplicity=1, options=None, output=None,
+                 xyz_file=None, checkpoints=(), reuse=True, hessian=False, grid=None, field=False, pcm=None, memory=None,
+                 name='', cost=0.0):
+        self.kind = kind
+        self.geometry = list(geometry)
+        self.ladder = list(ladder if ladder is not None else OPTIMIZATION_LADDER)
+        self.charge = charge
+        self.multiplicity = multiplicity
+        self.options = dict(options or {})
+        self.output = output
+        self.xyz_file = xyz_file
+        self.checkpoints = list(checkpoints)
+        self.reuse = reuse
+        self.hessian = hessian
+        self.grid = grid
+        self.field = field
+        self.pcm = pcm
+        self.memory = memory
+        self.name = name
+        self.cost = cost
+
+
+class Psi4Result(object):
+    """
+    Outcome of a Psi4Task.
+
+    :param job: The Psi4Task.
+    :param success: True if all steps converged.
+    :param energy: Final energy in Hartree.
+    :param geometry: Final (or, after a failure, last) geometry as list of xyz lines.
+    :param elapsed: Wall-clock time in seconds.
+    :param error: Description of the failure.
+    :param esp: ESP on the grid of the task in Hartree / e (kind 'esp').
+    :param field: m x 3 array of the electric field on the grid in Hartree / (e Bohr), if requested.
+    """
+
+    def __init__(self, job=None, success=False, energy=None, geometry=None, elapsed=0.0, error=None, esp=None,
+                 field=None):
+        self.job = job
+        self.success = success
+        self.energy = energy
+        self.geometry = geometry
+        self.elapsed = elapsed
+        self.error = error
+        self.esp = esp
+        self.field = field
+
+
+def write_xyz(path, geometry, comment=''):
+    """
+    Writes a list of xyz lines as xyz file.
+    """
+    f = open(path, 'w')
+    f.write('{}\n{}\n'.format(len(geometry), comment))
+    for line in geometry:
+        f.write(line if line.endswith('\n') else line + '\n')
+    f.close()
+    return 0
+
+
+class Psi4Backend(object):
+    """
+    Runs tasks with psi4's Python API. psi4 is imported when the worker starts.
+
+    :param threads: Number of threads of every calculation.
+    :param memory: Memory of every calculation in GB.
+    """
+
+    def __init__(self, threads=1, memory=2.0):
+        import psi4
+        self.psi4 = psi4
+        self.threads = threads
+        self.memory = memory
+
+    def run(self, task):
+        psi4 = self.psi4
+        psi4.core.be_quiet()
+        if task.output is not None:
+            psi4.core.set_output_file(task.output, False)
+        psi4.set_memory('{:g} GB'.format(task.memory or self.memory))
+        psi4.set_num_threads(self.threads)
+        molecule = psi4.geometry('{} {}\n{}noreorient\nnocom\n'.format(task.charge, task.multiplicity,
+                                                                       ''.join(task.geometry)))
+        energy = values = field = None
+        try:
+            if task.kind == 'optimize':
+                energy = self._optimize(task, molecule)
+            elif task.kind == 'esp':
+                energy, values, field = self._esp(task, molecule)
+            else:
+                method, basis = task.ladder[0]
+                psi4.set_options(dict(task.options, basis=basis))
+                energy = psi4.energy(method, molecule=molecule)
+            success, error = True, None
+        except Exception as e:
+            success, error = False, repr(e)
+        geometry = [line + '\n' for line in molecule.save_string_xyz().splitlines()[1:] if line.split()]
+        psi4.core.clean()
+        psi4.core.clean_options()
+        return Psi4Result(success=success, energy=energy, geometry=geometry, error=error, esp=values, field=field)
+
+    def _optimize(self, task, molecule):
+        psi4 = self.psi4
+        ladder = task.ladder
+        for k, (method, basis) in enumerate(ladder):
+            options = dict(task.options, basis=basis)
+            if task.reuse and k > 0:
+                options['guess'] = 'read'
+                # The Hessian is at the geometry of the first step (see resp2.optimization_input)
+                if task.hessian and ladder[0][0] == 'HF':
+                    options['cart_hess_read'] = k == 1
+            psi4.set_options(options)
+            energy, wfn = psi4.optimize(method, molecule=molecule, return_wfn=True)
+            if k < len(ladder) - 1:
+                if k < len(task.checkpoints):
+                    molecule.save_xyz_file(task.checkpoints[k], True)
+                if task.reuse:
+                    wfn.to_file(wfn.get_scratch_filename(180))
+                if task.reuse and task.hessian and k == 0 and method == 'HF':
+                    psi4.set_options({'hessian_write': True})
+                    psi4.hessian('HF', molecule=molecule)
+        return energy
+
+    def _esp(self, task, molecule):
+        psi4 = self.psi4
+        method, basis = task.ladder[0]
+        options = dict(task.options, basis=basis)
+        if task.pcm:
+            options.update(pcm=True, pcm_scf_type='total')
+            psi4.pcm_helper(task.pcm)
+        psi4.set_options(options)
+        energy, wfn = psi4.energy(method, molecule=molecule, return_wfn=True)
+        calculator = psi4.core.ESPPropCalc(wfn)
+        # The points are passed in Bohr
+        points = psi4.core.Matrix.from_array(np.asarray(task.grid, dtype=float) / esp.BOHR)
+        values = np.array(calculator.compute_esp_over_grid_in_memory(points)).ravel()
+        field = np.array(calculator.compute_field_over_grid_in_memory(points)) if task.field else None
+        return energy, values, field
+
+
+class FakeBackend(object):
+    """
+    Backend without QM. The geometry is returned unchanged, the energy is minus the number of atoms and the ESP
+    is the one of fixed point charges on the atoms.
+
+    :param threads: Ignored.
+    :param memory: Ignored.
+    :param duration: Seconds every task takes.
+    :param charges: Point charges of the atoms. default=None (all zero)
+    :param fail: Names of tasks which fail after the first optimization step (unless the option guess is
+                 set, like in an escalated retry).
+    """
+
+    def __init__(self, threads=1, memory=2.0, duration=0.0, fail=(), charges=None):
+        self.duration = duration
+        self.fail = set(fail)
+        self.charges = charges
+
+    def run(self, task):
+        time.sleep(self.duration)
+        if task.name in self.fail and 'guess' not in task.options:
+            if task.kind == 'optimize' and task.checkpoints:
+                write_xyz(task.checkpoints[0], task.geometry, comment=task.name)
+            return Psi4Result(success=False, geometry=task.geometry, error='SCF did not converge')
+        for checkpoint in task.checkpoints if task.kind == 'optimize' else []:
+            write_xyz(checkpoint, task.geometry, comment=task.name)
+        values = field = None
+        if task.kind == 'esp':
+            coordinates = np.array([[float(x) for x in line.split()[1:4]] for line in task.geometry])
+            charges = np.zeros(len(coordinates)) if self.charges is None else np.asarray(self.charges)
+            values = esp.coulomb_matrix(coordinates, task.grid) @ charges
+            field = np.zeros((len(values), 3)) if task.field else None
+        return Psi4Result(success=True, energy=-float(len(task.geometry)), geometry=task.geometry, esp=values,
+                          field=field)
+
+
+BACKENDS = {'psi4': Psi4Backend, 'fake': FakeBackend}
+
+_backend = None
+
+
+def _init_worker(backend, kwargs):
+    global _backend
+    _backend = BACKENDS.get(backend, backend)(**kwargs)
+
+
+def _run_task(task):
+    t0 = time.time()
+    try:
+        result = _backend.run(task)
+    except Exception as e:
+        result = Psi4Result(success=False, geometry=task.geometry, error=repr(e))
+    result.job = task
+    result.elapsed = time.time() - t0
+    if result.success and task.xyz_file is not None:
+        write_xyz(task.xyz_file, result.geometry, comment=task.name)
+    log.info('psi4 task {} {} in worker {} after {:.1f} s'.format(task.name, 'finished' if result.success else
+                                                                   'FAILED', os.getpid(), result.elapsed))
+    return result
+
+
+class Psi4Pool(object):
+    """
+    Pool of warm psi4 worker processes.
+
+    :param nworkers: Number of worker processes.
+    :param backend: 'psi4', 'fake' or a backend class with a run(task) method.
+    :param threads: Threads of every calculation.
+    :param memory: Memory of every calculation in GB.
+    :param backend_options: Further keyword arguments of the backend (e.g. duration of FakeBackend).
+    """
+
+    def __init__(self, nworkers=1, backend='psi4', threads=1, memory=2.0, **backend_options):
+        self.nworkers = nworkers
+        self.threads = threads
+        self.memory = memory
+        # Only the timings of real psi4 calculations are recorded for the cost model
+        self.records_timings = BACKENDS.get(backend, backend) is Psi4Backend
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=nworkers, initializer=_init_worker,
+            initargs=(backend, dict(backend_options, threads=threads, memory=memory)))
+
+    def submit(self, task):
+        """
+        :param task: Psi4Task
+        :return: concurrent.futures.Future with a Psi4Result
+        """
+        return self._executor.submit(_run_task, task)
+
+    def run(self, tasks):
+        """
+        :param tasks: List of Psi4Tasks.
+        :return: List of Psi4Results in the order of the tasks.
+        """
+        return [future.result() for future in [self.submit(task) for task in tasks]]
+
+    def shutdown(self):
+        self._executor.shutdown()
+        return 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
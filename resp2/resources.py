@@ -0,0 +1,155 @@
+"""
+resources.py decides how psi4 jobs are sized and placed on the host.
+
+The host's cores and memory are read once, minus a configurable reservation for the operating
+system and other programs. From the size of the molecule the threads and memory one psi4 job
+should get are estimated, and from both the number of jobs which can run at the same time.
+Every concurrent job gets a disjoint set of CPUs it is pinned to.
+
+The reservation can be set with the environment variables RESP2_RESERVE_CORES and
+RESP2_RESERVE_MEMORY (in GB) or with the arguments of detect_host_resources.
+"""
+
+import logging as log
+import os
+
+
+class HostResources(object):
+    """
+    Cores and memory available for QM jobs.
+
+    :param cpus: List of CPU ids jobs may run on.
+    :param memory: Memory in GB available for jobs.
+    """
+
+    def __init__(self, cpus, memory):
+        self.cpus = list(cpus)
+        self.memory = memory
+
+    @property
+    def ncores(self):
+        return len(self.cpus)
+
+    def __repr__(self):
+        return 'HostResources(ncores={}, memory={:.1f} GB)'.format(self.ncores, self.memory)
+
+
+class JobSlot(object):
+    """
+    Resources of one concurrently running job.
+
+    :param threads: Number of threads (psi4 -n).
+    :param memory: Memory in GB (psi4 memory keyword).
+    :param cpus: CPU ids the job is pinned to.
+    """
+
+    def __init__(self, threads, memory, cpus):
+        self.threads = threads
+        self.memory = memory
+        self.cpus = list(cpus)
+
+    def __repr__(self):
+        return 'JobSlot(threads={}, memory={} GB, cpus={})'.format(self.threads, self.memory, self.cpus)
+
+
+def _total_memory():
+    """
+    :return: Physical memory of the host in GB.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+    except (ValueError, OSError, AttributeError):
+        pass
+    try:
+        for line in open('/proc/meminfo'):
+            if line.startswith('MemTotal'):
+                return int(line.split()[1]) / 1024 ** 2
+    except OSError:
+        pass
+    log.warning('Could not determine the memory of the host. Assume 8 GB.')
+    return 8.0
+
+
+def detect_host_resources(reserve_cores=None, reserve_memory=None):
+    """
+    Reads the cores (respecting the CPU affinity of this process) and the memory of the host.
+
+    :param reserve_cores: Number of cores not used for jobs. default: RESP2_RESERVE_CORES or 0
+    :param reserve_memory: Memory in GB not used for jobs. default: RESP2_RESERVE_MEMORY or 2.0
+    :return: HostResources
+    """
+    if reserve_cores is None:
+        reserve_cores = int(os.environ.get('RESP2_RESERVE_CORES', 0))
+    if reserve_memory is None:
+        reserve_memory = float(os.environ.get('RESP2_RESERVE_MEMORY', 2.0))
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = list(range(os.cpu_count() or 1))
+    # Reserved cores are taken from the beginning, where the operating system usually runs
+    cpus = cpus[min(reserve_cores, len(cpus) - 1):]
+    memory = max(_total_memory() - reserve_memory, 1.0)
+    return HostResources(cpus, memory)
+
+
+def count_heavy_atoms(xyz_file):
+    """
+    Counts the non-hydrogen atoms in a xyz file.
+
+    :param xyz_file: Path to the xyz file.
+    :return: Number of heavy atoms.
+    """
+    lines = open(xyz_file).readlines()[2:]
+    return len([line for line in lines if line.split() and line.split()[0].upper() not in ('H', 'D')])
+
+
+def psi4_job_requirements(heavy_atoms):
+    """
+    Estimates the threads and memory a psi4 job on a molecule of this size can use efficiently.
+    Small molecules do not scale beyond a few threads; the memory mainly grows with the number
+    of basis functions.
+
+    :param heavy_atoms: Number of heavy atoms of the molecule.
+    :return: (threads, memory in GB)
+    """
+    threads = min(max(1, (heavy_atoms + 2) // 3), 16)
+    memory = max(2.0, 0.5 * heavy_atoms)
+    return threads, memory
+
+
+def plan_psi4_jobs(heavy_atoms, njobs=None, nthreads=None, memory=None, host=None):
+    """
+    Sizes the psi4 jobs for one molecule.
+
+    The number of concurrent jobs is limited by the cores, the memory and njobs. Cores which are left
+    over are distributed to the jobs, so that jobs x threads fills the host.
+
+    :param heavy_atoms: Number of heavy atoms of the molecule.
+    :param njobs: Maximum number of concurrent jobs (usually the number of conformers). default: no limit
+    :param nthreads: Threads per job. default: estimated from the molecule size
+    :param memory: Memory per job in GB. default: estimated from the molecule size
+    :param host: HostResources. default: detect_host_resources()
+    :return: List of JobSlots, one per concurrently running job.
+    """
+    if host is None:
+        host = detect_host_resources()
+    threads_wanted, memory_wanted = psi4_job_requirements(heavy_atoms)
+    if nthreads is not None:
+        threads_wanted = nthreads
+    if memory is not None:
+        memory_wanted = memory
+    threads_wanted = max(1, min(threads_wanted, host.ncores))
+
+    nslots = min(host.ncores // threads_wanted, max(1, int(host.memory // memory_wanted)))
+    if njobs is not None:
+        nslots = min(nslots, njobs)
+    nslots = max(nslots, 1)
+
+    threads = threads_wanted if nthreads is not None else host.ncores // nslots
+    if memory is None:
+        # psi4 profits from more memory, so the job gets its share of the host
+        memory = max(memory_wanted, int(host.memory / nslots * 2) / 2.0)
+        memory = min(memory, host.memory)
+    slots = [JobSlot(threads, memory, host.cpus[k * threads:(k + 1) * threads]) for k in range(nslots)]
+    log.info('psi4 jobs for {} heavy atoms on {}: {}'.format(heavy_atoms, host, slots))
+    return slots
@@ -21,8 +21,34 @@ import logging as log
 
 try:
     import resp2.create_mol2_pdb as create_mol2_pdb
+    import resp2.scheduler as scheduler
+    import resp2.jobs as jobs
+    import resp2.resources as resources
+    import resp2.cost as cost
+    import resp2.manifest as manifest
+    import resp2.plan as plan
+    import resp2.retry as retry
+    import resp2.progress as progress
+    import resp2.psi4pool as psi4pool
+    import resp2.esppair as esppair
+    import resp2.esp as esp
+    import resp2.presets as presets
+    import resp2.conformers as conformers
 except ModuleNotFoundError:
     import create_mol2_pdb
+    import scheduler
+    import jobs
+    import resources
+    import cost
+    import manifest
+    import plan
+    import retry
+    import progress
+    import psi4pool
+    import esppair
+    import esp
+    import presets
+    import conformers
 try:
     import pybel
     import openbabel
@@ -30,6 +56,24 @@ except ModuleNotFoundError:
     print('Could not import pybel')
 import shutil
 import glob
+import signal
+import tempfile
+import asyncio
+import functools
+import json
+import numpy as np
+
+# Location of the respyte scripts (esp_generator.py and resp_optimizer.py)
+RESPYTE_PATH = os.environ.get('RESPYTE_PATH', os.path.expanduser('~/programs/respyte/respyte'))
+
+# Maximum number of conformers omega generates per molecule
+MAX_CONFORMERS = 5
+
+# Largest change of a charge in e after which sequential_charges stops adding conformers
+CHARGE_TOLERANCE = 0.01
+
+# Role of the branches in combined gas phase / PCM psi4 sessions (see esppair)
+PAIR_MODES = {'RESP2LIQUID': 'pair', 'RESP2GAS': 'cached'}
 
 
 ### Local functions
@@ -50,14 +94,13 @@ def create_fb_input(name='', targets=[], forcefield='smirnoff99Frosst.offxml', p
     :param convergence: <tight> or <loose> convergence criteria.
     :return: 0 if succesful.
     """
-    cwdir = os.getcwd()
-    if os.path.isdir('targets') == True:
-        os.chdir('targets')
-    output = open(name, 'w')
+    # The input file is written next to the targets
+    target_folder = 'targets' if os.path.isdir('targets') else ''
+    output = open(os.path.join(target_folder, name), 'w')
     create_fb_input_header(output=output, port=port, type=type, forcefield=forcefield, mol2_files=mol2_files,
                            convergence=convergence)
     for ele in targets:
-        abb = os.path.basename(glob.glob('{}-liquid/*box.pdb'.format(ele))[0])
+        abb = os.path.basename(glob.glob(os.path.join(target_folder, '{}-liquid/*box.pdb'.format(ele)))[0])
         abb = abb.split('-')[0]
         output.write('''
 
@@ -77,7 +120,8 @@ gas_prod_steps     20000000
 gas_timestep 0.5
 $end
 '''.format(ele, abb, abb))
-    os.chdir(cwdir)
+    output.close()
+    return 0
 
 
 def create_fb_input_header(output=None, port='3333', type='single', forcefield='smirnoff99Frosst.offxml', mol2_files=[],
@@ -193,7 +237,8 @@ Global,use_cni,FALSE,,,,
     return 0
 
 
-def create_target(smiles='', name='', folder=None, density=None, hov=None, dielectric=None, resname='MOL', nmol=700, tries=2000):
+def create_target(smiles='', name='', folder=None, density=None, hov=None, dielectric=None, resname='MOL', nmol=700, tries=2000,
+                  timeout=None):
     """
     This functions creates a target including folder structure mol2 files and the data.csv file.
     Charges are done separate.
@@ -207,6 +252,7 @@ def create_target(smiles='', name='', folder=None, density=None, hov=None, diele
     :param resname: Abbreviation of the Residue. Specified in the mol2
     :param nmol: Number of molecules in the liquid simulation box.
     :param tries: Number of tries to create the liquid simulation box. For bulky molecules higher values are necessary.
+    :param timeout: Wall-clock limit in seconds for every genbox call. default=None
     :return:
     """
     # Check if folder is specified. If not than use standard folder
@@ -217,21 +263,20 @@ def create_target(smiles='', name='', folder=None, density=None, hov=None, diele
     except Exception:
         log.warning('folder {} already exists'.format(folder))
     create_std_target_file(name=name, folder = folder, density=density, hov=hov, dielectric=dielectric)
-    create_smifile_from_string(smiles=smiles, filename=os.path.join(folder, resname + '.smi'))
-    cwd = os.getcwd()
-    os.chdir(folder)
+    smifile = os.path.join(folder, resname + '.smi')
+    create_smifile_from_string(smiles=smiles, filename=smifile)
+    # All files are written next to the smi file, the working directory is not changed.
     # try except is necessary for really bulky molecules.
     try:
         create_mol2_pdb.run_create_mol2_pdb(nmol=nmol, density=density - 250, tries=tries,
-                                            input= resname + '.smi', resname=resname)
+                                            input=smifile, resname=resname, timeout=timeout)
     except Exception:
         try:
             create_mol2_pdb.run_create_mol2_pdb(nmol=nmol, density=density - 350, tries=tries,
-                                                input=resname + '.smi', resname=resname)
+                                                input=smifile, resname=resname, timeout=timeout)
         except Exception:
             create_mol2_pdb.run_create_mol2_pdb(nmol=nmol, density=density - 400, tries=tries,
-                                                input= resname + '.smi', resname=resname)
-    os.chdir(cwd)
+                                                input=smifile, resname=resname, timeout=timeout)
     return 0
 
 
@@ -252,7 +297,30 @@ def create_smifile_from_string(smiles='', filename=''):
 
 ### RESP2 functions. Ordered in sequence of expected use.
 
-def create_conformers(infile=None, outfile=None, resname=None, folder= None, name = None):
+def create_structure(smi=None, folder='', resname='MOL'):
+    """
+    Makes sure the input structure {resname}.mol2 exists in folder. If it is missing, a 3D structure is
+    created from the SMILES string with openbabel.
+
+    :param smi: SMILES Code of the molecule.
+    :param folder: Name of the folder for the target.
+    :param resname: Abbreviation of the Residue. Specified in the mol2
+    :return: Path to the mol2 file
+    """
+    infile_path = os.path.join(folder, '{}.mol2'.format(resname))
+    if not os.path.isfile(infile_path):
+        log.warning('Could not find file: {}'.format(infile_path))
+        if smi is not None:
+            log.warning('Create molecule from SMILES string')
+            mymol = pybel.readstring("smi", smi)
+            mymol.addh()
+            mymol.make3D()
+            mymol.write(format='mol2',filename=infile_path, overwrite=True)
+    return infile_path
+
+
+def create_conformers(infile=None, outfile=None, resname=None, folder= None, name = None, preoptimize=None,
+                      window=conformers.PREOPT_WINDOW, deduplicate=False, adaptive=False, max_conformers=None):
 
     """
     This function takes a mol1 file and runs Openeye's omega to create conformers for the molecules
@@ -262,6 +330,14 @@ def create_conformers(infile=None, outfile=None, resname=None, folder= None, nam
     :param outfile: Path to output file return
     :param folder: Name of the folder for the target. If not specified. {name}-liquid is used.
     :param resname: Abbreviation of the Residue. Specified in the mol2
+    :param preoptimize: Force field (e.g. MMFF94) the conformers are relaxed, ranked and screened with before
+                        the QM optimization (see conformers.preoptimize_conformers). default=None (omega conformers)
+    :param window: Energy window in kcal/mol of the pre-optimized conformers.
+    :param deduplicate: Remove conformers which are the same structure (see conformers.unique_conformers).
+    :param adaptive: Choose the number of conformers and the RMS range from the flexibility of the molecule
+                     (see conformers.conformer_policy) instead of MAX_CONFORMERS. default=False
+    :param max_conformers: Upper limit of the number of conformers, e.g. from the QM budget of a batch
+                           (see budget_conformers). default=None (MAX_CONFORMERS, or the adaptive limit)
     :return: Number of conformers for this molecule
     """
     if folder is None and name is None:
@@ -282,15 +358,24 @@ def create_conformers(infile=None, outfile=None, resname=None, folder= None, nam
     if not oechem.OEIs2DFormat(ofs.GetFormat()):
         oechem.OEThrow.Fatal("Invalid output file format for 2D coordinates!")
 
+    number, rms_range = MAX_CONFORMERS, [0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5]
+    if adaptive:
+        flexibility = conformers.flexibility(infilepath)
+        number, rms_range = conformers.conformer_policy(**flexibility)
+        log.info('{} has {} rotors and {} sp3 ring atoms: up to {} conformers'.format(
+            resname, flexibility['rotors'], flexibility['ring_atoms'], number))
+    if max_conformers is not None:
+        number = min(number, max_conformers)
+
     omegaOpts = oeomega.OEOmegaOptions()
     omega = oeomega.OEOmega(omegaOpts)
     omega.SetCommentEnergy(True)
     omega.SetEnumNitrogen(True)
     omega.SetSampleHydrogens(True)
     omega.SetEnergyWindow(9.0)
-    omega.SetMaxConfs(5)
+    omega.SetMaxConfs(number)
     omega.SetRangeIncrement(2)
-    omega.SetRMSRange([0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5])
+    omega.SetRMSRange(rms_range)
     filename = '{}-conformers'.format(resname)
     for mol in ifs.GetOEMols():
         ret_code = omega.Build(mol)
@@ -307,88 +392,450 @@ def create_conformers(infile=None, outfile=None, resname=None, folder= None, nam
         else:
             oechem.OEThrow.Warning("%s: %s" % (mol.GetTitle(), oeomega.OEGetOmegaError(ret_code)))
 
+    if preoptimize:
+        nconf = conformers.preoptimize_conformers(resname=resname, number_of_conformers=nconf, folder=folder,
+                                                  forcefield=preoptimize, window=window, deduplicate=deduplicate)
+    elif deduplicate:
+        nconf = conformers.deduplicate_conformers(folder=folder, resname=resname, number_of_conformers=nconf)
     return nconf
 
-def optimize_conformers(opt=True, name='', resname='MOL', number_of_conformers=1, folder = None):
+def budget_conformers(molecules, budget=None, charge_types=('RESP2',), deltas=(1.0,), preset=None,
+                      cost_model=None):
     """
-    Optimize all conformers using psi4. This is done in a 3 step approach were the level of theory is
-    increased stepwise. The resulting structures ares saved as xyz files. If opt = False the
-    optimization is omitted and only the files are copied
+    Chooses the number of conformers of every molecule of a batch from its flexibility, within a QM budget
+    for the whole batch (see conformers.allocate_conformers). The cost of a conformer is the estimated cost
+    of its optimization and its ESP calculations. The input structures are created if necessary.
+
+    :param molecules: List of dictionaries with the keys name, resname, smiles and optionally folder.
+    :param budget: QM budget of the batch in core-hours. default=None (the adaptive number of every molecule)
+    :param charge_types: Charge models, which determine the ESP branches.
+    :param deltas: Mixing parameters.
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
+    :param cost_model: cost.CostModel. default: cost.get_cost_model()
+    :return: List of the maximum numbers of conformers in the order of the molecules.
+    """
+    cost_model = cost_model or cost.get_cost_model()
+    preset = presets.get_preset(preset)
+    branches = required_branches(charge_types=charge_types, deltas=deltas)
+    wanted, costs = [], []
+    for molecule in molecules:
+        folder = molecule.get('folder') or molecule['name'] + '-liquid'
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        infile_path = create_structure(smi=molecule.get('smiles'), folder=folder, resname=molecule['resname'])
+        elements = cost.read_elements(infile_path)
+        wanted.append(conformers.conformer_policy(**conformers.flexibility(infile_path))[0])
+        costs.append(cost_model.estimate_optimization(elements, preset.ladder, preset.hf_hessian) +
+                     sum(cost_model.estimate_esp(elements, type, preset.esp_levels) for type in branches))
+    counts = conformers.allocate_conformers(wanted, costs, budget * 3600.0 if budget is not None else None)
+    log.info('{} conformers for {} molecules ({} wanted), estimated {:.1f} core-hours'.format(
+        sum(counts), len(molecules), sum(wanted), sum(n * c for n, c in zip(counts, costs)) / 3600.0))
+    return counts
+
+
+def convert_conformers(name='', resname='MOL', number_of_conformers=1, folder=None):
+    """
+    Converts the mol2 files of the conformers to xyz files, which are used as input for psi4.
 
-    :param opt: True if optimization should be performed.
     :param name: Name of the molecule. Folders are named accordingly.
     :param resname: Abbreviation of the Residue. Specified in the mol2
     :param number_of_conformers: Number of conformers for this molecule
     :param folder: Name of the folder for the target. If not specified. {name}-liquid is used.
-
-    :return:
-    """
-    header = """memory 12 gb
-molecule mol {
-noreorient
-nocom
+    :return: 0 if successful
     """
-    tail_m1 = """
-}
-set basis 6-31G*
-optimize('HF')
-set basis cc-pV(D+d)Z
-optimize('HF')
-set basis cc-pV(D+d)Z
-optimize('PW6B95')
-
-"""
-
-    # 2 Convert mol2 files to xyz files and put them in the corresponding folder
     obConversion = openbabel.OBConversion()
     obConversion.SetInAndOutFormats("mol2", "xyz")
 
     if folder is None:
         folder = name +'-liquid'
-    filename = name
     for i in range(1, number_of_conformers + 1):
         inputfile = os.path.join(folder, resname + '-conformers_' + str(i) + '.mol2')
         outputfile = os.path.join(folder, resname + '-conformers_' + str(i) + '.xyz')
-        print('DEBUG {}'.format(inputfile))
+        log.debug('Convert {} to {}'.format(inputfile, outputfile))
         mol = openbabel.OBMol()
         obConversion.ReadFile(mol, inputfile)
         obConversion.WriteFile(mol, outputfile)
+    return 0
 
-    if opt == True:
 
-        for i in range(1, number_of_conformers + 1):
-            xyz_file = os.path.join(folder, resname + '-conformers_' + str(i) + '.xyz')
-            psi4_input_file = os.path.join(folder, resname + '-conformers_' + str(i) + '.in')
-            psi4_output_file = os.path.join(folder, resname + '-conformers_' + str(i) + '.out')
-            f = open(xyz_file, 'r')
+def psi4_succeeded(psi4_output_file):
+    """
+    Checks if a psi4 calculation finished successfully (psi4 prints 'beer' at the end of a successful run).
+
+    :param psi4_output_file: Path to the psi4 output file.
+    :return: True if the calculation was successful.
+    """
+    return os.path.isfile(psi4_output_file) and 'beer' in open(psi4_output_file).read()
+
+
+def psi4_final_energy(psi4_output_file):
+    """
+    :param psi4_output_file: Path to the output file of a psi4 optimization.
+    :return: Final energy in Hartree, or None if the file has none.
+    """
+    if not os.path.isfile(psi4_output_file):
+        return None
+    energy = None
+    for line in open(psi4_output_file):
+        if 'Final energy is' in line:
+            energy = float(line.split()[-1])
+    return energy
+
+
+def optimization_input(coordinates, ladder, memory, opt_xyz_file, checkpoints=(), reuse=True, options=None,
+                       hessian=False):
+    """
+    Creates the psi4 input of a multi step optimization.
+
+    Every tier after the first one starts from the converged orbitals of the previous tier (projected onto
+    the new basis set). With hessian, an HF first tier is followed by an HF Hessian at its geometry, which
+    the second tier starts from instead of the guess Hessian of optking. Later tiers start from a geometry
+    the second tier has moved, so they use the guess Hessian again. The geometry after every tier but
+    the last one is saved to its checkpoint file, so that a failed job can continue with the next tier.
+
+    :param coordinates: List of xyz lines.
+    :param ladder: List of (method, basis) optimization steps.
+    :param memory: Memory in GB.
+    :param opt_xyz_file: File the optimized structure is written to.
+    :param checkpoints: Files the geometries after all but the last tier are written to.
+    :param reuse: False if every tier should start with a fresh guess and Hessian.
+    :param options: Dictionary of psi4 options of all tiers (see presets).
+    :param hessian: True if the tiers after an HF first tier start from its HF Hessian (see presets.Preset).
+    :return: Content of the psi4 input file.
+    """
+    text = """memory {:g} gb
+molecule mol {{
+noreorient
+nocom
+0 1
+{}}}
+""".format(memory, ''.join(coordinates))
+    text += ''.join('set {} {}\n'.format(key, value) for key, value in sorted((options or {}).items()))
+    for k, (method, basis) in enumerate(ladder):
+        text += 'set basis {}\n'.format(basis)
+        if reuse and k > 0:
+            text += 'set guess read\n'
+            # The Hessian is at the geometry of the first tier; later tiers start from optking's guess
+            if hessian and k == 1 and ladder[0][0] == 'HF':
+                text += 'set cart_hess_read true\n'
+            elif hessian and k == 2 and ladder[0][0] == 'HF':
+                text += 'set cart_hess_read false\n'
+        text += "E, wfn = optimize('{}', return_wfn=True)\n".format(method)
+        if k < len(ladder) - 1:
+            if k < len(checkpoints):
+                text += "mol.save_xyz_file('{}',True)\n".format(checkpoints[k])
+            if reuse:
+                text += 'wfn.to_file(wfn.get_scratch_filename(180))\n'
+            if reuse and hessian and k == 0 and method == 'HF':
+                text += "set hessian_write true\nhessian('HF')\n"
+    return text + "mol.save_xyz_file('{}',True)".format(opt_xyz_file)
+
+
+def esp_input(coordinates, method, basis, memory, pcm=None, field=False, options=None):
+    """
+    Creates the psi4 input of an ESP calculation on the points of grid.dat in the working directory.
+    psi4 writes the ESP to grid_esp.dat and the electric field to grid_field.dat.
+
+    :param coordinates: List of xyz lines.
+    :param method: QM method.
+    :param basis: Basis set.
+    :param memory: Memory in GB.
+    :param pcm: psi4 pcm block (see esp.PCM_WATER). default=None (gas phase)
+    :param field: True if the electric field is calculated as well.
+    :param options: Dictionary of psi4 options (see presets).
+    :return: Content of the psi4 input file.
+    """
+    text = """memory {:g} gb
+molecule mol {{
+noreorient
+nocom
+0 1
+{}}}
+""".format(memory, ''.join(coordinates))
+    text += ''.join('set {} {}\n'.format(key, value) for key, value in sorted((options or {}).items()))
+    text += 'set basis {}\n'.format(basis)
+    if pcm:
+        text += 'set pcm true\nset pcm_scf_type total\npcm = {{{}}}\n'.format(pcm)
+    properties = ['GRID_ESP', 'GRID_FIELD'] if field else ['GRID_ESP']
+    return text + "E, wfn = prop('{}', properties={}, return_wfn=True)\n".format(method, properties)
+
+
+def _checkpoint_file(folder, resname, i, tier):
+    return os.path.join(folder, '{}-conformers_{}.tier{}.xyz'.format(resname, i, tier))
+
+
+def _optimization_params(ladder, options=None):
+    # Manifest parameters of an optimization; without extra options they are the ladder alone
+    return [ladder, options] if options else ladder
+
+
+def _last_checkpoint(folder, resname, i, ladder, options=None):
+    """
+    :return: (number of finished tiers, xyz lines after the last finished tier). (0, None) without checkpoint.
+    """
+    xyz_file = os.path.join(folder, resname + '-conformers_' + str(i) + '.xyz')
+    for k in range(len(ladder) - 1, 0, -1):
+        if manifest.read_manifest(folder, 'optimization_{}_tier{}'.format(i, k), [xyz_file],
+                                  _optimization_params(ladder[:k], options)):
+            f = open(_checkpoint_file(folder, resname, i, k), 'r')
             coordinates = f.readlines()[2:]
             f.close()
-            f = open(psi4_input_file, 'w')
-            f.write(header)
-            f.write('0 1\n')
-            for line in coordinates:
-                f.write(line)
-            f.write(tail_m1)
-            f.write("mol.save_xyz_file('{}',True)".format(
-                os.path.join(folder, resname + '-confermers_opt_' + str(i) + '.xyz')))
+            return k, coordinates
+    return 0, None
 
-            f.close()
 
-            os.system('psi4 {} -n 4'.format(psi4_input_file))
-            if 'beer' in open(psi4_output_file).read():
+def optimize_conformers(opt=True, name='', resname='MOL', number_of_conformers=1, folder = None, njobs=None,
+                        nthreads=None, memory=None, timeout=None, host=None, convert=True, resume=True,
+                        max_attempts=3, pool=None, preset=None, conformer_numbers=None):
+    """
+    Optimize all conformers using psi4. This is done in a 3 step approach were the level of theory is
+    increased stepwise. The resulting structures ares saved as xyz files. If opt = False the
+    optimization is omitted and only the files are copied
+
+    Every tier starts from the orbitals of the previous one (see optimization_input) and the
+    geometry after every tier is checkpointed. A failed optimization, also in a later run, continues with
+    the first unfinished tier.
+
+    Every conformer is optimized as its own psi4 job and the function returns after all jobs have finished.
+    Threads, memory and the number of concurrent jobs are chosen from the cores and memory of the host and
+    the size of the molecule (see resources.plan_psi4_jobs) unless they are given explicitly.
+    Each running job is pinned to its own set of CPUs.
+
+    :param opt: True if optimization should be performed.
+    :param name: Name of the molecule. Folders are named accordingly.
+    :param resname: Abbreviation of the Residue. Specified in the mol2
+    :param number_of_conformers: Number of conformers for this molecule
+    :param folder: Name of the folder for the target. If not specified. {name}-liquid is used.
+    :param njobs: Maximum number of conformers optimized at the same time. default=None (automatic)
+    :param nthreads: Number of threads per psi4 job. default=None (automatic)
+    :param memory: Memory per psi4 job in GB. default=None (automatic)
+    :param timeout: Wall-clock limit per conformer in seconds. Jobs exceeding it are killed. default=None
+    :param host: resources.HostResources the jobs may use. default=None (the whole host)
+    :param convert: False if the conformers were already converted to xyz files (see convert_conformers).
+    :param resume: Skip conformers whose optimization already finished for the same input (see manifest).
+    :param max_attempts: Failed optimizations are retried with escalating settings (see retry). default=3
+    :param pool: psi4pool.Psi4Pool of warm psi4 workers. If given, the conformers are optimized by the
+                 workers of the pool instead of one psi4 process per conformer. default=None
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
+    :param conformer_numbers: Numbers of the conformers to optimize. default=None (1 to number_of_conformers)
+
+    :return: Dictionary conformer number -> True if the optimization was successful
+    """
+    # 2 Convert mol2 files to xyz files and put them in the corresponding folder
+    if folder is None:
+        folder = name +'-liquid'
+    filename = name
+    if convert:
+        convert_conformers(name=name, resname=resname, number_of_conformers=number_of_conformers, folder=folder)
+    if conformer_numbers is None:
+        conformer_numbers = range(1, number_of_conformers + 1)
+
+    success = {}
+    if opt == True:
+
+        heavy_atoms = max(resources.count_heavy_atoms(os.path.join(folder, resname + '-conformers_' + str(i) + '.xyz'))
+                          for i in conformer_numbers)
+        slots = resources.plan_psi4_jobs(heavy_atoms, njobs=min(njobs or len(conformer_numbers), len(conformer_numbers)),
+                                         nthreads=nthreads, memory=memory, host=host)
+        cost_model = cost.get_cost_model()
+        tracker = progress.get_tracker()
+        policy = retry.RetryPolicy(max_attempts=max_attempts)
+        preset = presets.get_preset(preset)
+        ladder = preset.ladder
+        options = preset.options(optimization=True)
+        params = _optimization_params(ladder, options)
+        psi4_jobs = {}
+        coordinates = {}
+        first_tier = {}
+        for i in conformer_numbers:
+            xyz_file = os.path.join(folder, resname + '-conformers_' + str(i) + '.xyz')
+            if resume and manifest.read_manifest(folder, 'optimization_{}'.format(i), [xyz_file], params):
+                log.info('Optimization of {} and conformer {} already done'.format(filename, i))
+                success[i] = True
+                continue
+            f = open(xyz_file, 'r')
+            coordinates[i] = f.readlines()[2:]
+            f.close()
+            first_tier[i] = 0
+            if resume:
+                first_tier[i], checkpoint = _last_checkpoint(folder, resname, i, ladder, options)
+                if checkpoint is not None:
+                    log.info('Optimization of {} and conformer {} continues after tier {}'.format(
+                        filename, i, first_tier[i]))
+                    coordinates[i] = checkpoint
+            psi4_jobs[i] = None
+
+        attempt = 1
+        while psi4_jobs:
+            escalation = policy.escalation(attempt)
+            for i in psi4_jobs:
+                # Checkpoints of the tiers which are run again are outdated
+                for k in range(first_tier[i] + 1, len(ladder)):
+                    manifest.invalidate(folder, 'optimization_{}_tier{}'.format(i, k))
+            if pool is not None:
+                results = _optimize_in_pool(pool, psi4_jobs, coordinates, first_tier, escalation, name=filename,
+                                            resname=resname, folder=folder, cost_model=cost_model, ladder=ladder,
+                                            options=options, hessian=preset.hf_hessian)
+            else:
+                for i in psi4_jobs:
+                    xyz_file = os.path.join(folder, resname + '-conformers_' + str(i) + '.xyz')
+                    psi4_input_file = os.path.join(folder, resname + '-conformers_' + str(i) + '.in')
+                    text = optimization_input(coordinates[i], ladder[first_tier[i]:], slots[0].memory,
+                                              os.path.join(folder, resname + '-confermers_opt_' + str(i) + '.xyz'),
+                                              checkpoints=[_checkpoint_file(folder, resname, i, k)
+                                                           for k in range(first_tier[i] + 1, len(ladder))],
+                                              options=options, hessian=preset.hf_hessian)
+                    f = open(psi4_input_file, 'w')
+                    f.write(retry.escalate_input(text, escalation))
+                    f.close()
+                    psi4_jobs[i] = jobs.Job(['psi4', psi4_input_file, '-n', slots[0].threads], timeout=timeout,
+                                            name='psi4 optimization {} conformer {}'.format(filename, i),
+                                            cost=cost_model.estimate_optimization(cost.read_elements(xyz_file),
+                                                                                  ladder, preset.hf_hessian),
+                                            stage='optimization')
+                    tracker.add('optimization', cost=psi4_jobs[i].cost)
+                results = jobs.run_jobs(list(psi4_jobs.values()), slots=slots)
+            failed = {}
+            for i, result in zip(psi4_jobs, results):
+                xyz_file = os.path.join(folder, resname + '-conformers_' + str(i) + '.xyz')
+                psi4_output_file = os.path.join(folder, resname + '-conformers_' + str(i) + '.out')
+                success[i] = result.success and (pool is not None or psi4_succeeded(psi4_output_file))
+                tracker.finish('optimization', success=success[i], cost=result.job.cost)
+                retry.record_attempt(folder, 'optimization', i, attempt, escalation, success[i], result.elapsed)
+                for k in range(first_tier[i] + 1, len(ladder)):
+                    checkpoint = _checkpoint_file(folder, resname, i, k)
+                    if os.path.isfile(checkpoint):
+                        manifest.write_manifest(folder, 'optimization_{}_tier{}'.format(i, k), [xyz_file],
+                                                _optimization_params(ladder[:k], options), [checkpoint])
+                if success[i]:
+                    manifest.write_manifest(folder, 'optimization_{}'.format(i), [xyz_file], params,
+                                            [os.path.join(folder, resname + '-confermers_opt_' + str(i) + '.xyz')])
+                    # Timings of the ladder do not include the optional HF Hessian; fake pools have none
+                    if attempt == 1 and first_tier[i] == 0 and not preset.hf_hessian and \
+                            (pool is None or pool.records_timings):
+                        cost.record_timing('ladder', cost.ladder_name(ladder), False, 'opt', cost.read_elements(xyz_file),
+                                           result.elapsed, threads=slots[0].threads if pool is None else pool.threads)
+                elif policy.retry(attempt):
+                    log.warning('Optimization of {} and conformer {} failed in attempt {}, retrying'.format(
+                        filename, i, attempt))
+                    failed_output = retry.keep_failed_output(psi4_output_file, attempt)
+                    first_tier[i], checkpoint = _last_checkpoint(folder, resname, i, ladder, options)
+                    coordinates[i] = checkpoint or coordinates[i]
+                    if policy.escalation(attempt + 1).get('restart'):
+                        coordinates[i] = (retry.last_geometry(failed_output) or getattr(result, 'geometry', None)
+                                          or coordinates[i])
+                    failed[i] = None
+            psi4_jobs = failed
+            attempt += 1
+
+        for i in sorted(success):
+            if success[i]:
                 log.info('Optimization of {} and conformer {} succesful'.format(filename, i))
             else:
                 log.error('Optimization of {} and conformer {} FAILED!!!!!!'.format(filename, i))
 
     else:
-        for i in range(1, number_of_conformers + 1):
+        for i in conformer_numbers:
             if not os.path.exists(os.path.join(folder, resname + '-confermers_opt_' + str(i) + '.xyz')):
                 shutil.copy(os.path.join(folder, resname + '-confermers_' + str(i) + '.xyz'),
                             os.path.join(folder, resname + '-confermers_opt_' + str(i) + '.xyz'))
+            success[i] = True
+
+    return success
 
 
+def deduplicate_optimized(name='', resname='MOL', number_of_conformers=1, folder=None, preset=None,
+                          rmsd_threshold=conformers.DEDUP_RMSD, energy_threshold=conformers.DEDUP_ENERGY):
+    """
+    Removes optimized conformers which ended in the same minimum as a lower one (see
+    conformers.unique_conformers) and conformers whose optimization failed. The remaining conformers
+    are renumbered 1..n with all their files, so that the ESP stages only see distinct structures.
+    The manifests of the optimization and of the conformer stage are updated accordingly.
 
-def create_respyte(type='RESP1', name='', resname='MOL', number_of_conformers=1, opt_folder=None ):
+    :param name: Name of the molecule. Folders are named accordingly.
+    :param resname: Abbreviation of the Residue. Specified in the mol2
+    :param number_of_conformers: Number of optimized conformers.
+    :param folder: Name of the folder for the target. If not specified. {name}-liquid is used.
+    :param preset: Name of the level of theory preset of the optimization (see presets). default=None
+    :param rmsd_threshold: RMSD in Angstrom of the heavy atoms and polar hydrogens.
+    :param energy_threshold: Energy difference in kcal/mol.
+    :return: Number of remaining conformers.
+    """
+    if folder is None:
+        folder = name + '-liquid'
+    structures, energies = [], []
+    for i in range(1, number_of_conformers + 1):
+        opt_xyz_file = os.path.join(folder, resname + '-confermers_opt_' + str(i) + '.xyz')
+        structures.append(esp.read_xyz(opt_xyz_file) if os.path.isfile(opt_xyz_file) else None)
+        energy = psi4_final_energy(os.path.join(folder, resname + '-conformers_' + str(i) + '.out'))
+        energies.append(energy * conformers.HARTREE if energy is not None else None)
+    order = [k + 1 for k in conformers.unique_conformers(structures, energies, rmsd_threshold, energy_threshold)]
+    log.info('{} of {} optimized conformers of {} are distinct'.format(len(order), number_of_conformers, name))
+    if order == list(range(1, number_of_conformers + 1)):
+        return number_of_conformers
+    optimized = [os.path.isfile(manifest.manifest_path(folder, 'optimization_{}'.format(i))) for i in order]
+    conformers.renumber_conformers(folder, resname, order, number_of_conformers)
+
+    preset = presets.get_preset(preset)
+    ladder = preset.ladder
+    options = preset.options(optimization=True)
+    for i in range(1, number_of_conformers + 1):
+        manifest.invalidate(folder, 'optimization_{}'.format(i))
+        for k in range(1, len(ladder)):
+            manifest.invalidate(folder, 'optimization_{}_tier{}'.format(i, k))
+    for i in range(1, len(order) + 1):
+        xyz_file = os.path.join(folder, resname + '-conformers_' + str(i) + '.xyz')
+        for k in range(1, len(ladder)):
+            checkpoint = _checkpoint_file(folder, resname, i, k)
+            if os.path.isfile(checkpoint):
+                manifest.write_manifest(folder, 'optimization_{}_tier{}'.format(i, k), [xyz_file],
+                                        _optimization_params(ladder[:k], options), [checkpoint])
+        if optimized[i - 1]:
+            manifest.write_manifest(folder, 'optimization_{}'.format(i), [xyz_file],
+                                    _optimization_params(ladder, options),
+                                    [os.path.join(folder, resname + '-confermers_opt_' + str(i) + '.xyz')])
+    manifest.update_result(folder, 'conformers', len(order))
+    return len(order)
+
+
+def _optimize_in_pool(pool, conformers, coordinates, first_tier, escalation, name='', resname='MOL', folder='',
+                      cost_model=None, ladder=None, options=None, hessian=False):
+    """
+    Optimizes conformers with the workers of a psi4pool.Psi4Pool. Used by optimize_conformers.
+
+    :param pool: psi4pool.Psi4Pool
+    :param conformers: Numbers of the conformers to optimize.
+    :param coordinates: Dictionary conformer number -> list of xyz lines.
+    :param first_tier: Dictionary conformer number -> number of finished tiers of the optimization ladder.
+    :param escalation: Escalation of the attempt (see retry.RetryPolicy.escalation).
+    :param ladder: List of (method, basis) optimization steps. default: cost.OPTIMIZATION_LADDER
+    :param options: psi4 options of the preset, overridden by the escalation.
+    :param hessian: True if the tiers after an HF first tier start from its HF Hessian (see presets.Preset).
+    :return: List of psi4pool.Psi4Results in the order of conformers.
+    """
+    tracker = progress.get_tracker()
+    futures = []
+    for i in conformers:
+        xyz_file = os.path.join(folder, resname + '-conformers_' + str(i) + '.xyz')
+        ladder = ladder or cost.OPTIMIZATION_LADDER
+        task = psi4pool.Psi4Task('optimize', coordinates[i], ladder=ladder[first_tier[i]:],
+                                 checkpoints=[_checkpoint_file(folder, resname, i, k)
+                                              for k in range(first_tier[i] + 1, len(ladder))],
+                                 options=dict(options or {}, **escalation.get('options', {})),
+                                 memory=pool.memory * escalation.get('memory_factor', 1.0),
+                                 output=os.path.join(folder, resname + '-conformers_' + str(i) + '.out'),
+                                 xyz_file=os.path.join(folder, resname + '-confermers_opt_' + str(i) + '.xyz'),
+                                 hessian=hessian, name='psi4 optimization {} conformer {}'.format(name, i),
+                                 cost=cost_model.estimate_optimization(cost.read_elements(xyz_file), ladder,
+                                                                       hessian))
+        tracker.add('optimization', cost=task.cost)
+        futures.append(pool.submit(task))
+        tracker.start('optimization')
+    return [future.result() for future in futures]
+
+
+def create_respyte(type='RESP1', name='', resname='MOL', number_of_conformers=1, opt_folder=None, timeout=None,
+                   pair=False, preset=None):
     """
     This function creates the respyte input files to generate the selection of ESP grid points by calling the function
     create_respyte_input_files.
@@ -404,6 +851,71 @@ def create_respyte(type='RESP1', name='', resname='MOL', number_of_conformers=1,
     :param resname: 3 letter abbreviation of the compound
     :param number_of_conformers: Number of conformers used for this compound
     :param opt_folder: Name of the folder used for optimize_conformers. If not specified. {name}-liquid is used.
+    :param timeout: Wall-clock limit in seconds for each respyte step. default=None
+    :param pair: True if RESP2LIQUID and RESP2GAS are calculated in combined psi4 sessions (see generate_esp).
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
+
+    :return: 0 if successful
+    """
+    esp_respyte(type=type, name=name, resname=resname, number_of_conformers=number_of_conformers,
+                opt_folder=opt_folder, timeout=timeout, pair=pair, preset=preset)
+
+    # 4 Fit the charges with RESPyte
+    fit_respyte(type=type, name=name, timeout=timeout)
+
+    return 0
+
+
+def esp_respyte(type='RESP1', name='', resname='MOL', number_of_conformers=1, opt_folder=None, timeout=None,
+                pair=False, preset=None):
+    """
+    Creates the respyte input of a branch and calculates the ESPs of all conformers (the first half of
+    create_respyte). Raises RuntimeError if the ESP of any conformer failed (see require_esp).
+
+    :param type: Defines what type of QM calculation to perform
+    :param name: Name of the compound
+    :param resname: 3 letter abbreviation of the compound
+    :param number_of_conformers: Number of conformers used for this compound
+    :param opt_folder: Name of the folder used for optimize_conformers. If not specified. {name}-liquid is used.
+    :param timeout: Wall-clock limit in seconds for each respyte step. default=None
+    :param pair: True if RESP2LIQUID and RESP2GAS are calculated in combined psi4 sessions (see generate_esp).
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
+    :return: Dictionary conformer number -> True
+    """
+    prepare_respyte(type=type, name=name, resname=resname, number_of_conformers=number_of_conformers,
+                    opt_folder=opt_folder, preset=preset)
+    success = generate_esp(type=type, name=name, number_of_conformers=number_of_conformers, timeout=timeout,
+                           pair=pair, preset=preset)
+    require_esp(success, type=type, name=name)
+    return success
+
+
+def require_esp(success, type='RESP1', name=''):
+    """
+    Charges must not be fitted to a part of the conformers of a branch.
+
+    :param success: Dictionary conformer number -> True if the ESP calculation was successful.
+    :param type: Type of the QM calculation (branch).
+    :param name: Name of the compound
+    :return: 0 if the ESP of every conformer was calculated, otherwise RuntimeError is raised.
+    """
+    failed = sorted(i for i, ok in success.items() if not ok)
+    if failed:
+        raise RuntimeError('ESP calculation of {} {} failed for conformers {}'.format(name, type, failed))
+    return 0
+
+
+def prepare_respyte(type='RESP1', name='', resname='MOL', number_of_conformers=1, opt_folder=None, preset=None):
+    """
+    Creates the respyte folder structure and input files and copies the optimized conformers into it.
+    Used by create_respyte.
+
+    :param type: Defines what type of QM calculation to perform
+    :param name: Name of the compound
+    :param resname: 3 letter abbreviation of the compound
+    :param number_of_conformers: Number of conformers used for this compound
+    :param opt_folder: Name of the folder used for optimize_conformers. If not specified. {name}-liquid is used.
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
 
     :return: 0 if successful
     """
@@ -445,7 +957,8 @@ def create_respyte(type='RESP1', name='', resname='MOL', number_of_conformers=1,
     log.info('Create folder structure for {} with {} conformers'.format(name, number_of_conformers))
 
     # 2 Create Respyte and RESP Optimizer input files
-    create_respyte_input_files(type=type, name=name, resname=resname, number_of_conformers=number_of_conformers)
+    create_respyte_input_files(type=type, name=name, resname=resname, number_of_conformers=number_of_conformers,
+                               preset=preset)
 
     # 3 Copy optimized files
     # Looks for the optimized files
@@ -453,27 +966,82 @@ def create_respyte(type='RESP1', name='', resname='MOL', number_of_conformers=1,
         shutil.copyfile(os.path.join(opt_folder, resname + '-confermers_opt_' + str(i) + '.xyz'),
                         os.path.join('{}-{}/input/molecules/mol1/conf{}/mol1_conf{}.xyz'.format(name, type, i, i)))
 
-    # 4 Run RESPyte and PSI4
-    calculate_respyte(type=type, name=name, resname=resname, number_of_conformers=number_of_conformers)
-
     return 0
 
 
-def calculate_respyte(type='RESP1', name='', resname='MOL', number_of_conformers=1):
+def calculate_respyte(type='RESP1', name='', resname='MOL', number_of_conformers=1, timeout=None, pair=False,
+                      preset=None):
     """
     This function performs the psi4 calculation and the respyte calculation and checks if the
-    calculation was successful.
+    calculation was successful. Raises RuntimeError if the ESP of any conformer or the fit failed, so that
+    the branch is not checkpointed (see manifest.run_stage).
 
     :param type: defines what type of QM calculation to perform
     :param name: name of the compound
     :param resname: 3 letter abbreviation of the compound
     :param number_of_conformers: Number of conformers used for this compound
+    :param timeout: Wall-clock limit in seconds for each respyte step. default=None
+    :param pair: True if RESP2LIQUID and RESP2GAS are calculated in combined psi4 sessions (see generate_esp).
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
     :return: 0 if successful
     """
+    success = generate_esp(type=type, name=name, number_of_conformers=number_of_conformers, timeout=timeout,
+                           pair=pair, preset=preset)
+    require_esp(success, type=type, name=name)
+    fit_respyte(type=type, name=name, timeout=timeout)
+    return 0
+
+
+def write_espf(tmp_folder, espf_file):
+    """
+    Writes the ESP of a psi4 run in the format of respyte's esp_generator, which resp_optimizer reads:
+    for every grid point a line x y z esp, followed by a line with the electric field if it was calculated.
+
+    :param tmp_folder: Folder of the psi4 run with grid.dat, grid_esp.dat and optionally grid_field.dat.
+    :param espf_file: Path of the espf file.
+    :return: 0 if successful
+    """
+    grid = [line.split()[:3] for line in open(os.path.join(tmp_folder, 'grid.dat')) if line.split()]
+    values = [line.split()[0] for line in open(os.path.join(tmp_folder, 'grid_esp.dat')) if line.split()]
+    field_file = os.path.join(tmp_folder, 'grid_field.dat')
+    field = [line.split()[:3] for line in open(field_file) if line.split()] if os.path.isfile(field_file) else None
+    if len(values) != len(grid) or (field is not None and len(field) != len(grid)):
+        raise RuntimeError('ESP of {} does not match its grid'.format(tmp_folder))
+    with open(espf_file, 'w') as f:
+        for k, point in enumerate(grid):
+            f.write('{:>16.10f} {:>16.10f} {:>16.10f} {:>16.10f}\n'.format(*[float(x) for x in point + [values[k]]]))
+            if field is not None:
+                f.write('{:>16.10f} {:>16.10f} {:>16.10f}\n'.format(*[float(x) for x in field[k]]))
+    return 0
+
+
+def generate_esp(type='RESP1', name='', number_of_conformers=1, timeout=None, max_attempts=3, pair=False,
+                 preset=None):
+    """
+    Runs respyte's esp_generator (grid selection and psi4 ESP calculation) for all conformers
+    and checks which calculations were successful. Used by calculate_respyte.
+
+    Failed ESP calculations are rerun with escalating SCF settings (see retry) from the psi4 input
+    respyte left in the tmp folder of the conformer. The geometry is never changed. After a successful
+    rerun the ESP file of the conformer (mol1_conf{i}.espf), which esp_generator writes only for its own
+    runs, is written from the results of the rerun (see write_espf).
+
+    With pair=True, RESP2LIQUID and RESP2GAS share their psi4 sessions (see esppair): the RESP2LIQUID
+    calculation of every conformer converges the gas phase first and starts the PCM SCF from its
+    orbitals. The gas phase ESP is kept and used by the following RESP2GAS calculation, which then only
+    selects the grid. RESP2LIQUID has to be calculated first.
+
+    :param type: defines what type of QM calculation to perform
+    :param name: name of the compound
+    :param number_of_conformers: Number of conformers used for this compound
+    :param timeout: Wall-clock limit in seconds. default=None
+    :param max_attempts: Maximum number of attempts of every ESP calculation. default=3
+    :param pair: True if RESP2LIQUID and RESP2GAS are calculated in combined psi4 sessions. default=False
+    :param preset: Name of the level of theory preset the inputs were created with (see presets). default=None
+    :return: Dictionary conformer number -> True if the ESP calculation was successful
+    """
     foldername = name + '-' + type
-    cwdr = os.getcwd()
-    os.chdir(foldername)
-    mol_folder = 'input/molecules/mol1/'
+    mol_folder = os.path.join(foldername, 'input/molecules/mol1/')
     for i in range(1, number_of_conformers + 1):
         conf_folder = os.path.join(mol_folder, 'conf' + str(i))
         tmp_folder = os.path.join(conf_folder, 'tmp/')
@@ -481,21 +1049,336 @@ def calculate_respyte(type='RESP1', name='', resname='MOL', number_of_conformers
             shutil.rmtree(tmp_folder)
         except Exception:
             pass
-    os.system('python ~/programs/respyte/respyte/esp_generator.py')
+        # An ESP file of an earlier run must not be fitted if this run fails
+        espf_file = os.path.join(conf_folder, 'mol1_conf{}.espf'.format(i))
+        if os.path.isfile(espf_file):
+            os.remove(espf_file)
+    tracker = progress.get_tracker()
+    levels = presets.get_preset(preset).esp_levels
+    first_conformer = os.path.join(mol_folder, 'conf1', 'mol1_conf1.xyz')
+    esp_cost = 0.0
+    if os.path.isfile(first_conformer):
+        esp_cost = cost.get_cost_model().estimate_esp(cost.read_elements(first_conformer), type, levels)
+    mode = PAIR_MODES.get(type) if pair else None
+    env = esppair.pair_environment(name + '-esp-pair', mode) if mode else None
+    if mode and env is None:
+        log.warning('psi4 not found, {} of {} is calculated without the combined sessions'.format(type, name))
+    # respyte calculates all conformers in one job
+    tracker.add(type, number_of_conformers, cost=esp_cost)
+    tracker.start(type, number_of_conformers)
+    result = jobs.run_job(jobs.Job(['python', os.path.join(RESPYTE_PATH, 'esp_generator.py')], cwd=foldername,
+                                   timeout=timeout, env=env, name='esp_generator {} {}'.format(name, type)))
+    policy = retry.RetryPolicy(max_attempts=max_attempts)
+    success = {}
     for i in range(1, number_of_conformers + 1):
         conf_folder = os.path.join(mol_folder, 'conf' + str(i))
-        psi4_output_file = os.path.join(conf_folder, 'tmp/output.dat')
-        if 'beer' in open(psi4_output_file).read():
+        tmp_folder = os.path.join(conf_folder, 'tmp')
+        psi4_output_file = os.path.join(tmp_folder, 'output.dat')
+        success[i] = psi4_succeeded(psi4_output_file)
+        tracker.finish(type, success=success[i], cost=esp_cost)
+        retry.record_attempt(foldername, type, i, 1, policy.escalation(1), success[i])
+        if success[i] and not (env is not None and mode == 'cached'):
+            # respyte runs the conformers one after the other, the time is shared equally
+            method, basis, pcm = levels[type]
+            cost.record_timing(method, basis, pcm, 'sp',
+                               cost.read_elements(os.path.join(conf_folder, 'mol1_conf{}.xyz'.format(i))),
+                               result.elapsed / number_of_conformers)
+        attempt = 1
+        while not success[i] and policy.retry(attempt):
+            psi4_input_file = os.path.join(tmp_folder, 'input.dat')
+            if not os.path.isfile(psi4_input_file):
+                retry.record_attempt(foldername, type, i, attempt + 1, None, False,
+                                     message='No psi4 input in {}, cannot retry'.format(tmp_folder))
+                break
+            attempt += 1
+            log.warning('ESP calculation for {} and conformer {} failed, attempt {}'.format(name, i, attempt))
+            retry.keep_failed_output(psi4_output_file, attempt - 1)
+            # Only the SCF settings are escalated; the ESP has to be calculated for the given geometry
+            escalation = {key: value for key, value in policy.escalation(attempt).items() if key != 'restart'}
+            text = retry.escalate_input(open(psi4_input_file).read(), escalation)
+            f = open(psi4_input_file, 'w')
+            f.write(text)
+            f.close()
+            tracker.add(type, cost=esp_cost)
+            rerun = jobs.run_job(jobs.Job(['psi4', 'input.dat'], cwd=tmp_folder, timeout=timeout,
+                                          name='psi4 esp {} {} conformer {}'.format(name, type, i), stage=type))
+            success[i] = rerun.success and psi4_succeeded(psi4_output_file)
+            if success[i]:
+                try:
+                    write_espf(tmp_folder, os.path.join(conf_folder, 'mol1_conf{}.espf'.format(i)))
+                except (IOError, RuntimeError) as e:
+                    log.error('ESP of the rerun for {} and conformer {} unusable: {}'.format(name, i, e))
+                    success[i] = False
+            tracker.finish(type, success=success[i], cost=esp_cost)
+            retry.record_attempt(foldername, type, i, attempt, escalation, success[i], rerun.elapsed)
+        if success[i]:
             log.info('ESP calculation for {} and conformer {} successful'.format(name, i))
         else:
             log.error('ESP calculation for {} and conformer {} FAILED!!!!!!'.format(name, i))
+    return success
+
+
+def calculate_esp_arrays(type='RESP1', name='', resname='MOL', number_of_conformers=1, pool=None, opt_folder=None,
+                         field=False, preset=None, conformer_numbers=None, timeout=None):
+    """
+    Calculates the ESP of all optimized conformers without respyte. The MSK grid is selected with numpy,
+    passed to the QM session of a warm psi4 worker as array, and the ESP comes back as array (see esp).
+    The arrays are stored in {name}-{type}/esp/mol1_conf{i}.npz.
+
+    Without pool every conformer is calculated by its own psi4 process in {name}-{type}/esp/conf{i}
+    (see esp_input), which reads the grid from and writes the ESP to text files.
+
+    :param type: RESP1, RESP2GAS or RESP2LIQUID
+    :param name: Name of the compound
+    :param resname: 3 letter abbreviation of the compound
+    :param number_of_conformers: Number of conformers used for this compound
+    :param pool: psi4pool.Psi4Pool running the calculations.
+    :param opt_folder: Name of the folder used for optimize_conformers. If not specified. {name}-liquid is used.
+    :param field: True if the electric field is calculated as well.
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
+    :param conformer_numbers: Numbers of the conformers to calculate. default=None (1 to number_of_conformers)
+    :param timeout: Wall-clock limit per psi4 process in seconds, without pool. default=None
+    :return: Dictionary conformer number -> dictionary of arrays (see esp.load_esp), None if the calculation failed
+    """
+    if opt_folder is None:
+        opt_folder = name + '-liquid'
+    esp_folder = os.path.join(name + '-' + type, 'esp')
+    if not os.path.isdir(esp_folder):
+        os.makedirs(esp_folder)
+    preset = presets.get_preset(preset)
+    method, basis, pcm = preset.esp_levels[type]
+    cost_model = cost.get_cost_model()
+    tracker = progress.get_tracker()
+    conformer_numbers = list(conformer_numbers or range(1, number_of_conformers + 1))
+    futures = {}
+    structures = {}
+    psi4_jobs = {}
+    for i in conformer_numbers:
+        xyz_file = os.path.join(opt_folder, resname + '-confermers_opt_' + str(i) + '.xyz')
+        elements, coordinates = esp.read_xyz(xyz_file)
+        structures[i] = (elements, coordinates, esp.msk_grid(elements, coordinates))
+        geometry = ['{} {} {} {}\n'.format(element, *xyz) for element, xyz in zip(elements, coordinates)]
+        task_cost = cost_model.estimate_esp(elements, type, preset.esp_levels)
+        tracker.add(type, cost=task_cost)
+        if pool is not None:
+            task = psi4pool.Psi4Task('esp', geometry, ladder=[(method, basis)], grid=structures[i][2], field=field,
+                                     pcm=esp.PCM_WATER if pcm else None, options=preset.options(),
+                                     output=os.path.join(esp_folder, 'mol1_conf{}.out'.format(i)),
+                                     name='psi4 esp {} {} conformer {}'.format(name, type, i), cost=task_cost)
+            futures[i] = pool.submit(task)
+            tracker.start(type)
+        else:
+            psi4_jobs[i] = (geometry, task_cost)
+    results = {i: future.result() for i, future in futures.items()}
+    if psi4_jobs:
+        results = _esp_in_processes(psi4_jobs, structures, method, basis, pcm, field, preset.options(), esp_folder,
+                                    timeout=timeout, name='{} {}'.format(name, type), stage=type)
+    data = {}
+    for i in conformer_numbers:
+        result = results[i]
+        tracker.finish(type, success=result.success, cost=result.job.cost)
+        if not result.success:
+            log.error('ESP calculation for {} and conformer {} FAILED: {}'.format(name, i, result.error))
+            data[i] = None
+            continue
+        elements, coordinates, grid = structures[i]
+        esp.save_esp(os.path.join(esp_folder, 'mol1_conf{}.npz'.format(i)), grid, result.esp, result.field,
+                     elements=elements, coordinates=coordinates)
+        data[i] = dict(grid=grid, esp=result.esp, elements=np.asarray(elements), coordinates=coordinates)
+        if result.field is not None:
+            data[i]['field'] = result.field
+        log.info('ESP calculation for {} and conformer {} successful'.format(name, i))
+    return data
+
+
+def _esp_in_processes(psi4_jobs, structures, method, basis, pcm, field, options, esp_folder, timeout=None, name='',
+                      stage=''):
+    """
+    Runs the ESP calculations of calculate_esp_arrays as psi4 processes, one per conformer.
+
+    :param psi4_jobs: Dictionary conformer number -> (xyz lines, estimated cost).
+    :param structures: Dictionary conformer number -> (elements, coordinates, grid).
+    :return: Dictionary conformer number -> psi4pool.Psi4Result
+    """
+    heavy_atoms = max(len([element for element in structures[i][0] if element != 'H']) for i in psi4_jobs)
+    slots = resources.plan_psi4_jobs(heavy_atoms, njobs=len(psi4_jobs))
+    job_list = []
+    for i, (geometry, task_cost) in psi4_jobs.items():
+        work_folder = os.path.join(esp_folder, 'conf{}'.format(i))
+        if os.path.isdir(work_folder):
+            shutil.rmtree(work_folder)
+        os.makedirs(work_folder)
+        np.savetxt(os.path.join(work_folder, 'grid.dat'), structures[i][2], fmt='%16.10f')
+        f = open(os.path.join(work_folder, 'input.dat'), 'w')
+        f.write(esp_input(geometry, method, basis, slots[0].memory, pcm=esp.PCM_WATER if pcm else None, field=field,
+                          options=options))
+        f.close()
+        job_list.append(jobs.Job(['psi4', 'input.dat', '-n', slots[0].threads], cwd=work_folder, timeout=timeout,
+                                 name='psi4 esp {} conformer {}'.format(name, i), cost=task_cost, stage=stage))
+    results = {}
+    for i, job, result in zip(psi4_jobs, job_list, jobs.run_jobs(job_list, slots=slots)):
+        work_folder = os.path.join(esp_folder, 'conf{}'.format(i))
+        results[i] = psi4pool.Psi4Result(job=job, success=False, elapsed=result.elapsed,
+                                         error='psi4 failed, see {}'.format(os.path.join(work_folder, 'output.dat')))
+        if not (result.success and psi4_succeeded(os.path.join(work_folder, 'output.dat'))):
+            continue
+        try:
+            results[i].esp = np.loadtxt(os.path.join(work_folder, 'grid_esp.dat'), ndmin=1)
+            if field:
+                results[i].field = np.loadtxt(os.path.join(work_folder, 'grid_field.dat'), ndmin=2)
+        except (IOError, ValueError) as e:
+            results[i].error = repr(e)
+            continue
+        results[i].success = len(results[i].esp) == len(structures[i][2])
+    return results
+
+
+def fit_esp_arrays(type='RESP1', name='', resname='MOL', number_of_conformers=1, opt_folder=None, data=None):
+    """
+    Fits RESP charges to the ESP arrays of all conformers (see esp.resp_fit) and writes them to
+    {name}-{type}/resp_output/mol1_conf1.mol2, like respyte's resp_optimizer.
+
+    :param type: RESP1, RESP2GAS or RESP2LIQUID
+    :param name: Name of the compound
+    :param resname: 3 letter abbreviation of the compound
+    :param number_of_conformers: Number of conformers used for this compound
+    :param opt_folder: Name of the folder used for optimize_conformers. If not specified. {name}-liquid is used.
+    :param data: Arrays of calculate_esp_arrays. default=None (read from {name}-{type}/esp)
+    :return: List of charges
+    """
+    if opt_folder is None:
+        opt_folder = name + '-liquid'
+    if data is None:
+        data = {}
+        for i in range(1, number_of_conformers + 1):
+            path = os.path.join(name + '-' + type, 'esp', 'mol1_conf{}.npz'.format(i))
+            data[i] = esp.load_esp(path) if os.path.isfile(path) else None
+    structures = [(arrays['coordinates'], arrays['grid'], arrays['esp']) for i, arrays in sorted(data.items())
+                  if arrays is not None]
+    if not structures:
+        raise RuntimeError('No ESP of {} {} to fit'.format(name, type))
+    elements = [str(element) for element in next(arrays for arrays in data.values() if arrays is not None)['elements']]
+    charges = esp.resp_fit(elements, structures)
+    output_folder = os.path.join(name + '-' + type, 'resp_output')
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+    lines, _ = read_mol2_charges(os.path.join(opt_folder, resname + '-conformers_1.mol2'))
+    write_mol2_charges(lines, charges, os.path.join(output_folder, 'mol1_conf1.mol2'), resname=resname)
+    return list(charges)
+
+
+def sequential_charges(name='', resname='MOL', number_of_conformers=1, folder=None, pool=None,
+                       branches=('RESP2LIQUID', 'RESP2GAS'), tolerance=CHARGE_TOLERANCE, convert=True, timeout=None,
+                       preset=None, energies=None):
+    """
+    Optimizes the conformers one after the other in order of increasing energy and refits the charges after
+    every conformer with the ESP arrays of all conformers so far (see calculate_esp_arrays and fit_esp_arrays).
+    The remaining conformers are skipped once no charge of any branch changed by more than tolerance.
+    An optimized conformer which ended in the same minimum as one used before (see
+    conformers.unique_conformers) gets no ESP calculations and does not count.
 
-    os.system('python ~/programs/respyte/respyte/resp_optimizer.py')
-    os.chdir(cwdr)
+    Without pool the optimizations and ESP calculations run as psi4 processes.
+    The conformers used, the duplicates and the number of conformers needed are written to
+    {folder}/{resname}-sequential.json.
+
+    :param name: Name of the molecule. Folders are named accordingly.
+    :param resname: Abbreviation of the Residue. Specified in the mol2
+    :param number_of_conformers: Number of conformers available.
+    :param folder: Name of the folder for the target. If not specified. {name}-liquid is used.
+    :param pool: psi4pool.Psi4Pool running the optimizations and ESP calculations. default=None (psi4 processes)
+    :param branches: ESP branches which are fitted (see required_branches).
+    :param tolerance: Largest change of a charge in e at which the charges are converged.
+    :param convert: False if the conformers were already converted to xyz files (see convert_conformers).
+    :param timeout: Wall-clock limit per psi4 calculation in seconds.
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
+    :param energies: Energies of the conformers in kcal/mol, which set the order.
+                     default=None (force field energies, see conformers.force_field_energies)
+    :return: Dictionary with the keys conformers (number used), order (their numbers), duplicates, available,
+             converged and changes (largest change of a charge after every conformer).
+    """
+    if folder is None:
+        folder = name + '-liquid'
+    if convert:
+        convert_conformers(name=name, resname=resname, number_of_conformers=number_of_conformers, folder=folder)
+    if energies is None:
+        energies = conformers.force_field_energies(folder=folder, resname=resname,
+                                                   number_of_conformers=number_of_conformers)
+    # Conformers without energy come last, ties keep the order of the numbers
+    order = sorted(range(1, number_of_conformers + 1),
+                   key=lambda i: (energies[i - 1] is None, energies[i - 1] or 0.0, i))
+    data = {type: {} for type in branches}
+    charges = {}
+    used = []
+    record = dict(conformers=0, order=[], duplicates=[], available=number_of_conformers, converged=False, changes=[])
+    for i in order:
+        success = optimize_conformers(name=name, resname=resname, number_of_conformers=number_of_conformers,
+                                      folder=folder, timeout=timeout, convert=False, pool=pool, preset=preset,
+                                      conformer_numbers=[i])
+        if not success.get(i):
+            continue
+        structure = esp.read_xyz(os.path.join(folder, resname + '-confermers_opt_' + str(i) + '.xyz'))
+        energy = psi4_final_energy(os.path.join(folder, resname + '-conformers_' + str(i) + '.out'))
+        energy = energy * conformers.HARTREE if energy is not None else None
+        if used and len(conformers.unique_conformers([s for s, e in used] + [structure],
+                                                     [e for s, e in used] + [energy])) <= len(used):
+            log.info('Conformer {} of {} is a duplicate after the optimization, skipping it'.format(i, name))
+            record['duplicates'].append(i)
+            continue
+        arrays = {type: calculate_esp_arrays(type=type, name=name, resname=resname, pool=pool, opt_folder=folder,
+                                             preset=preset, conformer_numbers=[i], timeout=timeout)[i]
+                  for type in branches}
+        if any(value is None for value in arrays.values()):
+            continue
+        used.append((structure, energy))
+        previous = charges
+        charges = {}
+        for type in branches:
+            data[type][i] = arrays[type]
+            charges[type] = np.array(fit_esp_arrays(type=type, name=name, resname=resname, opt_folder=folder,
+                                                    data=data[type]))
+        record['conformers'] += 1
+        record['order'].append(i)
+        if previous:
+            change = max(float(np.max(np.abs(charges[type] - previous[type]))) for type in branches)
+            record['changes'].append(change)
+            log.info('Largest charge change of {} with conformer {}: {:.4f} e'.format(name, i, change))
+            if change < tolerance:
+                record['converged'] = True
+                break
+    log.info('Charges of {} {} after {} of {} conformers'.format(
+        name, 'converged' if record['converged'] else 'did not converge', record['conformers'],
+        number_of_conformers))
+    with open(os.path.join(folder, resname + '-sequential.json'), 'w') as f:
+        json.dump(record, f, indent=1)
+    if not charges:
+        raise RuntimeError('No conformer of {} could be calculated'.format(name))
+    return record
+
+
+def fit_respyte(type='RESP1', name='', timeout=None):
+    """
+    Runs respyte's resp_optimizer, which fits the charges to the ESPs of all conformers.
+    Used by calculate_respyte. Raises RuntimeError if the fit failed.
+
+    :param type: defines what type of QM calculation to perform
+    :param name: name of the compound
+    :param timeout: Wall-clock limit in seconds. default=None
+    :return: 0 if successful
+    """
+    foldername = name + '-' + type
+    # The charges of an earlier fit must not be mistaken for the result of this one
+    mol2_file = os.path.join(foldername, 'resp_output', 'mol1_conf1.mol2')
+    if os.path.isfile(mol2_file):
+        os.remove(mol2_file)
+    result = jobs.run_job(jobs.Job(['python', os.path.join(RESPYTE_PATH, 'resp_optimizer.py')], cwd=foldername,
+                                   timeout=timeout, name='resp_optimizer {} {}'.format(name, type)))
+    if not result.success or not os.path.isfile(mol2_file):
+        log.error('Charge fit for {} {} FAILED!!!!!!'.format(name, type))
+        raise RuntimeError('Charge fit for {} {} failed'.format(name, type))
     return 0
 
 
-def create_respyte_input_files(type='RESP1', name='', resname='MOL', number_of_conformers=1):
+def create_respyte_input_files(type='RESP1', name='', resname='MOL', number_of_conformers=1, preset=None):
     """
     This function performs the psi4 calculation and the respyte calculations and checks if the
     calculation was successful.
@@ -503,24 +1386,15 @@ def create_respyte_input_files(type='RESP1', name='', resname='MOL', number_of_c
     :param type: Defines what type of QM calculation to perform
     :param name: Name of the compound
     :param number_of_conformers: Number of conformers used for this compound
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
     :return: 0 if successful
     """
-    if type == 'RESP1':
-        method = 'HF'
-        basis = '6-31G*'
-        pcm = 'N'
-    elif type == 'RESP2GAS':
-
-        method = 'PW6B95'
-        basis = 'aug-cc-pV(D+d)Z'
-        pcm = 'N'
-    elif type == 'RESP2LIQUID':
-        method = 'PW6B95'
-        basis = 'aug-cc-pV(D+d)Z'
-        pcm = 'Y\n    solvent   : water'
-    else:
+    levels = presets.get_preset(preset).esp_levels
+    if type not in levels:
         log.error('Charge type not recognized')
         sys.exit()
+    method, basis, pcm = levels[type]
+    pcm = 'Y\n    solvent   : water' if pcm else 'N'
 
     # input.yml
     input_file = open('{}-{}/input/input.yml'.format(name, type), 'w')
@@ -532,18 +1406,18 @@ cheminformatics : openeye
 
 grid_setting :
     forcegen  : Y
-    type      : msk # msk(default)/ extendedmsk/ fcc/ newfcc/ vdwfactors/ vdwconstants
-    radii     : bondi # bondi(default)/ modbondi
+    type      : {type} # msk(default)/ extendedmsk/ fcc/ newfcc/ vdwfactors/ vdwconstants
+    radii     : {radii} # bondi(default)/ modbondi
     method    : {}
     basis     : {}
     pcm       : {}
-    space     : 0.4
-    innner    : 1.6
-    outer     : 2.1
+    space     : {space}
+    innner    : {inner}
+    outer     : {outer}
 
     
     
-    """.format(number_of_conformers, method, basis, pcm))
+    """.format(number_of_conformers, method, basis, pcm, **esp.RESPYTE_GRID))
 
     input_file.close()
     # respyte.yml
@@ -558,19 +1432,20 @@ grid_setting :
     cheminformatics : openeye
 
     boundary_select:
-        radii    : bondi
-        inner    : 1.3
-        outer    : 2.1
+        radii    : {radii}
+        inner    : {inner}
+        outer    : {outer}
 
     restraint :
         penalty : 2-stg-fit
         matrices :
             - esp
-        a1      : 0.0005
-        a2      : 0.001
-        b       : 0.1
+        a1      : {a1}
+        a2      : {a2}
+        b       : {b}
 
-        """.format(number_of_conformers))
+        """.format(number_of_conformers, radii=esp.RESPYTE_GRID['radii'], inner=esp.RESPYTE_BOUNDARY[0],
+                   outer=esp.RESPYTE_BOUNDARY[1], **esp.RESPYTE_RESTRAINT))
     respyte_file.close()
 
     return 0
@@ -578,10 +1453,94 @@ grid_setting :
 
 
 
+def read_mol2_charges(filename):
+    """
+    Reads the partial charges of a mol2 file.
+
+    :param filename: Path to the mol2 file.
+    :return: Lines of the file and list of charges.
+    """
+    f = open(filename, 'r')
+    v = 0
+    charges = []
+    lines = f.readlines()
+    for line in lines:
+        if '@<TRIPOS>ATOM' in line:
+            v = 1
+        elif '@<TRIPOS>BOND' in line:
+            v = 2
+        elif v == 1:
+            entry = line.split()
+            charges.append(float(entry[8]))
+    f.close()
+    return lines, charges
+
+
+def required_branches(charge_types=('RESP2',), deltas=(1.0,)):
+    """
+    Determines which QM branches are needed for the requested charge models.
+    RESP1 charges need the RESP1 (HF/6-31G*) calculation. RESP2 charges mix gas phase and PCM charges
+    with delta, so delta = 0.0 only needs RESP2GAS and delta = 1.0 only needs RESP2LIQUID.
+
+    :param charge_types: List of charge types (RESP1, RESP2)
+    :param deltas: List of mixing parameters
+    :return: List of branches (RESP2LIQUID, RESP2GAS, RESP1)
+    """
+    branches = set()
+    for type in charge_types:
+        if type == 'RESP1':
+            branches.add('RESP1')
+        elif type == 'RESP2':
+            for delta in deltas:
+                if delta > 0.0:
+                    branches.add('RESP2LIQUID')
+                if delta < 1.0:
+                    branches.add('RESP2GAS')
+        else:
+            log.error('The type you defined is not recognized. Up to now only RESP1 and RESP2 are valid options')
+            sys.exit(1)
+    return [branch for branch in ['RESP2LIQUID', 'RESP2GAS', 'RESP1'] if branch in branches]
+
+
+def paired_branches(branches):
+    """
+    :param branches: List of ESP branches.
+    :return: True if RESP2LIQUID and RESP2GAS are both calculated and share their psi4 sessions.
+    """
+    return 'RESP2LIQUID' in branches and 'RESP2GAS' in branches
+
+
+def charge_file_path(name='', resname='MOL', delta=0.0, type='RESP1'):
+    """
+    :return: Path of the mol2 file create_charge_file writes for these arguments.
+    """
+    abbreviation = {'RESP1': 'R1', 'RESP2': 'R2'}[type]
+    return os.path.join(name + '-liquid', '{}_{}_{}.mol2'.format(resname, abbreviation, int(delta * 100)))
+
+
+def collect_charges(name='', resname='MOL', charge_types=('RESP2',), deltas=(1.0,)):
+    """
+    Reads the charge files of a finished calculation.
+
+    :param name: Name of the compound.
+    :param resname: 3 letter abbreviation of the compound.
+    :param charge_types: Charge types (RESP1, RESP2)
+    :param deltas: Mixing parameters
+    :return: List of dictionaries with the keys type, delta, file and charges.
+    """
+    collected = []
+    for type in charge_types:
+        for delta in deltas:
+            filename = charge_file_path(name=name, resname=resname, delta=delta, type=type)
+            collected.append(dict(type=type, delta=delta, file=filename, charges=read_mol2_charges(filename)[1]))
+    return collected
+
+
 def create_charge_file(name='', resname='MOL', delta=0.0, type='RESP1'):
     """
     This function creates a MOL2 file with either RESP1 scaled charges or RESP2 charges
-    with a certain mixing parameter.
+    with a certain mixing parameter. For RESP2 with delta = 0.0 (1.0) only the gas phase (liquid)
+    charges are required.
 
     :param name: Name of the compound.
     :param resname: 3 letter abbreviation of the compound.
@@ -591,23 +1550,10 @@ def create_charge_file(name='', resname='MOL', delta=0.0, type='RESP1'):
     """
     if type == 'RESP1':
         mol2_resp1 = name + '-RESP1/resp_output/mol1_conf1.mol2'
-        f = open(mol2_resp1)
-        output_file = os.path.join(name + '-liquid', resname + '_R1_' + str(int(delta * 100)) + '.mol2')
-        output = open(output_file, 'w')
+        output_file = charge_file_path(name=name, resname=resname, delta=delta, type=type)
 
         # Read in RESP1 charges
-        v = 0
-        resp1charges = []
-        lines = f.readlines()
-        for line in lines:
-            if '@<TRIPOS>ATOM' in line:
-                v = 1
-            elif '@<TRIPOS>BOND' in line:
-                v = 2
-            elif v == 1:
-                entry = line.split()
-                resp1charges.append(float(entry[8]))
-        f.close()
+        lines, resp1charges = read_mol2_charges(mol2_resp1)
         charges = []
         for i in range(len(resp1charges)):
             charges.append(resp1charges[i] * delta)
@@ -616,38 +1562,17 @@ def create_charge_file(name='', resname='MOL', delta=0.0, type='RESP1'):
     elif type == 'RESP2':
         mol2_gas = name + '-RESP2GAS/resp_output/mol1_conf1.mol2'
         mol2_liquid = name + '-RESP2LIQUID/resp_output/mol1_conf1.mol2'
-        output_file = os.path.join(name + '-liquid', resname + '_R2_' + str(int(delta * 100)) + '.mol2')
-        f = open(mol2_gas, 'r')
-        f2 = open(mol2_liquid, 'r')
-        output = open(output_file, 'w')
-
-        # Read in gas phase charges (gpc)
-        v = 0
-        gpc = []
-        lines = f.readlines()
-        for line in lines:
-            if '@<TRIPOS>ATOM' in line:
-                v = 1
-            elif '@<TRIPOS>BOND' in line:
-                v = 2
-            elif v == 1:
-                entry = line.split()
-                gpc.append(float(entry[8]))
-        f.close()
-
-        # Read in implicit solvent charges (isc)
-        v = 0
-        isc = []
-        lines2 = f2.readlines()
-        for line in lines2:
-            if '@<TRIPOS>ATOM' in line:
-                v = 1
-            elif '@<TRIPOS>BOND' in line:
-                v = 2
-            elif v == 1:
-                entry = line.split()
-                isc.append(float(entry[8]))
-        f2.close()
+        output_file = charge_file_path(name=name, resname=resname, delta=delta, type=type)
+
+        # Read in gas phase charges (gpc) and implicit solvent charges (isc)
+        if delta < 1.0:
+            lines, gpc = read_mol2_charges(mol2_gas)
+        if delta > 0.0:
+            lines, isc = read_mol2_charges(mol2_liquid)
+        if delta <= 0.0:
+            isc = gpc
+        if delta >= 1.0:
+            gpc = isc
 
         charges = []
         for i in range(len(isc)):
@@ -657,9 +1582,26 @@ def create_charge_file(name='', resname='MOL', delta=0.0, type='RESP1'):
         log.error('The type you defined is not recognized. Up to now only RESP1 and RESP2 are valid options')
         sys.exit(1)
 
+    write_mol2_charges(lines, charges, output_file, resname=resname)
     log.info('Created charges {} type charges with a delta value of {}'.format(type, delta))
+
+    return 0
+
+
+def write_mol2_charges(lines, charges, output_file, resname='MOL'):
+    """
+    Writes a mol2 file with new partial charges.
+
+    :param lines: Lines of the mol2 file the structure is taken from (see read_mol2_charges).
+    :param charges: List of charges in the order of the atoms.
+    :param output_file: Path of the new mol2 file.
+    :param resname: Residue name of all atoms.
+    :return: 0 if successful
+    """
+    output = open(output_file, 'w')
     v = 0
     num = 0
+    lines = list(lines)
     if lines[1].startswith('***') or lines[1].startswith('resp_gas') or lines[1].startswith('mol1_conf1'):
         lines[1] = '{}\n'.format(resname)
     for i, line in enumerate(lines):
@@ -679,18 +1621,25 @@ def create_charge_file(name='', resname='MOL', delta=0.0, type='RESP1'):
             num += 1
         else:
             output.write(line)
-    f.close()
     output.close()
-
     return 0
 
 
 
 
-def create_RESP2(smi = None,folder='', opt=True, name='', resname='MOL', delta=1.0, density=None, hov=None, dielectric=None):
+def create_RESP2(smi = None,folder='', opt=True, name='', resname='MOL', delta=1.0, density=None, hov=None, dielectric=None,
+                 nworkers=1, nthreads=None, timeout=None, resume=True, charge_types=('RESP2',), deltas=None,
+                 dry_run=False, executor=None, status_file=None, report_interval=30.0, preset=None,
+                 preoptimize=None, deduplicate=False, adaptive=False, sequential=False):
     """
     Creates a mol2 file with RESP2 charges from a mol2 file (resname.mol2) or from a smiles string.
 
+    The calculation is run as a dependency graph: conformers -> optimization -> {RESP2LIQUID, RESP2GAS, RESP1}
+    -> charge files. Only the ESP branches required by the requested charge types and deltas are calculated
+    (see required_branches). They run in parallel if nworkers > 1, except RESP2GAS, which uses the gas phase
+    ESP calculated together with RESP2LIQUID if both are required (see generate_esp).
+    One charge file is written for every combination of charge type and delta.
+
     :param folder: folder to write the output files.
     :param opt: True when generated conformers should be locally optimized.
     :param name: Name of the compound
@@ -700,34 +1649,150 @@ def create_RESP2(smi = None,folder='', opt=True, name='', resname='MOL', delta=1
     :param folder: Name of the folder for the target. If not specified. {name}-liquid is used.
     :param resname: Abbreviation of the Residue. Specified in the mol2
     :param delta: Fraction (in percent) of liquid charges. default=1.0
-    :return:
+    :param nworkers: Maximum number of stages running at the same time. default=1 (sequential)
+    :param nthreads: Number of threads per psi4 optimization job. default=None (sized from host and molecule)
+    :param timeout: Wall-clock limit in seconds for every external program call. default=None
+    :param resume: Skip stages which already finished for the same inputs (see manifest). default=True
+    :param charge_types: Charge models to create (RESP1 and/or RESP2). default=('RESP2',)
+    :param deltas: List of mixing parameters. Overrides delta if given.
+    :param dry_run: Only print the jobs the calculation would launch with their estimated resources (see plan).
+    :param executor: concurrent.futures.Executor running the stages (see executors). default=None (local)
+    :param status_file: JSON file the progress (jobs per stage, throughput, ETA) is written to. default=None
+    :param report_interval: Seconds between progress reports in the log and the status file. default=30
+    :param preset: Name of the level of theory preset (see presets). default=None (production)
+    :param preoptimize: Force field the omega conformers are pre-optimized and screened with before the QM
+                        optimization, e.g. MMFF94 (see conformers). default=None
+    :param deduplicate: Remove duplicate conformers after omega and after the optimization (see
+                        conformers.unique_conformers). default=False
+    :param adaptive: Choose the number of conformers from the flexibility of the molecule
+                     (see conformers.conformer_policy). default=False
+    :param sequential: Optimize and fit the conformers one after the other in order of increasing energy and
+                       stop once the charges converged (see sequential_charges). default=False
+    :return: 0, or the list of plan.PlannedJobs for a dry run
     """
 
     if folder is None:
         folder = name + '-liquid'
+    if deltas is None:
+        deltas = [delta]
+    if dry_run:
+        planned = plan.plan_molecule(name=name, smiles=smi, folder=folder, resname=resname, opt=opt,
+                                     charge_types=charge_types, deltas=deltas, preset=preset)
+        plan.write_table(planned)
+        return planned
     if not os.path.isdir(folder):
         os.mkdir(folder)
     infile = '{}.mol2'.format(resname)
-    infile_path = os.path.join(folder, '{}.mol2'.format(resname))
-    if not os.path.isfile(infile_path):
-        log.warning('Could not find file: {}'.format(infile_path))
-        if smi is not None:
-            log.warning('Create molecule from SMILES string')
-            outputfile = os.path.join(folder, resname + '.mol2')
-            mymol = pybel.readstring("smi", smi)
-            mymol.addh()
-            mymol.make3D()
-            mymol.write(format='mol2',filename=outputfile, overwrite=True)
+    infile_path = create_structure(smi=smi, folder=folder, resname=resname)
     outfile = '{}-conformers.mol2'.format(resname)
-    number_of_conformers = create_conformers(infile=infile, outfile=outfile,resname = resname,folder = folder)
-    optimize_conformers(name=name, resname=resname, opt=opt, number_of_conformers=number_of_conformers,folder = folder)
-    create_respyte(name=name, resname=resname, type='RESP2LIQUID', number_of_conformers=number_of_conformers)
-    create_respyte(name=name, resname=resname, type='RESP2GAS', number_of_conformers=number_of_conformers)
-    create_respyte(name=name, resname=resname, type='RESP1', number_of_conformers=number_of_conformers)
-    create_charge_file(name=name, resname=resname, type='RESP1', delta=delta)
+    # The ESP branches are started most expensive first; without input structure they are equally ranked
+    branch_cost = {}
+    if os.path.isfile(infile_path):
+        cost_model = cost.get_cost_model()
+        elements = cost.read_elements(infile_path)
+        levels = presets.get_preset(preset).esp_levels
+        branch_cost = {type: cost_model.estimate_esp(elements, type, levels) for type in levels}
+    branches = required_branches(charge_types=charge_types, deltas=deltas)
+    log.info('Charge models {} with deltas {} require the QM branches {}'.format(list(charge_types), list(deltas),
+                                                                                 branches))
+    stages = ['conformers', 'sequential'] + branches
+    if not resume:
+        for stage in stages:
+            manifest.invalidate(folder, stage)
+    # Every stage writes a manifest when it is finished; a rerun skips complete stages
+    tasks = [scheduler.Task('conformers', manifest.run_stage,
+                            dict(folder=folder, stage='conformers', function=create_conformers,
+                                 kwargs=dict(infile=infile, outfile=outfile, resname=resname, folder=folder,
+                                             preoptimize=preoptimize, deduplicate=deduplicate,
+                                             adaptive=adaptive),
+                                 inputs=[infile_path],
+                                 outputs=[os.path.join(folder, resname + '-conformers_*.mol2')]))]
+    if sequential:
+        # Optimizations, ESPs and fits of all branches conformer by conformer
+        tasks.append(scheduler.Task('sequential', manifest.run_stage,
+                                    dict(folder=folder, stage='sequential', function=sequential_charges,
+                                         kwargs=dict(name=name, resname=resname, folder=folder, branches=branches,
+                                                     timeout=timeout, preset=preset,
+                                                     number_of_conformers=scheduler.Result('conformers')),
+                                         inputs=[os.path.join(folder, resname + '-conformers_*.mol2')],
+                                         outputs=['{}-{}/resp_output/mol1_conf1.mol2'.format(name, type)
+                                                  for type in branches])))
+    else:
+        tasks.append(scheduler.Task('optimization', optimize_conformers,
+                                    dict(name=name, resname=resname, opt=opt, folder=folder, nthreads=nthreads,
+                                         timeout=timeout, resume=resume, preset=preset,
+                                         number_of_conformers=scheduler.Result('conformers'))))
+        # Conformers which ended in the same minimum get no ESP calculations
+        optimized = 'conformers'
+        if deduplicate:
+            tasks.append(scheduler.Task('deduplication', deduplicate_optimized,
+                                        dict(name=name, resname=resname, folder=folder, preset=preset,
+                                             number_of_conformers=scheduler.Result('conformers')),
+                                        requires=['optimization']))
+            optimized = 'deduplication'
+        # The gas phase ESP is calculated in the sessions of RESP2LIQUID if both are needed
+        pair = paired_branches(branches)
+        for type in branches:
+            tasks.append(scheduler.Task(type, manifest.run_stage,
+                                        dict(folder=folder, stage=type, function=create_respyte,
+                                             kwargs=dict(name=name, resname=resname, type=type, opt_folder=folder,
+                                                         timeout=timeout, pair=pair, preset=preset,
+                                                         number_of_conformers=scheduler.Result(optimized)),
+                                             inputs=[os.path.join(folder, resname + '-confermers_opt_*.xyz')],
+                                             outputs=['{}-{}/resp_output/mol1_conf1.mol2'.format(name, type)]),
+                                        requires=['optimization'] +
+                                        (['RESP2LIQUID'] if pair and type == 'RESP2GAS' else []),
+                                        cost=branch_cost.get(type, 0.0)))
+    for charge_type in charge_types:
+        for value in deltas:
+            tasks.append(scheduler.Task('charges {} {}'.format(charge_type, value), create_charge_file,
+                                        dict(name=name, resname=resname, type=charge_type, delta=value),
+                                        requires=['sequential'] if sequential else
+                                        required_branches(charge_types=[charge_type], deltas=[value])))
+    # Stages run by other processes report their jobs through a journal in the folder of the molecule
+    journal = tempfile.mkdtemp(prefix='.progress-', dir=folder)
+    for task in tasks:
+        task.function = progress.Forwarded(task.function, journal)
+    previous_handler = manifest.install_sigterm_handler()
+    reporter = progress.Reporter(path=status_file, interval=report_interval, journal=journal).start()
+    try:
+        scheduler.run_task_graph(tasks, max_workers=nworkers, executor=executor)
+    except manifest.Preempted:
+        log.error('Calculation of {} was preempted. Finished stages are checkpointed, rerun to continue.'.format(name))
+        raise
+    finally:
+        reporter.stop()
+        shutil.rmtree(journal, ignore_errors=True)
+        if previous_handler is not None:
+            signal.signal(signal.SIGTERM, previous_handler)
     return 0
 
 
+async def create_RESP2_async(smi=None, name='', resname='MOL', delta=1.0, charge_types=('RESP2',), deltas=None,
+                             sequential=False, **kwargs):
+    """
+    Coroutine counterpart of create_RESP2. The calculation runs in a worker thread, so the event loop
+    stays free for other work (e.g. building the topology of molecules which are already finished).
+
+    :param smi: SMILES Code of the molecule.
+    :param name: Name of the compound
+    :param resname: Abbreviation of the Residue.
+    :param delta: Mixing parameter. Used if deltas is not given.
+    :param charge_types: Charge models to create (RESP1 and/or RESP2).
+    :param deltas: List of mixing parameters.
+    :param sequential: Stop adding conformers once the charges converged (see sequential_charges).
+    :param kwargs: Further keyword arguments of create_RESP2.
+    :return: List of dictionaries with the keys type, delta, file and charges (see collect_charges).
+    """
+    if deltas is None:
+        deltas = [delta]
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, functools.partial(create_RESP2, smi=smi, name=name, resname=resname,
+                                                       charge_types=charge_types, deltas=deltas,
+                                                       sequential=sequential, **kwargs))
+    return collect_charges(name=name, resname=resname, charge_types=charge_types, deltas=deltas)
+
+
 if __name__ == "__main__":
     log.getLogger().setLevel(log.INFO)
     #create_RESP2(smi = 'CO', opt=True, name='methanol2', resname='MET', folder='methanol-liquid')\
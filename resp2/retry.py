@@ -0,0 +1,159 @@
+"""
+retry.py retries failed psi4 jobs with escalating settings.
+
+A rare SCF or optimization failure should not cost a whole molecule. A failed job is rerun up to
+RetryPolicy.max_attempts times, and every attempt uses the next, more conservative settings of the
+policy's escalation list:
+
+1. the original settings
+2. a different SCF guess and more SCF iterations
+3. additionally damping, a looser optimization convergence, a restart from the last geometry of
+   the failed attempt and twice the memory
+4. additionally the core guess
+
+Every attempt is appended to {folder}/attempts.jsonl with its settings, outcome and wall-clock time.
+"""
+
+import json
+import logging as log
+import os
+import re
+import time
+
+ESCALATIONS = [dict(),
+               dict(options={'guess': 'gwh', 'maxiter': 200}),
+               dict(options={'guess': 'gwh', 'maxiter': 300, 'damping_percentage': 20,
+                             'g_convergence': 'gau_loose'}, restart=True, memory_factor=2.0),
+               dict(options={'guess': 'core', 'maxiter': 300, 'damping_percentage': 20,
+                             'g_convergence': 'gau_loose'}, restart=True, memory_factor=2.0)]
+
+ATTEMPTS_FILE = 'attempts.jsonl'
+
+# Lines of a psi4 input which start a calculation. Escalated options are set before the first one.
+_CALCULATION = re.compile(r'^\s*(\w+\s*(,\s*\w+\s*)*=\s*)?(energy|optimize|opt|gradient|properties|prop)\(')
+_MEMORY = re.compile(r'^\s*memory\s+([0-9.]+)\s*(\w+)', re.IGNORECASE | re.MULTILINE)
+
+
+class RetryPolicy(object):
+    """
+    :param max_attempts: Maximum number of attempts of a job (including the first one).
+    :param escalations: List of escalations (see ESCALATIONS). Attempts beyond its length use the last one.
+    """
+
+    def __init__(self, max_attempts=3, escalations=None):
+        self.max_attempts = max_attempts
+        self.escalations = escalations if escalations is not None else ESCALATIONS
+
+    def escalation(self, attempt):
+        """
+        :param attempt: Number of the attempt, starting with 1.
+        :return: Dictionary with the optional keys options (psi4 options), restart (restart from the last
+                 geometry) and memory_factor.
+        """
+        return self.escalations[min(attempt, len(self.escalations)) - 1]
+
+    def retry(self, attempt):
+        """
+        :return: True if another attempt follows the failed attempt number attempt.
+        """
+        return attempt < self.max_attempts
+
+
+def escalate_input(text, escalation):
+    """
+    Applies an escalation to a psi4 input.
+
+    :param text: Content of the psi4 input file.
+    :param escalation: Dictionary (see RetryPolicy.escalation).
+    :return: Content of the escalated input file.
+    """
+    factor = escalation.get('memory_factor')
+    if factor:
+        text = _MEMORY.sub(lambda match: 'memory {:g} {}'.format(float(match.group(1)) * factor, match.group(2)),
+                           text, count=1)
+    options = escalation.get('options')
+    if not options:
+        return text
+    settings = ''.join('set {} {}\n'.format(key, value) for key, value in sorted(options.items()))
+    lines = text.splitlines(True)
+    for k, line in enumerate(lines):
+        if _CALCULATION.match(line):
+            return ''.join(lines[:k]) + settings + ''.join(lines[k:])
+    return text + '\n' + settings
+
+
+def last_geometry(psi4_output_file):
+    """
+    Reads the last geometry psi4 printed, e.g. the last step of a failed optimization.
+
+    :param psi4_output_file: Path to the psi4 output file.
+    :return: List of xyz lines (symbol x y z) in Angstrom, or None if no geometry was found.
+    """
+    if not os.path.isfile(psi4_output_file):
+        return None
+    lines = open(psi4_output_file).readlines()
+    geometry = None
+    for k, line in enumerate(lines):
+        if 'Geometry (in Angstrom)' not in line:
+            continue
+        coordinates = []
+        # Header line, column names and a separator precede the atoms
+        for atom in lines[k + 4:]:
+            fields = atom.split()
+            if len(fields) < 4:
+                break
+            try:
+                coordinates.append('{} {} {} {}\n'.format(re.sub(r'\d', '', fields[0]), *[float(x) for x in fields[1:4]]))
+            except ValueError:
+                break
+        if coordinates:
+            geometry = coordinates
+    return geometry
+
+
+def record_attempt(folder, stage, conformer, attempt, escalation, success, elapsed=None, message=None):
+    """
+    Appends an attempt of a job to {folder}/attempts.jsonl.
+
+    :param folder: Folder of the molecule.
+    :param stage: Name of the stage, e.g. optimization or RESP2LIQUID.
+    :param conformer: Number of the conformer.
+    :param attempt: Number of the attempt, starting with 1.
+    :param escalation: Escalation used for the attempt.
+    :param success: True if the attempt was successful.
+    :param elapsed: Wall-clock time in seconds.
+    :param message: Optional note, e.g. why no retry was possible.
+    :return: 0 if successful
+    """
+    try:
+        with open(os.path.join(folder, ATTEMPTS_FILE), 'a') as f:
+            f.write(json.dumps(dict(stage=stage, conformer=conformer, attempt=attempt, escalation=escalation,
+                                    success=bool(success), elapsed=elapsed, time=time.time(), message=message)) + '\n')
+    except OSError as e:
+        log.warning('Could not record attempt in {}: {}'.format(folder, e))
+    return 0
+
+
+def load_attempts(folder):
+    """
+    :param folder: Folder of the molecule.
+    :return: List of all recorded attempts (dictionaries).
+    """
+    path = os.path.join(folder, ATTEMPTS_FILE)
+    if not os.path.isfile(path):
+        return []
+    return [json.loads(line) for line in open(path) if line.strip()]
+
+
+def keep_failed_output(psi4_output_file, attempt):
+    """
+    Renames the output of a failed attempt to {output}.attempt{attempt}, so that the next attempt does not
+    overwrite it.
+
+    :return: New path of the output file, or None if it does not exist.
+    """
+    if not os.path.isfile(psi4_output_file):
+        return None
+    path = '{}.attempt{}'.format(psi4_output_file, attempt)
+    os.replace(psi4_output_file, path)
+    return path
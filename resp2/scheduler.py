@@ -0,0 +1,131 @@
+"""
+scheduler.py runs the stages of a charge calculation as a small dependency graph.
+
+A stage is started as soon as all stages it depends on have finished. Stages which do not depend
+on each other (e.g. the RESP1, RESP2GAS and RESP2LIQUID ESP branches) are executed at the same time
+in a process pool. All stages work on explicit paths, so a thread pool (executors.ThreadExecutor)
+works as well. Any other executor (see executors) can be used instead, e.g. to run the stages on
+several nodes.
+"""
+
+import concurrent.futures
+import logging as log
+
+try:
+    import resp2.executors as executors
+except ModuleNotFoundError:
+    import executors
+
+
+class Result(object):
+    """
+    Placeholder for the return value of another task.
+    It can be used as keyword argument of a task and is replaced by the actual value before the task starts.
+    Using a Result as argument implicitly adds a dependency on the corresponding task.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+
+def _placeholders(value):
+    """
+    :return: Names of all Result placeholders in a value (also inside lists and dictionaries).
+    """
+    if isinstance(value, Result):
+        return {value.name}
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return set().union(*[_placeholders(item) for item in value]) if value else set()
+    return set()
+
+
+def _resolve(value, results):
+    if isinstance(value, Result):
+        return results[value.name]
+    if isinstance(value, dict):
+        return {key: _resolve(item, results) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_resolve(item, results) for item in value)
+    return value
+
+
+class Task(object):
+    """
+    A single node of the dependency graph.
+
+    :param name: Unique name of the task.
+    :param function: Function to call. Has to be picklable (module level) if the graph runs in parallel.
+    :param kwargs: Keyword arguments for the function. Values (also inside lists and dictionaries)
+                   can be Result placeholders.
+    :param requires: Names of the tasks which have to be finished before this task can start.
+    :param cost: Estimated cost of the task (see cost.CostModel). Ready tasks start most expensive first.
+    """
+
+    def __init__(self, name, function, kwargs=None, requires=(), cost=0.0):
+        self.name = name
+        self.cost = cost
+        self.function = function
+        self.kwargs = dict(kwargs or {})
+        self.requires = set(requires) | _placeholders(self.kwargs)
+
+    def resolve(self, results):
+        """
+        Replaces all Result placeholders with the return values of the finished tasks.
+
+        :param results: Dictionary of task name -> return value
+        :return: Keyword arguments ready to be passed to the function
+        """
+        return _resolve(self.kwargs, results)
+
+
+def run_task_graph(tasks, max_workers=1, executor=None):
+    """
+    Executes all tasks respecting their dependencies. Independent tasks are executed in parallel,
+    with at most max_workers tasks running at the same time.
+
+    :param tasks: List of Task objects.
+    :param max_workers: Worker budget. With 1 all tasks are run sequentially in the current process.
+    :param executor: concurrent.futures.Executor to run the tasks with (see executors). It is not shut down.
+                     default=None (a process pool with max_workers processes, or inline for 1)
+    :return: Dictionary of task name -> return value of the task.
+    """
+    pending = {task.name: task for task in tasks}
+    if len(pending) != len(tasks):
+        raise ValueError('Task names have to be unique')
+    for task in pending.values():
+        missing = task.requires - set(pending)
+        if missing:
+            raise ValueError('Task {} depends on unknown tasks {}'.format(task.name, sorted(missing)))
+
+    results = {}
+    running = {}
+    pool = executor
+    if executor is None:
+        pool = executors.LocalExecutor(max_workers=max_workers) if max_workers > 1 else executors.InlineExecutor()
+    finished = False
+    try:
+        while pending or running:
+            ready = sorted([name for name, task in pending.items() if task.requires <= set(results)],
+                           key=lambda name: -pending[name].cost)
+            # Tasks are only handed to the pool when a worker is free, so that a task which becomes
+            # ready later can still overtake cheaper tasks (longest job first)
+            for name in ready[:max(max_workers - len(running), 0)]:
+                task = pending.pop(name)
+                log.info('Starting task {}'.format(name))
+                running[pool.submit(task.function, **task.resolve(results))] = name
+            if not running:
+                raise ValueError('Cyclic dependencies between tasks {}'.format(sorted(pending)))
+            done, _ = concurrent.futures.wait(list(running), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                # Re-raises the exception of a failed task; tasks depending on it are never started.
+                results[name] = future.result()
+                log.info('Finished task {}'.format(name))
+        finished = True
+    finally:
+        if executor is None:
+            # After a failure (or preemption) queued tasks are dropped instead of waited for
+            pool.shutdown(wait=finished, cancel_futures=not finished)
+    return results
@@ -0,0 +1,99 @@
+"""
+Writes the fixture of test_esp.test_resp_fit_matches_reference: two conformers of dimethyl ether in the
+layout of respyte (input/molecules/mol1/conf{i}/mol1_conf{i}.xyz and .espf) and reference.json.
+
+The ESP is the one of atomic point charges plus two lone pair sites on the oxygen, so that the fit is
+not exact and the restraints matter. The reference charges are fitted with the two stage RESP of AMBER
+and respyte (2-stg-fit, restraint settings of respyte.yml) written with Lagrange multipliers for the
+total charge, the equivalences and the fixed charges of the second stage, independently of esp.resp_fit.
+The equivalences are given by hand. Running respyte's resp_optimizer on input/ gives charges to compare.
+
+    python make_reference.py
+"""
+
+import json
+import os
+
+import numpy as np
+
+from resp2 import esp
+
+ELEMENTS = ['C', 'O', 'C', 'H', 'H', 'H', 'H', 'H', 'H']
+CONFORMERS = [np.array([[-1.166, 0.198, 0.000], [0.000, -0.582, 0.000], [1.166, 0.198, 0.000],
+                        [-2.032, -0.463, 0.000], [-1.196, 0.840, 0.892], [-1.196, 0.840, -0.892],
+                        [2.032, -0.463, 0.000], [1.196, 0.840, 0.892], [1.196, 0.840, -0.892]]),
+              np.array([[-1.170, 0.195, 0.010], [0.000, -0.585, 0.000], [1.168, 0.201, -0.012],
+                        [-2.020, -0.480, 0.120], [-1.230, 0.870, 0.860], [-1.150, 0.810, -0.920],
+                        [2.040, -0.450, -0.050], [1.160, 0.830, 0.910], [1.230, 0.860, -0.860]])]
+CHARGES = np.array([0.10, -0.38, 0.10, 0.03, 0.03, 0.03, 0.03, 0.03, 0.03])
+# Lone pair sites (offset from the oxygen in Angstrom) and their charge; the oxygen carries the opposite
+LONE_PAIRS = [np.array([0.0, -0.3, 0.25]), np.array([0.0, -0.3, -0.25])]
+LONE_PAIR_CHARGE = -0.05
+
+# Stage 1: the carbons are equivalent. Stage 2: carbons and all methyl hydrogens are refitted, the
+# carbons and the hydrogens are equivalent, the oxygen keeps its charge of stage 1.
+STAGE1_EQUIVALENT = [[0, 2]]
+STAGE2_FREE = [0, 2, 3, 4, 5, 6, 7, 8]
+STAGE2_EQUIVALENT = [[0, 2], [3, 4, 5, 6, 7, 8]]
+
+
+def reference_fit(A, B, a, b, equivalent, fixed, restrained, tolerance=1e-8):
+    n = len(B)
+    constraints, values = [np.ones(n)], [0.0]
+    for group in equivalent:
+        for i in group[1:]:
+            row = np.zeros(n)
+            row[group[0]], row[i] = 1.0, -1.0
+            constraints.append(row)
+            values.append(0.0)
+    for i, value in fixed.items():
+        row = np.zeros(n)
+        row[i] = 1.0
+        constraints.append(row)
+        values.append(value)
+    C = np.array(constraints)
+    q = np.zeros(n)
+    for _ in range(1000):
+        R = np.diag(np.where(restrained, a / np.sqrt(q ** 2 + b ** 2), 0.0))
+        system = np.block([[A + R, C.T], [C, np.zeros((len(C), len(C)))]])
+        q_new = np.linalg.solve(system, np.append(B, values))[:n]
+        if np.max(np.abs(q_new - q)) < tolerance:
+            return q_new
+        q = q_new
+    return q
+
+
+def main():
+    folder = os.path.dirname(os.path.abspath(__file__))
+    A, B = np.zeros((len(ELEMENTS), len(ELEMENTS))), np.zeros(len(ELEMENTS))
+    for i, coordinates in enumerate(CONFORMERS, 1):
+        grid = esp.msk_grid(ELEMENTS, coordinates)
+        sites = np.vstack([coordinates] + [coordinates[1] + offset for offset in LONE_PAIRS])
+        charges = np.append(CHARGES, [LONE_PAIR_CHARGE] * len(LONE_PAIRS))
+        charges[1] -= LONE_PAIR_CHARGE * len(LONE_PAIRS)
+        values = esp.coulomb_matrix(sites, grid) @ charges
+        conf_folder = os.path.join(folder, 'input', 'molecules', 'mol1', 'conf{}'.format(i))
+        if not os.path.isdir(conf_folder):
+            os.makedirs(conf_folder)
+        with open(os.path.join(conf_folder, 'mol1_conf{}.xyz'.format(i)), 'w') as f:
+            f.write('{}\ndimethyl ether conformer {}\n'.format(len(ELEMENTS), i))
+            f.writelines('{} {:.6f} {:.6f} {:.6f}\n'.format(e, *xyz) for e, xyz in zip(ELEMENTS, coordinates))
+        with open(os.path.join(conf_folder, 'mol1_conf{}.espf'.format(i)), 'w') as f:
+            f.writelines('{:>16.10f} {:>16.10f} {:>16.10f} {:>16.10f}\n'.format(*point, value)
+                         for point, value in zip(grid, values))
+        # The fit uses the points and values as written
+        C = esp.coulomb_matrix(coordinates, np.round(grid, 10))
+        A += C.T @ C
+        B += C.T @ np.round(values, 10)
+    restrained = np.array([element != 'H' for element in ELEMENTS])
+    restraint = esp.RESPYTE_RESTRAINT
+    stage1 = reference_fit(A, B, restraint['a1'], restraint['b'], STAGE1_EQUIVALENT, {}, restrained)
+    fixed = {i: stage1[i] for i in range(len(ELEMENTS)) if i not in STAGE2_FREE}
+    stage2 = reference_fit(A, B, restraint['a2'], restraint['b'], STAGE2_EQUIVALENT, fixed, restrained)
+    with open(os.path.join(folder, 'reference.json'), 'w') as f:
+        json.dump(dict(elements=ELEMENTS, restraint=restraint, stage1=list(stage1), charges=list(stage2)), f,
+                  indent=1)
+
+
+if __name__ == '__main__':
+    main()
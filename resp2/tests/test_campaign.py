@@ -0,0 +1,51 @@
+"""
+Tests for the batch campaign runner and its job database.
+"""
+
+import pytest
+from resp2 import campaign
+
+
+def test_read_smiles_table(tmpdir):
+    table = tmpdir.join('table.csv')
+    table.write('RESP2_0.50 LJ opt. [g/l],RESP1 SMIRNOFF [g/l]\n1,OC,786.600,767.353\n2,C-C#N,787.450,728.954\n')
+    molecules = campaign.read_smiles_table(str(table))
+    assert [molecule['smiles'] for molecule in molecules] == ['OC', 'C-C#N']
+    assert molecules[1]['index'] == 2 and molecules[1]['properties'] == ['787.450', '728.954']
+    assert campaign.molecule_resname(1) == 'M01' and len(campaign.molecule_resname(1000)) == 3
+
+
+def test_job_database(tmpdir):
+    db = campaign.JobDatabase(str(tmpdir.join('campaign.db')))
+    db.add_molecule('mol0001', 'OC', 'M01')
+    with db.job('mol0001', 'structure'):
+        pass
+    db.add_job('mol0001', 'optimization', 1)
+    db.add_job('mol0001', 'optimization', 2)
+    db.update_job('mol0001', 'optimization', 1, 'running')
+    with pytest.raises(RuntimeError):
+        with db.job('mol0001', 'optimization', 2):
+            raise RuntimeError('SCF did not converge')
+    assert db.summary() == {'structure': {'done': 1}, 'optimization': {'running': 1, 'failed': 1}}
+    failed = db.jobs(status='failed')
+    assert len(failed) == 1 and 'SCF' in failed[0]['message'] and failed[0]['elapsed'] >= 0
+    assert db.molecules()[0]['status'] == 'queued'
+
+
+def test_failed_esp_conformer_fails_the_molecule(tmpdir, monkeypatch):
+    from resp2 import resp2 as r
+    fitted = []
+    monkeypatch.setattr(r, 'create_structure', lambda **kwargs: None)
+    monkeypatch.setattr(r, 'create_conformers', lambda **kwargs: 2)
+    monkeypatch.setattr(r, 'optimize_conformers', lambda **kwargs: {1: True, 2: True})
+    monkeypatch.setattr(r, 'prepare_respyte', lambda **kwargs: 0)
+    monkeypatch.setattr(r, 'generate_esp', lambda **kwargs: {1: True, 2: False})
+    monkeypatch.setattr(r, 'fit_respyte', lambda type='RESP1', **kwargs: fitted.append(type))
+    monkeypatch.setattr(r, 'create_charge_file', lambda **kwargs: 0)
+    db = str(tmpdir.join('campaign.db'))
+    campaign.JobDatabase(db).add_molecule('mol0001', 'OC', 'M01')
+    assert not campaign.run_molecule(db=db, name='mol0001', smiles='OC', resname='M01', workdir=str(tmpdir),
+                                     charge_type='RESP1')
+    database = campaign.JobDatabase(db)
+    assert database.molecules()[0]['status'] == 'failed' and fitted == []
+    assert database.summary()['RESP1'] == {'done': 1, 'failed': 1}
@@ -0,0 +1,86 @@
+"""
+Tests for the preparation of the omega conformers.
+"""
+
+import os
+import numpy as np
+from resp2 import conformers, cost, esp, manifest, psi4pool, resp2
+
+
+def test_select_and_renumber_conformers(tmpdir):
+    # Energies in kcal/mol, the third conformer failed
+    assert conformers.select_conformers([3.0, 0.5, None, 7.0, 1.0], window=5.0) == [1, 4, 0]
+    folder = str(tmpdir)
+    for i in range(1, 5):
+        for extension in ['.mol2', '.xyz']:
+            tmpdir.join('MOL-conformers_{}{}'.format(i, extension)).write(str(i))
+    assert conformers.renumber_conformers(folder, 'MOL', [2, 4, 1], 4) == 3
+    for extension in ['.mol2', '.xyz']:
+        assert [tmpdir.join('MOL-conformers_{}{}'.format(k, extension)).read() for k in [1, 2, 3]] == ['2', '4', '1']
+        assert not tmpdir.join('MOL-conformers_4' + extension).check()
+
+
+def test_replace_mol2_coordinates():
+    lines = ['@<TRIPOS>ATOM\n',
+             '      1 C1          1.0616   -0.2681   -0.0006 C.3       1 ETH1        0.0000\n',
+             '      2 O1          1.5170    1.3236   -1.7228 O.3       1 ETH1       -0.6800\n',
+             '@<TRIPOS>BOND\n', '     1    1    2 1\n']
+    new = conformers.replace_mol2_coordinates(lines, [(0.0, 0.0, 0.0), (1.4, 0.0, -0.1)])
+    assert new[2].split() == ['2', 'O1', '1.4000', '0.0000', '-0.1000', 'O.3', '1', 'ETH1', '-0.6800']
+    assert new[3:] == lines[3:]
+
+
+def _rotation(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]])
+
+
+def test_rmsd_with_symmetry():
+    # Acetate like fragment: the two oxygens can be exchanged
+    elements = ['C', 'C', 'O', 'O']
+    x = np.array([[0.0, 0.0, 0.0], [1.5, 0.0, 0.0], [2.2, 1.1, 0.0], [2.0, -0.9, 1.0]])
+    permutations = conformers.symmetry_permutations(elements, esp.bond_matrix(elements, x))
+    assert [list(p) for p in permutations] == [[0, 1, 2, 3], [0, 1, 3, 2]]
+    swapped = x[[0, 1, 3, 2]] @ _rotation(0.7).T + 1.0
+    moved = x @ _rotation(-1.2).T - 2.0
+    rmsd = conformers.rmsd_matrix(np.array([x, moved, swapped]))
+    assert rmsd[0, 1] < 1e-6 and rmsd[0, 2] > 0.1
+    assert conformers.rmsd_matrix(np.array([x, moved, swapped]), permutations).max() < 1e-6
+
+
+def test_deduplicate_optimized(tmpdir):
+    folder = str(tmpdir)
+    elements = ['C', 'O', 'H', 'H', 'H', 'H']
+    x = np.array([[0.0, 0.0, 0.0], [1.42, 0.0, 0.0], [1.75, 0.9, 0.0],
+                  [-0.4, 1.0, 0.0], [-0.4, -0.5, 0.9], [-0.4, -0.5, -0.9]])
+    rotated = x.copy()
+    rotated[2] = [1.75, -0.45, 0.78]
+    geometries = {1: x, 2: x @ _rotation(1.0).T, 3: rotated, 4: x + 0.01}
+    energies = {1: -115.0, 2: -115.00001, 3: -115.001, 4: None}
+    for i, geometry in geometries.items():
+        psi4pool.write_xyz(str(tmpdir.join('MOL-confermers_opt_{}.xyz'.format(i))),
+                           ['{} {} {} {}'.format(e, *xyz) for e, xyz in zip(elements, geometry)])
+        tmpdir.join('MOL-conformers_{}.xyz'.format(i)).write(str(i))
+        if energies[i] is not None:
+            tmpdir.join('MOL-conformers_{}.out'.format(i)).write('Final energy is {}\n'.format(energies[i]))
+        manifest.write_manifest(folder, 'optimization_{}'.format(i), [str(tmpdir.join('MOL-conformers_{}.xyz'.format(i)))],
+                                cost.OPTIMIZATION_LADDER, [str(tmpdir.join('MOL-confermers_opt_{}.xyz'.format(i)))])
+    # 2 and 4 are 1 again, 3 differs in the hydroxyl hydrogen
+    assert resp2.deduplicate_optimized(resname='MOL', number_of_conformers=4, folder=folder) == 2
+    assert tmpdir.join('MOL-conformers_2.xyz').read() == '3' and not tmpdir.join('MOL-conformers_3.xyz').check()
+    assert manifest.read_manifest(folder, 'optimization_2', [str(tmpdir.join('MOL-conformers_2.xyz'))],
+                                  cost.OPTIMIZATION_LADDER) is not None
+    assert not os.path.isfile(manifest.manifest_path(folder, 'optimization_3'))
+
+
+def test_conformer_budget():
+    data = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+    # Ethanol: only the hydroxyl group gives distinct conformers
+    assert conformers.flexibility(os.path.join(data, 'ETH.mol2')) == dict(rotors=1, ring_atoms=0)
+    assert conformers.conformer_policy(rotors=0)[0] == 1
+    number, rms_range = conformers.conformer_policy(rotors=10)
+    assert number == conformers.MAX_ADAPTIVE_CONFORMERS and rms_range[0] > conformers.RMS_START
+    assert conformers.conformer_policy(ring_atoms=6)[0] == 3
+    # Every molecule gets one conformer, then the budget is shared in proportion to the wanted numbers
+    assert conformers.allocate_conformers([1, 2, 10], [1.0, 1.0, 2.0], budget=None) == [1, 2, 10]
+    assert conformers.allocate_conformers([1, 2, 10], [1.0, 1.0, 2.0], budget=12.0) == [1, 1, 5]
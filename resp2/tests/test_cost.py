@@ -0,0 +1,30 @@
+"""
+Tests for the QM cost model.
+"""
+
+from resp2 import cost
+
+
+def test_estimates_are_ordered():
+    model = cost.CostModel()
+    methanol = ['C', 'O', 'H', 'H', 'H', 'H']
+    fragment = ['C'] * 30 + ['N'] * 5 + ['O'] * 5 + ['H'] * 30
+    assert cost.count_basis_functions(methanol, '6-31G*') == 38
+    assert model.estimate_esp(methanol, 'RESP1') < model.estimate_esp(methanol, 'RESP2GAS') \
+        < model.estimate_esp(methanol, 'RESP2LIQUID')
+    assert model.estimate_optimization(methanol) < model.estimate_optimization(fragment)
+    # The optional HF Hessian adds to the optimization unless the first step is not HF
+    assert model.estimate_optimization(methanol, hessian=True) > model.estimate_optimization(methanol)
+    dft = [('PW6B95', 'cc-pV(D+d)Z')] * 2
+    assert model.estimate_optimization(methanol, dft, hessian=True) == model.estimate_optimization(methanol, dft)
+
+
+def test_calibration(tmpdir):
+    path = str(tmpdir.join('timings.jsonl'))
+    methanol = ['C', 'O', 'H', 'H', 'H', 'H']
+    default = cost.CostModel().estimate_esp(methanol, 'RESP1')
+    cost.record_timing('HF', '6-31G*', False, 'sp', methanol, default * 4, threads=1, path=path)
+    model = cost.CostModel.load(path)
+    assert abs(model.estimate_esp(methanol, 'RESP1') / default - 4) < 1e-6
+    # Levels without timings are scaled with the average correction
+    assert abs(model.estimate_esp(methanol, 'RESP2GAS') / cost.CostModel().estimate_esp(methanol, 'RESP2GAS') - 4) < 1e-6
@@ -0,0 +1,44 @@
+"""
+Tests for the charge daemon with a fake pipeline.
+"""
+
+import asyncio
+import threading
+import time
+from resp2 import daemon, pipeline
+
+calls = []
+
+
+def fake_charges(molecule):
+    calls.append(molecule['smiles'])
+    time.sleep(0.1 * len(molecule['smiles']))
+    molecule['charges'] = [dict(type='RESP2', delta=1.0, file=None, charges=[0.0] * len(molecule['smiles']))]
+    return molecule
+
+
+def test_daemon(tmpdir):
+    path = str(tmpdir.join('resp2.sock'))
+    fake = pipeline.Pipeline([pipeline.Stage('charges', fake_charges, workers=2)])
+    service = daemon.ChargeDaemon(path, workdir=str(tmpdir), charge_pipeline=fake)
+    thread = threading.Thread(target=asyncio.run, args=(service.serve(),), daemon=True)
+    thread.start()
+    for _ in range(100):
+        if service._server is not None:
+            break
+        time.sleep(0.05)
+    del calls[:]
+    requests = [dict(smiles='CCCCO'), dict(smiles='C'), dict(smiles='CCCCO'), dict(resname='BAD')]
+    responses = list(daemon.request_charges(requests, path))
+    assert len(responses) == 4
+    # Results stream back in the order they are finished; the invalid request is answered first
+    assert responses[0]['id'] == 3 and responses[0]['error'] is not None
+    assert responses[1]['id'] == 1
+    assert sorted(response['id'] for response in responses[2:]) == [0, 2]
+    # The duplicate request is calculated only once, a finished result is reused
+    assert sorted(calls) == ['C', 'CCCCO']
+    assert [response['id'] for response in daemon.request_charges([dict(smiles='C')], path)] == [0]
+    assert len(calls) == 2
+    service.stop()
+    thread.join(5)
+    assert not thread.is_alive()
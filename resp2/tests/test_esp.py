@@ -0,0 +1,144 @@
+"""
+Tests for the ESP arrays, the MSK grid and the RESP fit.
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+
+from resp2 import esp, psi4pool
+from resp2 import resp2 as resp2_module
+
+ELEMENTS = ['C', 'O', 'H', 'H', 'H', 'H']
+COORDINATES = np.array([[-0.046, 0.663, 0.000], [-0.046, -0.756, 0.000], [-1.086, 0.976, 0.000],
+                        [0.438, 1.079, 0.890], [0.438, 1.079, -0.890], [0.860, -1.096, 0.000]])
+CHARGES = np.array([0.12, -0.60, 0.03, 0.03, 0.03, 0.39])
+
+MOL2 = """@<TRIPOS>MOLECULE
+MOL
+ 6 5 1 0 0
+SMALL
+GASTEIGER
+
+@<TRIPOS>ATOM
+{}@<TRIPOS>BOND
+     1     1     2    1
+"""
+
+
+def test_msk_grid_and_storage(tmpdir):
+    grid = esp.msk_grid(ELEMENTS, COORDINATES)
+    radii = np.array([esp.BONDI_RADII[element] for element in ELEMENTS])
+    distances = np.linalg.norm(grid[:, None, :] - COORDINATES[None, :, :], axis=2)
+    assert len(grid) > 100 and np.all(distances >= 1.4 * radii - 1e-6)
+    path = str(tmpdir.join('conf1.npz'))
+    esp.save_esp(path, grid, np.ones(len(grid)), elements=ELEMENTS, coordinates=COORDINATES)
+    data = esp.load_esp(path)
+    assert np.allclose(data['grid'], grid) and list(data['elements']) == ELEMENTS
+
+
+def test_resp_fit_recovers_charges():
+    grid = esp.msk_grid(ELEMENTS, COORDINATES)
+    values = esp.coulomb_matrix(COORDINATES, grid) @ CHARGES
+    charges = esp.resp_fit(ELEMENTS, [(COORDINATES, grid, values)], a1=0.0, a2=0.0)
+    assert abs(charges.sum()) < 1e-8
+    # The methyl hydrogens are equivalent and the ESP is reproduced
+    assert np.allclose(charges, CHARGES, atol=1e-3)
+
+
+def test_esp_arrays_in_pool(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    os.makedirs('methanol-liquid')
+    psi4pool.write_xyz('methanol-liquid/MOL-confermers_opt_1.xyz',
+                       ['{} {} {} {}'.format(e, *xyz) for e, xyz in zip(ELEMENTS, COORDINATES)])
+    atoms = ''.join('{:>7} {:<3}{:>15}{:>10}{:>10} {:<3}{:>8}{:>5}{:>14.4f}\n'.format(
+        k + 1, e, *xyz, e, 1, 'MOL', 0.0) for k, (e, xyz) in enumerate(zip(ELEMENTS, COORDINATES)))
+    open('methanol-liquid/MOL-conformers_1.mol2', 'w').write(MOL2.format(atoms))
+    with psi4pool.Psi4Pool(backend='fake', charges=list(CHARGES)) as pool:
+        data = resp2_module.calculate_esp_arrays('RESP2GAS', 'methanol', pool=pool)
+    assert os.path.isfile('methanol-RESP2GAS/esp/mol1_conf1.npz')
+    charges = resp2_module.fit_esp_arrays('RESP2GAS', 'methanol', data=data)
+    _, written = resp2_module.read_mol2_charges('methanol-RESP2GAS/resp_output/mol1_conf1.mol2')
+    assert np.allclose(written, charges, atol=1e-4)
+    # Without data the fit reads the stored arrays
+    assert np.allclose(resp2_module.fit_esp_arrays('RESP2GAS', 'methanol'), charges)
+
+
+def test_sequential_charges_stop_when_converged(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    monkeypatch.setenv('RESP2_TIMINGS', str(tmpdir.join('timings.jsonl')))
+    os.makedirs('methanol-liquid')
+    # Conformers with different O-H bonds; conformer 4 is conformer 2 shifted
+    stretches = [1.6, 1.0, 2.2, 1.0, 2.8]
+    for i, stretch in enumerate(stretches, 1):
+        coordinates = COORDINATES.copy()
+        coordinates[5] = coordinates[1] + stretch * (coordinates[5] - coordinates[1])
+        psi4pool.write_xyz('methanol-liquid/MOL-conformers_{}.xyz'.format(i),
+                           ['{} {} {} {}'.format(e, *xyz) for e, xyz in zip(ELEMENTS, coordinates + 0.1 * (i == 4))])
+    atoms = ''.join('{:>7} {:<3}{:>15}{:>10}{:>10} {:<3}{:>8}{:>5}{:>14.4f}\n'.format(
+        k + 1, e, *xyz, e, 1, 'MOL', 0.0) for k, (e, xyz) in enumerate(zip(ELEMENTS, COORDINATES)))
+    open('methanol-liquid/MOL-conformers_1.mol2', 'w').write(MOL2.format(atoms))
+    with psi4pool.Psi4Pool(backend='fake', charges=list(CHARGES)) as pool:
+        record = resp2_module.sequential_charges('methanol', number_of_conformers=5, pool=pool, convert=False,
+                                                 branches=['RESP2GAS'], tolerance=0.02,
+                                                 energies=[2.0, 1.0, 3.0, 1.5, 4.0])
+    # Lowest energy first; the duplicate gets no ESP and the fifth conformer is skipped
+    assert record['order'] == [2, 1, 3] and record['duplicates'] == [4]
+    assert record['conformers'] == 3 and record['converged'] and record['available'] == 5
+    assert len(record['changes']) == 2 and record['changes'][-1] < 0.02
+    assert not os.path.isfile('methanol-liquid/MOL-confermers_opt_5.xyz')
+    assert not os.path.isfile('methanol-RESP2GAS/esp/mol1_conf4.npz')
+    assert os.path.isfile('methanol-liquid/MOL-sequential.json')
+    _, written = resp2_module.read_mol2_charges('methanol-RESP2GAS/resp_output/mol1_conf1.mol2')
+    data = {i: esp.load_esp('methanol-RESP2GAS/esp/mol1_conf{}.npz'.format(i)) for i in record['order']}
+    assert np.allclose(written, resp2_module.fit_esp_arrays('RESP2GAS', 'methanol', data=data), atol=1e-4)
+
+
+# Calculates the ESP of the point charges of the test on grid.dat, like psi4 with properties=['GRID_ESP']
+FAKE_PSI4 = """import sys
+import numpy as np
+sys.path.insert(0, {path!r})
+from resp2 import esp
+text = open('input.dat').read()
+block = text[text.index('0 1') + 4:text.index('}}')]
+coordinates = np.array([[float(x) for x in line.split()[1:4]] for line in block.splitlines() if line.split()])
+grid = np.loadtxt('grid.dat', ndmin=2)
+np.savetxt('grid_esp.dat', esp.coulomb_matrix(coordinates, grid) @ np.array({charges!r}))
+open('output.dat', 'w').write('Buy a developer a beer!\\n')
+"""
+
+
+def test_esp_arrays_without_pool(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    os.makedirs('methanol-liquid')
+    psi4pool.write_xyz('methanol-liquid/MOL-confermers_opt_1.xyz',
+                       ['{} {} {} {}'.format(e, *xyz) for e, xyz in zip(ELEMENTS, COORDINATES)])
+    tmpdir.mkdir('bin').join('psi4').write('#!/bin/sh\nexec "{}" "{}"\n'.format(sys.executable, tmpdir.join('psi4.py')))
+    tmpdir.join('bin', 'psi4').chmod(0o755)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(esp.__file__)))
+    tmpdir.join('psi4.py').write(FAKE_PSI4.format(path=root, charges=list(CHARGES)))
+    monkeypatch.setenv('PATH', str(tmpdir.join('bin')) + os.pathsep + os.environ['PATH'])
+    data = resp2_module.calculate_esp_arrays('RESP2GAS', 'methanol')
+    grid = esp.msk_grid(ELEMENTS, COORDINATES)
+    assert np.allclose(data[1]['esp'], esp.coulomb_matrix(COORDINATES, grid) @ CHARGES)
+    assert np.allclose(esp.load_esp('methanol-RESP2GAS/esp/mol1_conf1.npz')['esp'], data[1]['esp'])
+
+
+def test_resp_fit_matches_reference():
+    # ESP files of two conformers in respyte's format and the charges of a reference two stage fit
+    # (see data/respyte_fit/make_reference.py)
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'respyte_fit')
+    reference = json.load(open(os.path.join(folder, 'reference.json')))
+    conformers = []
+    for i in (1, 2):
+        conf_folder = os.path.join(folder, 'input', 'molecules', 'mol1', 'conf{}'.format(i))
+        elements, coordinates = esp.read_xyz(os.path.join(conf_folder, 'mol1_conf{}.xyz'.format(i)))
+        points = np.loadtxt(os.path.join(conf_folder, 'mol1_conf{}.espf'.format(i)))
+        conformers.append((coordinates, points[:, :3], points[:, 3]))
+    assert elements == reference['elements']
+    charges = esp.resp_fit(elements, conformers)
+    assert np.allclose(charges, reference['charges'], atol=1e-5)
+    # Both carbons and all methyl hydrogens are equivalent
+    assert esp.symmetry_classes(elements, conformers[0][0]) == [[0, 2], [1], [3, 4, 5, 6, 7, 8]]
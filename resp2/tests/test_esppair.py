@@ -0,0 +1,68 @@
+"""
+Tests for the combined gas phase / PCM ESP calculations.
+"""
+
+import os
+import subprocess
+import sys
+
+from resp2 import esppair
+
+LIQUID = """memory 2 gb
+molecule mol {
+0 1
+O 0.0 0.0 0.0
+}
+set {
+basis aug-cc-pV(D+d)Z
+pcm true
+pcm_scf_type total
+}
+pcm = {
+   Medium {
+   Solvent = Water
+   }
+}
+E, wfn = prop('PW6B95', properties=['GRID_ESP'], return_wfn=True)
+"""
+
+# Writes the files of the combined session: gas phase ESP (renamed by the input) and PCM ESP
+FAKE_PSI4 = """import sys
+open('gas_grid_esp.dat', 'w').write('gas\\n')
+open('grid_esp.dat', 'w').write('pcm\\n')
+open(sys.argv[2], 'w').write('Buy a developer a beer!\\n')
+"""
+
+
+def test_combined_input():
+    gas = esppair.strip_pcm(LIQUID)
+    assert 'pcm' not in gas.lower() and 'basis aug-cc-pV(D+d)Z' in gas
+    combined = esppair.combined_input(LIQUID)
+    assert combined.count("prop('PW6B95'") == 2
+    assert combined.index("os.replace(_name, 'gas_' + _name)") < combined.index('set guess read')
+    assert combined.index('set guess read') < combined.rindex("prop('PW6B95'")
+
+
+def test_pair_and_cached(tmpdir):
+    psi4 = tmpdir.join('psi4')
+    psi4.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, tmpdir.join('fake.py')))
+    psi4.chmod(0o755)
+    tmpdir.join('fake.py').write(FAKE_PSI4)
+    cache = str(tmpdir.join('cache'))
+    for branch, text in [('liquid', LIQUID), ('gas', esppair.strip_pcm(LIQUID))]:
+        tmpdir.mkdir(branch).join('input.dat').write(text)
+        tmpdir.join(branch, 'grid.dat').write('0.0 0.0 2.0\n')
+    liquid = str(tmpdir.join('liquid', 'input.dat'))
+    assert esppair.run([liquid, '-n', '2'], 'pair', cache, psi4=str(psi4)) == 0
+    assert tmpdir.join('liquid', 'grid_esp.dat').read() == 'pcm\n'
+    gas = str(tmpdir.join('gas', 'input.dat'))
+    assert esppair.run([gas], 'cached', cache, psi4='/nonexistent/psi4') == 0
+    assert tmpdir.join('gas', 'grid_esp.dat').read() == 'gas\n'
+    assert 'beer' in tmpdir.join('gas', 'output.dat').read()
+    env = esppair.pair_environment(cache, 'pair', psi4=str(psi4))
+    assert env['PATH'].startswith(os.path.join(cache, 'bin')) and env['RESP2_ESP_PAIR'] == 'pair'
+    # The wrapper does not import resp2/resp2.py, whose optional dependencies print to stdout
+    env = esppair.pair_environment(str(tmpdir.join('cache2')), 'pair', psi4=str(psi4))
+    output = subprocess.run(['psi4', liquid], env=dict(env, PYTHONPATH=''), cwd=str(tmpdir), stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True)
+    assert output.returncode == 0 and output.stdout == ''
@@ -0,0 +1,63 @@
+"""
+Tests for the executor backends. Local worker processes stand in for workers on several nodes.
+"""
+
+import multiprocessing
+import os
+import threading
+import pytest
+from resp2 import executors, scheduler
+
+
+def square(x=0):
+    return x * x, os.getpid()
+
+
+def fail():
+    raise ValueError('broken')
+
+
+class UnpicklableError(Exception):
+    def __init__(self, message):
+        super(UnpicklableError, self).__init__(message)
+        # Stands in for psi4 or openeye objects attached to an exception
+        self.handle = threading.Lock()
+
+
+def fail_unpicklable():
+    raise UnpicklableError('SCF did not converge')
+
+
+def test_shared_executor(tmpdir):
+    path = str(tmpdir.join('queue.db'))
+    executor = executors.SharedExecutor(path, poll_interval=0.05)
+    futures = [executor.submit(square, x=x) for x in range(6)] + [executor.submit(fail)]
+    workers = [multiprocessing.Process(target=executors.worker, args=(path, 0.05, 1.0)) for _ in range(2)]
+    for process in workers:
+        process.start()
+    assert [future.result(timeout=30)[0] for future in futures[:-1]] == [x * x for x in range(6)]
+    with pytest.raises(ValueError):
+        futures[-1].result(timeout=30)
+    executor.shutdown()
+    for process in workers:
+        process.join()
+    assert executors.TaskQueue(path).counts() == {'done': 6, 'failed': 1}
+
+
+def test_task_graph_with_executor():
+    tasks = [scheduler.Task('a', square, dict(x=3)),
+             scheduler.Task('b', square, dict(x=4), requires=['a'])]
+    results = scheduler.run_task_graph(tasks, max_workers=2, executor=executors.InlineExecutor())
+    assert results['a'][0] == 9 and results['b'][0] == 16
+
+
+def test_shared_executor_unpicklable_error(tmpdir):
+    path = str(tmpdir.join('queue.db'))
+    executor = executors.SharedExecutor(path, poll_interval=0.05)
+    future = executor.submit(fail_unpicklable)
+    assert executors.worker(path, max_tasks=1) == 1
+    with pytest.raises(executors.TaskError) as error:
+        future.result(timeout=30)
+    assert 'SCF did not converge' in str(error.value) and 'fail_unpicklable' in str(error.value)
+    executor.shutdown()
+    assert executors.TaskQueue(path).counts() == {'failed': 1}
@@ -0,0 +1,42 @@
+"""
+Tests for the asynchronous job runner.
+"""
+
+import asyncio
+import sys
+import time
+from resp2 import jobs
+
+
+def test_exit_codes(tmpdir):
+    stdout = str(tmpdir.join('out'))
+    result = jobs.run_job(jobs.Job([sys.executable, '-c', 'print("hello"); exit(3)'], stdout=stdout))
+    assert result.returncode == 3 and not result.success
+    assert open(stdout).read().strip() == 'hello'
+    assert jobs.run_job(jobs.Job(['no-such-program-resp2'])).returncode == 127
+
+
+def test_timeout_kills_process_group():
+    t0 = time.time()
+    # The child started by the shell has to be killed as well, otherwise wait() would not return
+    result = jobs.run_job(jobs.Job(['sh', '-c', 'sleep 30 & wait'], timeout=0.5))
+    assert result.timed_out and not result.success
+    assert time.time() - t0 < 10
+
+
+def test_concurrency_limit():
+    sleep = [sys.executable, '-c', 'import time; time.sleep(0.5)']
+    t0 = time.time()
+    runner = jobs.JobRunner(max_jobs=4)
+    results = runner.submit_all([jobs.Job(sleep) for _ in range(4)], max_concurrent=2).result()
+    elapsed = time.time() - t0
+    assert all(result.success for result in results)
+    assert 1.0 <= elapsed < 1.9
+
+    runner = jobs.JobRunner(max_jobs=1)
+    t0 = time.time()
+    results = runner.submit_all([jobs.Job(sleep) for _ in range(2)]).result()
+    assert time.time() - t0 >= 1.0
+
+    results = asyncio.run(jobs.run_jobs_async([jobs.Job(sleep) for _ in range(2)]))
+    assert len(results) == 2
@@ -0,0 +1,33 @@
+"""
+Tests for the resumable stage manifests.
+"""
+
+import os
+from resp2 import manifest
+
+calls = []
+
+
+def make_output(source='', target=''):
+    calls.append(source)
+    open(target, 'w').write(open(source).read().upper())
+    return len(calls)
+
+
+def test_run_stage_skips_complete_stages(tmpdir):
+    folder = str(tmpdir)
+    source, target = os.path.join(folder, 'in.txt'), os.path.join(folder, 'out.txt')
+    open(source, 'w').write('abc')
+    kwargs = dict(function=make_output, kwargs=dict(source=source, target=target), inputs=[source], outputs=[target])
+    del calls[:]
+    assert manifest.run_stage(folder, 'stage', **kwargs) == 1
+    assert manifest.run_stage(folder, 'stage', **kwargs) == 1
+    assert len(calls) == 1
+    # Changed inputs or outputs invalidate the stage
+    open(source, 'w').write('abcd')
+    assert manifest.run_stage(folder, 'stage', **kwargs) == 2
+    os.remove(target)
+    assert manifest.run_stage(folder, 'stage', **kwargs) == 3
+    manifest.invalidate(folder, 'stage')
+    assert manifest.run_stage(folder, 'stage', **kwargs) == 4
+    assert os.listdir(os.path.join(folder, manifest.MANIFEST_FOLDER)) == ['stage.json']
@@ -0,0 +1,83 @@
+"""
+Tests for the streaming stage pipeline.
+"""
+
+import threading
+import time
+
+import pytest
+
+from resp2 import pipeline
+
+
+def test_pipeline_overlaps_stages():
+    active = {'slow': 0, 'fast': 0}
+    overlap = []
+    lock = threading.Lock()
+
+    def stage(name, duration):
+        def function(item):
+            with lock:
+                active[name] += 1
+                overlap.append(active['slow'] > 0 and active['fast'] > 0)
+            time.sleep(duration)
+            with lock:
+                active[name] -= 1
+            if item['name'] == 'bad' and name == 'fast':
+                raise RuntimeError('failed')
+            item.setdefault('stages', []).append(name)
+        return function
+
+    stages = [pipeline.Stage('fast', stage('fast', 0.05), workers=2), pipeline.Stage('slow', stage('slow', 0.1))]
+    items = [{'name': 'mol{}'.format(k)} for k in range(5)] + [{'name': 'bad'}]
+    results = pipeline.Pipeline(stages, maxsize=1).run(items)
+    assert len(results) == 6
+    assert any(overlap)
+    for item in results:
+        if item['name'] == 'bad':
+            assert 'error' in item and 'stages' not in item
+        else:
+            assert item['stages'] == ['fast', 'slow']
+
+
+def test_pipeline_raises_error_of_items():
+    def items():
+        yield {'name': 'mol0'}
+        yield {'name': 'mol1'}
+        raise ValueError('broken table')
+
+    stages = [pipeline.Stage('first', lambda item: item, workers=2), pipeline.Stage('second', lambda item: item)]
+    finished = []
+    with pytest.raises(ValueError, match='broken table'):
+        for item in pipeline.Pipeline(stages, maxsize=1).stream(items()):
+            finished.append(item['name'])
+    assert sorted(finished) == ['mol0', 'mol1']
+
+
+def test_iter_charges_async(monkeypatch):
+    import asyncio
+
+    def fake_charges(molecule):
+        time.sleep(molecule['duration'])
+        molecule['charges'] = [dict(type='RESP2', delta=1.0, file=None, charges=[0.0])]
+
+    fake = pipeline.Pipeline([pipeline.Stage('charges', fake_charges, workers=2)])
+    monkeypatch.setattr(pipeline, 'charge_pipeline', lambda workers=None, maxsize=2: fake)
+
+    async def collect():
+        return [molecule['name'] async for molecule, charges in pipeline.iter_charges_async(
+            [dict(name='slow', duration=0.3), dict(name='fast', duration=0.05)])]
+
+    assert asyncio.run(collect()) == ['fast', 'slow']
+
+
+def test_failed_esp_conformer_stops_the_molecule(monkeypatch):
+    from resp2 import resp2 as r
+    fitted = []
+    monkeypatch.setattr(r, 'prepare_respyte', lambda **kwargs: 0)
+    monkeypatch.setattr(r, 'generate_esp', lambda number_of_conformers=1, **kwargs: {1: True, 2: False})
+    monkeypatch.setattr(r, 'fit_respyte', lambda type='RESP1', **kwargs: fitted.append(type))
+    stages = [pipeline.Stage('esp', pipeline.esp_stage), pipeline.Stage('fit', pipeline.fit_stage)]
+    molecule, = pipeline.Pipeline(stages).run([dict(name='methanol', resname='MET', number_of_conformers=2,
+                                                    charge_type='RESP1')])
+    assert 'failed for conformers [2]' in molecule['error'] and fitted == []
@@ -0,0 +1,40 @@
+"""
+Tests for the dry-run planner.
+"""
+
+import json
+from resp2 import cost, plan, presets
+
+
+def test_plan_molecule(tmpdir):
+    planned = plan.plan_molecule(name='methanol', smiles='CO', folder=str(tmpdir), charge_types=['RESP2'],
+                                 deltas=[0.6], number_of_conformers=2, density=790, cost_model=cost.CostModel())
+    stages = [job.stage for job in planned]
+    assert stages.count('optimization HF/6-31G*') == 2
+    assert stages.count('RESP2LIQUID') == 2 and stages.count('RESP2GAS') == 2
+    # The gas phase ESP comes out of the RESP2LIQUID sessions
+    assert {job.program for job in planned if job.stage == 'RESP2GAS'} == {'cached'}
+    assert 'RESP1' not in stages and 'box' in stages
+    summary = json.loads(plan.to_json(planned))['summary']
+    assert summary['jobs'] == len(planned)
+    assert abs(summary['core_hours'] - sum(job.core_hours for job in planned)) < 1e-9
+    # Without optimization only the ESP branches are planned
+    assert not [job for job in plan.plan_molecule(name='methanol', smiles='CO', folder=str(tmpdir), opt=False)
+                if job.stage.startswith('optimization')]
+
+
+def test_plan_molecule_hf_hessian(tmpdir):
+    production = presets.get_preset('production')
+    preset = presets.Preset('hessian', production.esp_levels, production.ladder, hf_hessian=True)
+    model = cost.CostModel()
+    planned = plan.plan_molecule(name='methanol', smiles='CO', folder=str(tmpdir), number_of_conformers=2,
+                                 cost_model=model, preset=preset)
+    hessians = [job for job in planned if job.stage == 'hessian HF/6-31G*']
+    assert len(hessians) == 2
+    optimization = sum(job.core_hours for job in planned if job.conformer == 1 and
+                       (job.stage.startswith('optimization') or job.stage.startswith('hessian')))
+    elements = cost.elements_from_smiles('CO')
+    assert abs(optimization - model.estimate_optimization(elements, preset.ladder, True) / 3600) < 1e-9
+    assert not [job for job in plan.plan_molecule(name='methanol', smiles='CO', folder=str(tmpdir),
+                                                  number_of_conformers=2, cost_model=model)
+                if job.stage.startswith('hessian')]
@@ -0,0 +1,42 @@
+"""
+Tests for the level of theory presets and their comparison.
+"""
+
+import pytest
+from resp2 import compare, cost, plan, presets, resp2
+
+
+def test_screening_preset(tmpdir):
+    assert presets.get_preset() is presets.PRESETS['production']
+    with pytest.raises(ValueError):
+        presets.get_preset('unknown')
+    screening = presets.get_preset('screening')
+    text = resp2.optimization_input(['C 0.0 0.0 0.0\n'], screening.ladder, 2.0, 'opt.xyz',
+                                    options=screening.options(optimization=True))
+    assert 'set scf_type df' in text and 'set g_convergence gau_loose' in text
+    assert text.count('optimize(') == 2
+    model = cost.CostModel()
+    production = plan.plan_molecule(name='methanol', smiles='CO', folder=str(tmpdir), number_of_conformers=2,
+                                    cost_model=model)
+    fast = plan.plan_molecule(name='methanol', smiles='CO', folder=str(tmpdir), number_of_conformers=2,
+                              cost_model=model, preset='screening')
+    assert len([job for job in fast if job.stage.startswith('optimization')]) == 2 * 2
+    assert sum(job.core_hours for job in fast) < sum(job.core_hours for job in production)
+
+
+def test_compare_presets(monkeypatch, tmpdir):
+    reference = [0.4, -0.6, 0.2]
+    shifts = {'production': 0.0, 'screening': 0.01}
+
+    def fake_pipeline(molecules, preset=None, **settings):
+        assert all(molecule['name'].startswith(str(tmpdir.join(preset))) for molecule in molecules)
+        return [dict(molecule, charges=[dict(type='RESP2', delta=0.6, file=None,
+                                             charges=[q + shifts[preset] for q in reference])])
+                for molecule in molecules]
+
+    monkeypatch.setattr(compare.pipeline, 'run_pipeline', fake_pipeline)
+    report = compare.compare_presets([dict(name='mol0001', resname='M01', smiles='CO')], workdir=str(tmpdir))
+    deviation = report['presets'][0]['deviations'][0]
+    assert deviation['molecules'] == 1 and deviation['atoms'] == 3
+    assert abs(deviation['rms'] - 0.01) < 1e-9 and abs(deviation['max'] - 0.01) < 1e-9
+    assert list(deviation['per_molecule']) == ['mol0001']
@@ -0,0 +1,89 @@
+"""
+Tests for the progress tracker and status file.
+"""
+
+import json
+import os
+
+from resp2 import progress
+
+
+def test_tracker_and_reporter(tmpdir):
+    tracker = progress.Tracker()
+    tracker.add('optimization', 4, cost=100.0)
+    tracker.start('optimization', 2)
+    tracker.finish('optimization', cost=100.0)
+    tracker.finish('optimization', success=False, cost=100.0)
+    snapshot = tracker.snapshot()
+    counts = snapshot['stages']['optimization']
+    assert (counts['queued'], counts['running'], counts['done'], counts['failed']) == (2, 0, 1, 1)
+    assert counts['per_hour'] > 0 and snapshot['eta'] is not None
+    assert 'optimization 1/4 done' in progress.format_snapshot(snapshot)
+    path = str(tmpdir.join('status.json'))
+    progress.Reporter(tracker, path=path, interval=0.01).start().stop()
+    assert json.load(open(path))['stages']['optimization']['done'] == 1
+
+
+def _stage_jobs(stage='', n=1):
+    tracker = progress.get_tracker()
+    tracker.add(stage, n, cost=10.0)
+    tracker.start(stage, n)
+    tracker.finish(stage, n, cost=10.0)
+    return os.getpid()
+
+
+def test_forwarded_jobs_reach_the_parent(tmpdir):
+    from resp2 import executors
+    journal = str(tmpdir)
+    tracker = progress.Tracker()
+    with executors.LocalExecutor(max_workers=2) as pool:
+        futures = [pool.submit(progress.Forwarded(_stage_jobs, journal), stage='optimization', n=2)
+                   for _ in range(3)]
+        pids = {future.result() for future in futures}
+    assert os.getpid() not in pids
+    assert tracker.follow(journal) == 9 and tracker.follow(journal) == 0
+    counts = tracker.snapshot()['stages']['optimization']
+    assert (counts['queued'], counts['running'], counts['done']) == (0, 0, 6)
+    # In the parent process the function runs directly
+    assert progress.Forwarded(_stage_jobs, journal)(stage='esp') == os.getpid()
+    assert tracker.follow(journal) == 0
+
+
+def _fake_conformers(resname='MOL', folder='', **kwargs):
+    open(os.path.join(folder, resname + '-conformers_1.mol2'), 'w').close()
+    return 2
+
+
+def _fake_optimization(number_of_conformers=1, **kwargs):
+    _stage_jobs('optimization', number_of_conformers)
+    return {i: True for i in range(1, number_of_conformers + 1)}
+
+
+def _fake_respyte(type='RESP1', name='', number_of_conformers=1, **kwargs):
+    _stage_jobs(type, number_of_conformers)
+    os.makedirs('{}-{}/resp_output'.format(name, type))
+    open('{}-{}/resp_output/mol1_conf1.mol2'.format(name, type), 'w').close()
+    return 0
+
+
+def _fake_charge_file(**kwargs):
+    return 0
+
+
+def test_create_RESP2_reports_jobs_of_worker_processes(tmpdir, monkeypatch):
+    from resp2 import resp2 as r
+    monkeypatch.chdir(str(tmpdir))
+    monkeypatch.setattr(r, 'create_structure', lambda smi=None, folder='', resname='MOL':
+                        os.path.join(folder, resname + '.mol2'))
+    monkeypatch.setattr(r, 'create_conformers', _fake_conformers)
+    monkeypatch.setattr(r, 'optimize_conformers', _fake_optimization)
+    monkeypatch.setattr(r, 'create_respyte', _fake_respyte)
+    monkeypatch.setattr(r, 'create_charge_file', _fake_charge_file)
+    monkeypatch.setattr(progress, '_tracker', progress.Tracker())
+    status_file = str(tmpdir.join('status.json'))
+    r.create_RESP2(smi='CO', name='methanol', folder='methanol-liquid', resname='MET', charge_types=['RESP2'],
+                   deltas=[0.6], nworkers=2, status_file=status_file)
+    stages = json.load(open(status_file))['stages']
+    assert stages['optimization']['done'] == 2
+    assert stages['RESP2LIQUID']['done'] == 2 and stages['RESP2GAS']['done'] == 2
+    assert not [f for f in os.listdir('methanol-liquid') if f.startswith('.progress-')]
@@ -0,0 +1,43 @@
+"""
+Tests for the pool of warm psi4 workers with the fake backend.
+"""
+
+import os
+
+from resp2 import cost
+from resp2 import psi4pool
+from resp2 import resp2 as resp2_module
+from resp2 import retry
+
+WATER = ['O 0.0 0.0 0.0\n', 'H 0.0 -0.76 0.52\n', 'H 0.0 0.76 0.52\n']
+
+
+def test_pool_runs_tasks_in_warm_workers(tmpdir):
+    path = str(tmpdir.join('opt.xyz'))
+    with psi4pool.Psi4Pool(nworkers=2, backend='fake') as pool:
+        tasks = [psi4pool.Psi4Task('optimize', WATER, xyz_file=path, name='water'),
+                 psi4pool.Psi4Task('energy', WATER[:1], name='oxygen')]
+        results = pool.run(tasks)
+    assert [result.success for result in results] == [True, True]
+    assert [result.energy for result in results] == [-3.0, -1.0]
+    assert open(path).read().splitlines()[2:] == [line.strip() for line in WATER]
+
+
+def test_optimize_conformers_in_pool(tmpdir, monkeypatch):
+    monkeypatch.setenv('RESP2_TIMINGS', str(tmpdir.join('timings.jsonl')))
+    folder = str(tmpdir)
+    for i in [1, 2]:
+        psi4pool.write_xyz(os.path.join(folder, 'MOL-conformers_{}.xyz'.format(i)), WATER)
+    failing = 'psi4 optimization water conformer 2'
+    with psi4pool.Psi4Pool(nworkers=1, backend='fake', fail=[failing]) as pool:
+        success = resp2_module.optimize_conformers(name='water', number_of_conformers=2, folder=folder,
+                                                   convert=False, pool=pool)
+    assert success == {1: True, 2: True}
+    assert os.path.isfile(os.path.join(folder, 'MOL-confermers_opt_2.xyz'))
+    attempts = retry.load_attempts(folder)
+    assert [(a['conformer'], a['attempt'], a['success']) for a in attempts] == [(1, 1, True), (2, 1, False),
+                                                                                 (2, 2, True)]
+    # The retry continued after the checkpoint of the first tier
+    assert resp2_module._last_checkpoint(folder, 'MOL', 2, cost.OPTIMIZATION_LADDER)[0] == 2
+    # The fake backend does not calibrate the cost model
+    assert cost.load_timings() == []
@@ -0,0 +1,31 @@
+"""
+Tests for the psi4 job sizing.
+"""
+
+from resp2 import resources
+
+
+def test_plan_psi4_jobs():
+    host = resources.HostResources(range(32), 120.0)
+    # Small molecules get many narrow jobs, large molecules few wide ones
+    small = resources.plan_psi4_jobs(2, host=host)
+    large = resources.plan_psi4_jobs(40, host=host)
+    assert len(small) > len(large)
+    assert small[0].threads < large[0].threads
+    for slots in (small, large):
+        cpus = [cpu for slot in slots for cpu in slot.cpus]
+        assert len(cpus) == len(set(cpus)) <= 32
+        assert sum(slot.memory for slot in slots) <= 120.0
+
+    # Five conformers share the whole node
+    slots = resources.plan_psi4_jobs(2, njobs=5, host=host)
+    assert len(slots) == 5 and slots[0].threads == 6
+    # Memory limits the number of concurrent jobs
+    slots = resources.plan_psi4_jobs(2, nthreads=1, memory=50, host=host)
+    assert len(slots) == 2 and slots[0].threads == 1
+
+
+def test_count_heavy_atoms(tmpdir):
+    xyz = tmpdir.join('mol.xyz')
+    xyz.write('6\n\nC 0 0 0\nO 1.4 0 0\nH 0 1 0\nH 0 -1 0\nH -1 0 0\nH 1.8 0.5 0\n')
+    assert resources.count_heavy_atoms(str(xyz)) == 2
@@ -10,3 +10,117 @@ import sys
 def test_resp2_imported():
     """Sample test, will always pass so long as import statement worked"""
     assert "resp2" in sys.modules
+
+
+def test_required_branches():
+    from resp2 import resp2 as r
+    assert r.required_branches(['RESP2'], [1.0]) == ['RESP2LIQUID']
+    assert r.required_branches(['RESP2'], [0.0]) == ['RESP2GAS']
+    assert r.required_branches(['RESP2'], [0.6]) == ['RESP2LIQUID', 'RESP2GAS']
+    assert r.required_branches(['RESP1', 'RESP2'], [1.0]) == ['RESP2LIQUID', 'RESP1']
+
+
+def test_create_fb_input_keeps_working_directory(tmpdir, monkeypatch):
+    import os
+    from resp2 import resp2 as r
+    monkeypatch.chdir(str(tmpdir))
+    os.makedirs('targets/methanol-liquid')
+    open('targets/methanol-liquid/MET-box.pdb', 'w').close()
+    r.create_fb_input(name='optimize.in', targets=['methanol'])
+    assert os.getcwd() == str(tmpdir)
+    assert 'liquid_coords    MET-box.pdb' in open('targets/optimize.in').read()
+
+
+def test_create_target_passes_timeout(tmpdir, monkeypatch):
+    from resp2 import resp2 as r
+    monkeypatch.chdir(str(tmpdir))
+    calls = []
+
+    def run_create_mol2_pdb(**kwargs):
+        calls.append(kwargs)
+        if len(calls) < 3:
+            raise RuntimeError('genbox failed')
+
+    monkeypatch.setattr(r.create_mol2_pdb, 'run_create_mol2_pdb', run_create_mol2_pdb)
+    r.create_target(smiles='CO', name='methanol', density=790, hov=37.4, dielectric=32.7, resname='MET', timeout=60)
+    # Every retry with a lower density is limited as well
+    assert [call['timeout'] for call in calls] == [60, 60, 60]
+    assert [call['density'] for call in calls] == [540, 440, 390]
+
+
+def test_optimization_input_reuses_previous_tier():
+    from resp2 import resp2 as r
+    ladder = [('HF', '6-31G*'), ('HF', 'cc-pV(D+d)Z'), ('PW6B95', 'cc-pV(D+d)Z')]
+    text = r.optimization_input(['O 0 0 0\n'], ladder, 4, 'opt.xyz', checkpoints=['t1.xyz', 't2.xyz'])
+    assert text.count('optimize(') == 3 and 'hessian' not in text
+    assert text.count('set guess read') == 2
+    assert text.index("save_xyz_file('t1.xyz'") < text.index('set basis cc-pV(D+d)Z')
+    # The HF Hessian is an additional job the preset has to ask for
+    text = r.optimization_input(['O 0 0 0\n'], ladder, 4, 'opt.xyz', hessian=True)
+    assert text.count("hessian('HF')") == 1 and text.count('set cart_hess_read true') == 1
+    # Only the tier after the Hessian reads it; the PW6B95 tier starts from a geometry the second tier moved
+    tiers = text.split('optimize(')
+    assert 'set cart_hess_read true' in tiers[1] and 'set cart_hess_read false' in tiers[2]
+    resumed = r.optimization_input(['O 0 0 0\n'], ladder[2:], 4, 'opt.xyz', hessian=True)
+    assert 'guess read' not in resumed and 'hessian' not in resumed
+
+
+# respyte's esp_generator: selects the grid and leaves a psi4 run without ESP
+FAKE_ESP_GENERATOR = """import os
+tmp = 'input/molecules/mol1/conf1/tmp'
+os.makedirs(tmp)
+open(os.path.join(tmp, 'input.dat'), 'w').write('memory 2 gb\\nE, wfn = prop("HF", properties=["GRID_ESP"])\\n')
+open(os.path.join(tmp, 'grid.dat'), 'w').write('0.0 0.0 2.0\\n0.0 2.0 0.0\\n')
+open(os.path.join(tmp, 'output.dat'), 'w').write('SCF did not converge\\n')
+"""
+
+FAKE_PSI4 = """import sys
+open('grid_esp.dat', 'w').write('0.25\\n-0.5\\n')
+open('output.dat', 'w').write('Buy a developer a beer!\\n')
+"""
+
+
+def _fake_respyte(tmpdir, monkeypatch, psi4=FAKE_PSI4):
+    # Runs esp_generator and psi4 from scripts in tmpdir; resp_optimizer fails
+    import os
+    from resp2 import resp2 as r
+    monkeypatch.chdir(str(tmpdir))
+    monkeypatch.setenv('RESP2_TIMINGS', str(tmpdir.join('timings.jsonl')))
+    respyte = tmpdir.mkdir('respyte')
+    respyte.join('esp_generator.py').write(FAKE_ESP_GENERATOR)
+    respyte.join('resp_optimizer.py').write('import sys\nsys.exit(1)\n')
+    monkeypatch.setattr(r, 'RESPYTE_PATH', str(respyte))
+    bin_folder = tmpdir.mkdir('bin')
+    bin_folder.join('psi4').write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, tmpdir.join('psi4.py')))
+    bin_folder.join('psi4').chmod(0o755)
+    tmpdir.join('psi4.py').write(psi4)
+    monkeypatch.setenv('PATH', str(bin_folder) + os.pathsep + os.environ['PATH'])
+    conf_folder = tmpdir.mkdir('water-RESP1').mkdir('input').mkdir('molecules').mkdir('mol1').mkdir('conf1')
+    conf_folder.join('mol1_conf1.xyz').write('1\n\nO 0.0 0.0 0.0\n')
+    return conf_folder
+
+
+def test_retried_esp_is_fitted(tmpdir, monkeypatch):
+    from resp2 import resp2 as r
+    conf_folder = _fake_respyte(tmpdir, monkeypatch)
+    # An ESP file of an earlier run is not fitted
+    conf_folder.join('mol1_conf1.espf').write('stale\n')
+    assert r.generate_esp(type='RESP1', name='water', number_of_conformers=1) == {1: True}
+    espf = [[float(x) for x in line.split()] for line in conf_folder.join('mol1_conf1.espf').readlines()]
+    assert espf == [[0.0, 0.0, 2.0, 0.25], [0.0, 2.0, 0.0, -0.5]]
+
+
+@pytest.mark.parametrize('psi4', [FAKE_PSI4, 'open("output.dat", "w").write("SCF did not converge")\n'])
+def test_failed_branch_is_not_checkpointed(tmpdir, monkeypatch, psi4):
+    import os
+    from resp2 import resp2 as r
+    from resp2 import manifest
+    _fake_respyte(tmpdir, monkeypatch, psi4=psi4)
+    stale = tmpdir.join('water-RESP1').mkdir('resp_output').join('mol1_conf1.mol2')
+    stale.write('charges of an earlier fit\n')
+    kwargs = dict(name='water', type='RESP1', number_of_conformers=1)
+    with pytest.raises(RuntimeError):
+        manifest.run_stage(str(tmpdir), 'RESP1', r.calculate_respyte, kwargs, outputs=[str(stale)])
+    assert not os.path.exists(manifest.manifest_path(str(tmpdir), 'RESP1'))
+    # The failed fit removed the charges of the earlier fit
+    assert psi4 != FAKE_PSI4 or not stale.exists()
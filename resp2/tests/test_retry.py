@@ -0,0 +1,40 @@
+"""
+Tests for the retry policy of failed psi4 jobs.
+"""
+
+from resp2 import retry
+
+OUTPUT = """
+    Geometry (in Angstrom), charge = 0, multiplicity = 1:
+
+       Center              X                  Y                   Z       
+    ------------   -----------------  -----------------  -----------------
+           O          0.000000000000     0.000000000000    -0.065000000000
+           H1         0.000000000000    -0.759000000000     0.520000000000
+
+  Nuclear repulsion =    9.1
+"""
+
+
+def test_escalate_input():
+    text = "memory 4 gb\nmolecule mol {\n0 1\nO 0 0 0\n}\nset basis 6-31G*\noptimize('HF')\n"
+    policy = retry.RetryPolicy(max_attempts=4)
+    assert retry.escalate_input(text, policy.escalation(1)) == text
+    escalated = retry.escalate_input(text, policy.escalation(4))
+    assert escalated.startswith('memory 8 gb')
+    assert escalated.index('set guess core') < escalated.index("optimize('HF')")
+    assert policy.retry(3) and not policy.retry(4)
+    # The default number of attempts reaches the escalation with more memory
+    default = retry.RetryPolicy()
+    assert default.escalation(default.max_attempts).get('memory_factor') == 2.0
+
+
+def test_last_geometry(tmpdir):
+    path = str(tmpdir.join('output.dat'))
+    open(path, 'w').write(OUTPUT + OUTPUT.replace('-0.065', '-0.070'))
+    geometry = retry.last_geometry(path)
+    assert len(geometry) == 2
+    assert geometry[0].split()[0] == 'O' and float(geometry[0].split()[3]) == -0.07
+    assert geometry[1].split()[0] == 'H'
+    retry.record_attempt(str(tmpdir), 'optimization', 1, 1, {}, False)
+    assert retry.load_attempts(str(tmpdir))[0]['success'] is False
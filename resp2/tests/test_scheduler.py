@@ -0,0 +1,33 @@
+"""
+Tests for the dependency graph scheduler.
+"""
+
+import pytest
+from resp2 import scheduler
+
+
+def add(a=0, b=0):
+    return a + b
+
+
+def fail():
+    raise RuntimeError('failed')
+
+
+@pytest.mark.parametrize('max_workers', [1, 3])
+def test_run_task_graph(max_workers):
+    tasks = [scheduler.Task('x', add, dict(a=1, b=1)),
+             scheduler.Task('y', add, dict(a=scheduler.Result('x'), b=2)),
+             scheduler.Task('z', add, dict(a=scheduler.Result('x'), b=3)),
+             scheduler.Task('total', add, dict(a=scheduler.Result('y'), b=scheduler.Result('z')))]
+    results = scheduler.run_task_graph(tasks, max_workers=max_workers)
+    assert results == {'x': 2, 'y': 4, 'z': 5, 'total': 9}
+
+
+def test_run_task_graph_errors():
+    with pytest.raises(ValueError):
+        scheduler.run_task_graph([scheduler.Task('a', add, requires=['missing'])])
+    with pytest.raises(ValueError):
+        scheduler.run_task_graph([scheduler.Task('a', add, requires=['b']), scheduler.Task('b', add, requires=['a'])])
+    with pytest.raises(RuntimeError):
+        scheduler.run_task_graph([scheduler.Task('a', fail), scheduler.Task('b', add, requires=['a'])])